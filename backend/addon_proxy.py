@@ -1,213 +1,645 @@
+import asyncio
+import functools
 import json
+import os
 import re
-from mitmproxy import http, ctx
+import time
+from mitmproxy import command, http, ctx
+
+from copilot_patch import patch_start_payload
+from metrics import Metrics, METRICS_FILE, FLUSH_INTERVAL
+from html_injector import HtmlInjector, can_stream, inject
+from http_cache import (
+    IMMUTABLE_CACHE_CONTROL, REWRITTEN_CACHE_CONTROL, ValidatorStore, freshness_lifetime, is_static_asset,
+    is_synthetic, parse_rewritten_etag, rewritten_etag, split_etags, synthetic_etag,
+)
+from rewrite_cache import RewriteCache, DEFAULT_CACHE_MB
+from worker_pool import RewritePool, DEFAULT_WORKERS, DEFAULT_TIMEOUT
+from rules_store import RulesStore, RulesSnapshot, RULES_PATH
+from routing import Router, route, host_patterns
+from rules_compiler import SHIM_PREFIX
+
+LABS_DATA_PATTERN = re.compile(r'/fx/_next/data/.*\.json(\?.*)?$', re.S)
+
+NOT_FOUND_TRUE = b'{"notFound":true}'
+NOT_FOUND_FALSE = b'{"notFound":false}'
+
+# Smaller bodies are rewritten inline; handing them to the pool costs more than it saves.
+OFFLOAD_MIN_BYTES = 64 * 1024
+
+# Bodies above this size are streamed through untouched even on matched routes.
+DEFAULT_MAX_BODY_MB = 32
+
+def set_raw_content(response, raw):
+    """Swaps in an already-encoded body, keeping Content-Length in step."""
+    response.raw_content = raw
+    if "transfer-encoding" not in response.headers:
+        response.headers["content-length"] = str(len(raw))
+
+
+def cached_rewrite(handler=None, *, scope=None):
+    """
+    Serves repeat rewrites of the same upstream body from the addon's
+    RewriteCache. The key covers the handler, rules version, upstream
+    validator and content encoding, so the stored body is ready to send.
+    ``scope(self, flow)`` adds whatever else the result depends on, for
+    handlers whose rewrite varies with the URL.
+    """
+    if handler is None:
+        return functools.partial(cached_rewrite, scope=scope)
+
+    @functools.wraps(handler)
+    def wrapper(self, flow):
+        response = flow.response
+        raw = response.raw_content
+        if not isinstance(raw, bytes):
+            return handler(self, flow)
+
+        key = (
+            handler.__name__,
+            self.snapshot_for(flow).version,
+            RewriteCache.validator(raw, response.headers.get("etag"), flow.request.url),
+            response.headers.get("content-encoding", ""),
+        )
+        if scope is not None:
+            key += (scope(self, flow),)
+        found, body = self.rewrite_cache.get(key)
+        if found:
+            self.metrics.cache_hit(handler.__name__)
+            if body is not None:
+                set_raw_content(response, body)
+            return
+
+        handler(self, flow)
+        new_raw = response.raw_content
+        self.rewrite_cache.put(key, new_raw if new_raw != raw else None)
+    return wrapper
+
+
+class DetachedFlow:
+    """
+    What a handler running on the rewrite pool sees: the live request, a
+    private copy of the response and the rules snapshot pinned when the job
+    was queued. The copy only replaces flow.response if the job finishes in
+    time, so an abandoned rewrite can never touch the live flow.
+    """
+    __slots__ = ("request", "response", "tweaker_snapshot")
+
+    def __init__(self, flow, snapshot):
+        self.request = flow.request
+        self.response = flow.response.copy()
+        self.tweaker_snapshot = snapshot
+
 
 class AITweaker:
-    def __init__(self):
-        self.rules = {}
-        self.gemini_url_pattern = re.compile(r'^https?:\/\/www\.gstatic\.com\/.*m=_b(\?.*)?$', re.S)
-        self.gemini_html_pattern = re.compile(r'^https?:\/\/gemini\.google\.com\/((app|chat)|$)', re.S)
-        self.copilot_url_pattern = re.compile(r'^https?:\/\/copilot\.microsoft\.com\/c\/api\/start.*')
-        self.google_labs_url_pattern = re.compile(r'^https?:\/\/labs\.google\/fx\/_next\/static\/chunks\/pages\/index-.*\.js')
-        self.google_labs_json_pattern = re.compile(r'^https?:\/\/labs\.google\/fx\/_next\/data\/.*\.json(\?.*)?$')
+    def __init__(self, rules_store=None):
+        self.rules_store = rules_store or RulesStore()
+        self.snapshot = self.rules_store.snapshot
+        self.router = Router.from_object(self)
+        self.max_body_bytes = DEFAULT_MAX_BODY_MB * 1024 * 1024
+        self._stream_limit = None
+        self.rewrite_cache = RewriteCache()
+        self.validators = ValidatorStore()
+        self.pool = RewritePool()
+        self.metrics = Metrics()
+        self.metrics_file = METRICS_FILE
+        self._metrics_task = None
+
+    def load(self, loader):
+        loader.add_option(
+            name="tweaker_max_body_mb",
+            typespec=int,
+            default=DEFAULT_MAX_BODY_MB,
+            help="Stream responses larger than this many MB through without rewriting them.",
+        )
+        loader.add_option(
+            name="tweaker_cache_mb",
+            typespec=int,
+            default=DEFAULT_CACHE_MB,
+            help="Memory budget in MB for cached rewritten scripts.",
+        )
+        loader.add_option(
+            name="tweaker_workers",
+            typespec=int,
+            default=DEFAULT_WORKERS,
+            help="Threads used for rewrites too large to run on the event loop.",
+        )
+        loader.add_option(
+            name="tweaker_rewrite_timeout_ms",
+            typespec=int,
+            default=int(DEFAULT_TIMEOUT * 1000),
+            help="Milliseconds before an offloaded rewrite is abandoned and the response passed through unmodified.",
+        )
+        loader.add_option(
+            name="tweaker_rules_file",
+            typespec=str,
+            default=RULES_PATH,
+            help="The rules.json the backend generates.",
+        )
+        loader.add_option(
+            name="tweaker_metrics_file",
+            typespec=str,
+            default=METRICS_FILE,
+            help="Where to write handler metrics for the backend's /metrics route. Empty to disable.",
+        )
+
+    def configure(self, updated):
+        if "tweaker_max_body_mb" in updated:
+            self.max_body_bytes = ctx.options.tweaker_max_body_mb * 1024 * 1024
+            # Caps bodies of unknown length too: mitmproxy streams the rest once
+            # its buffer passes the limit. A limit set by hand is left alone.
+            limit = f"{ctx.options.tweaker_max_body_mb}m"
+            if ctx.options.stream_large_bodies in (None, self._stream_limit) and limit != self._stream_limit:
+                self._stream_limit = limit
+                ctx.options.update(stream_large_bodies=limit)
+        if "tweaker_cache_mb" in updated:
+            self.rewrite_cache = RewriteCache(ctx.options.tweaker_cache_mb * 1024 * 1024)
+        if "tweaker_workers" in updated or "tweaker_rewrite_timeout_ms" in updated:
+            self.pool.shutdown()
+            self.pool = RewritePool(ctx.options.tweaker_workers, timeout=ctx.options.tweaker_rewrite_timeout_ms / 1000)
+        if "tweaker_metrics_file" in updated:
+            self.metrics_file = ctx.options.tweaker_metrics_file
+        if "tweaker_rules_file" in updated and isinstance(self.rules_store, RulesStore):
+            # An in-process proxy is fed by a MemoryRulesStore and has no file
+            if self.rules_store.path != ctx.options.tweaker_rules_file:
+                self.rules_store = RulesStore(ctx.options.tweaker_rules_file)
+
+    def running(self):
+        self.write_metrics()
+        if self._metrics_task is None:
+            self._metrics_task = asyncio.get_running_loop().create_task(self.flush_metrics())
+
+    def done(self):
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        self.write_metrics()
+        self.pool.shutdown()
+
+    async def flush_metrics(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            # Also picks up rules while no intercepted flow arrives to do it,
+            # e.g. an app enabled while all of its hosts are tunnelled
+            self.load_rules()
+            if self.metrics.dirty:
+                self.write_metrics()
+            else:
+                self.heartbeat()
 
-    def load_rules(self):
+    def heartbeat(self):
+        """Bumps the metrics file's mtime: the backend's supervisor takes it as a sign of life."""
+        if not self.metrics_file:
+            return
         try:
-            # Assume rules.json is in the same directory
-            with open('rules.json', 'r') as f:
-                self.rules = json.load(f)
-        except Exception as e:
-            ctx.log.error(f"Error loading rules: {e}")
+            os.utime(self.metrics_file)
+        except OSError:
+            self.write_metrics()
 
+    def write_metrics(self):
+        if not self.metrics_file:
+            return
+        try:
+            self.metrics.write(
+                self.metrics_file,
+                pool=self.pool.stats(),
+                cache=self.rewrite_cache.stats(),
+                http=self.validators.stats(),
+            )
+        except OSError as e:
+            ctx.log.warn(f"Could not write metrics to {self.metrics_file}: {e}")
+
+    @command.command("tweaker.cache_stats")
+    def cache_stats(self) -> str:
+        """Hit, miss and eviction counters of the rewritten script cache."""
+        return json.dumps({**self.rewrite_cache.stats(), "http": self.validators.stats()})
+
+    @command.command("tweaker.pool_stats")
+    def pool_stats(self) -> str:
+        """Queue depth, wait times and timeouts of the rewrite pool."""
+        return json.dumps(self.pool.stats())
+
+    @property
+    def rules(self):
+        return self.snapshot.rules
+
+    @rules.setter
+    def rules(self, rules):
+        self.snapshot = RulesSnapshot.from_rules(rules)
+
+    def snapshot_for(self, flow):
+        """
+        The rules a handler must use for ``flow``: pinned for pooled jobs,
+        else the current rules of the profile the client is mapped to.
+        """
+        pinned = getattr(flow, "tweaker_snapshot", None)
+        if pinned is not None:
+            return pinned
+        snapshot = self.snapshot
+        if not snapshot.clients:
+            return snapshot
+        # Behind the multi-worker front acceptor every peer is 127.0.0.1, so
+        # there only proxy-auth usernames identify a client.
+        peername = flow.client_conn.peername
+        auth = flow.metadata.get("proxyauth")
+        return snapshot.for_client(peername[0] if peername else None, auth[0] if auth else None)
+
+    def load_rules(self):
+        # Cheap: the store only re-reads rules.json when the file changed.
+        # Jobs on the rewrite pool carry their own pinned snapshot, so a
+        # reload can never swap the rules out from under a half-processed flow.
+        snapshot = self.rules_store.get()
+        if snapshot is not self.snapshot:
+            self.snapshot = snapshot
+            self.sync_intercept_hosts()
+
+    def sync_intercept_hosts(self):
+        """Narrows TLS interception to the hosts the current rules can touch."""
+        hosts = self.rules.get("intercept_hosts")
+        options = getattr(ctx, "options", None)
+        if hosts is None or options is None:
+            return
+
+        patterns = host_patterns(hosts)
+        if list(options.allow_hosts) != patterns:
+            options.update(allow_hosts=patterns)
+            ctx.log.info(f"Intercepting {', '.join(sorted(hosts)) or 'no hosts'}.")
+
+    @route("www.gstatic.com", pattern=r'.*m=_b(\?.*)?$', app="gemini")
+    @cached_rewrite
     def modify_gemini_script(self, flow: http.HTTPFlow) -> None:
-        app = self.rules.get("apps", {}).get("gemini", {})
-        if not app.get("enabled", False):
+        gemini = self.snapshot_for(flow).compiled.gemini
+        if gemini is None:
             return
 
         try:
-            content = flow.response.get_text()
-            flags = app.get("flags", [])
-            flags_string = json.dumps(flags)
-
-            injection = f"""
-;(function(){{
-    try {{
-        const ext_flags = {flags_string};
-        const originalFlagFunc = self.getFlag;
-
-        self.getFlag = function(id, fallback) {{
-            if (ext_flags.includes(id)) return true;
-            return originalFlagFunc.call(self, id, fallback);
-        }};
-    }} catch (e) {{}}
-}})();
-"""
-            flow.response.text = injection + content
+            flow.response.content = gemini.script_injection + flow.response.content
             ctx.log.info("Injected Gemini flags into script.")
         except Exception as e:
+            self.metrics.error("modify_gemini_script")
             ctx.log.error(f"Error modifying Gemini script: {e}")
 
+    @route("gemini.google.com", "/app", content_type="text/html", hook="responseheaders", app="gemini")
+    @route("gemini.google.com", "/chat", content_type="text/html", hook="responseheaders", app="gemini")
+    @route("gemini.google.com", "/", pattern=r"/$", content_type="text/html", hook="responseheaders", app="gemini")
+    def stream_gemini_html(self, flow: http.HTTPFlow) -> None:
+        gemini = self.snapshot_for(flow).compiled.gemini
+        if gemini is None:
+            return
+
+        headers = flow.response.headers
+        encoding = headers.get("content-encoding", "")
+        if not can_stream(encoding):
+            # Unknown encoding: leave it buffered for modify_gemini_html
+            return
+
+        self.drop_validators(flow)
+        flow.response.stream = HtmlInjector(gemini.html_injection, encoding)
+        # The injector emits identity-encoded HTML of a new length
+        headers.pop("content-encoding", None)
+        headers.pop("content-length", None)
+        if flow.request.http_version == "HTTP/1.1":
+            headers["transfer-encoding"] = "chunked"
+        ctx.log.info("Streaming Gemini flags into HTML.")
+
+    @route("gemini.google.com", "/app", content_type="text/html", app="gemini")
+    @route("gemini.google.com", "/chat", content_type="text/html", app="gemini")
+    @route("gemini.google.com", "/", pattern=r"/$", content_type="text/html", app="gemini")
     def modify_gemini_html(self, flow: http.HTTPFlow) -> None:
-        app = self.rules.get("apps", {}).get("gemini", {})
-        if not app.get("enabled", False):
+        gemini = self.snapshot_for(flow).compiled.gemini
+        if gemini is None:
             return
 
         try:
-            content_type = flow.response.headers.get("content-type", "")
-            if "text/html" not in content_type:
-                return
-
-            content = flow.response.get_text()
-            flags = app.get("flags", [])
-            flags_string = json.dumps(flags)
-
-            injection = f"""
-<script>
-(function() {{
-    try {{
-        const ext_flags = {flags_string};
-        let originalGetFlag;
-        Object.defineProperty(window, 'getFlag', {{
-            configurable: true,
-            enumerable: true,
-            get: function() {{
-                return function(id, fallback) {{
-                    if (ext_flags.includes(id)) return true;
-                    if (originalGetFlag) return originalGetFlag.call(window, id, fallback);
-                    return fallback;
-                }};
-            }},
-            set: function(newValue) {{
-                originalGetFlag = newValue;
-            }}
-        }});
-    }} catch (e) {{ console.error("AI Tweaker Injection Error:", e); }}
-}})();
-</script>
-"""
             # Inject at the beginning of the head, or body if head is missing
-            if "<head>" in content:
-                flow.response.text = content.replace("<head>", "<head>" + injection, 1)
-            elif "<body>" in content:
-                flow.response.text = content.replace("<body>", "<body>" + injection, 1)
-            else:
-                flow.response.text = injection + content
-
+            flow.response.content = inject(flow.response.content, gemini.html_injection)
             ctx.log.info("Injected Gemini flags into HTML.")
         except Exception as e:
+            self.metrics.error("modify_gemini_html")
             ctx.log.error(f"Error modifying Gemini HTML: {e}")
 
+    @route("copilot.microsoft.com", "/c/api/start", app="copilot")
     def modify_copilot_response(self, flow: http.HTTPFlow) -> None:
-        app = self.rules.get("apps", {}).get("copilot", {})
-        if not app.get("enabled", False):
+        copilot = self.snapshot_for(flow).compiled.copilot
+        if copilot is None:
             return
 
-        allow_beta = app.get("allow_beta", False)
-        flags_to_add = set(app.get("flags", []))
-
         try:
-            content = flow.response.get_text()
-
-            if content.startswith(")]}'"):
-                content = content[4:]
+            patched = patch_start_payload(flow.response.content, copilot.flags, copilot.allow_beta)
+            if patched is not None:
+                flow.response.content = patched
+                ctx.log.info("Modified Copilot features.")
 
-            data = json.loads(content)
-            modified = False
+        except Exception as e:
+            self.metrics.error("modify_copilot_response")
+            ctx.log.error(f"Error modifying Copilot response: {e}")
 
-            if allow_beta:
-                if data.get("allowBeta") != True:
-                    data["allowBeta"] = True
-                    modified = True
+    def rewrite_groups(self, flow, content_type):
+        """Declarative rewrite groups from rules.json that apply to this flow."""
+        groups = self.snapshot_for(flow).compiled.rewrites.get(flow.request.pretty_host)
+        if not groups:
+            return ()
+        path = flow.request.path
+        content_type = content_type.lower()
+        return [g for g in groups if path.startswith(g.path) and g.content_type in content_type]
+
+    def rewrite_scope(self, flow):
+        """Which rewrite groups apply: the same body may get different ones under another path."""
+        content_type = flow.response.headers.get("content-type", "")
+        return tuple((g.path, g.content_type) for g in self.rewrite_groups(flow, content_type)), flow.request.pretty_host
+
+    @cached_rewrite(scope=rewrite_scope)
+    def apply_rewrites(self, flow: http.HTTPFlow) -> None:
+        # Dispatched per host from the compiled rules rather than via @route,
+        # since the set of hosts changes with rules.json.
+        try:
+            content = flow.response.content
+            new_content = content
+            for group in self.rewrite_groups(flow, flow.response.headers.get("content-type", "")):
+                new_content = group.rewriter.apply(new_content)
+            if new_content is not content:
+                flow.response.content = new_content
+                ctx.log.info(f"Applied rewrite rules to {flow.request.pretty_host}{flow.request.path}")
 
-            if "features" in data and isinstance(data["features"], list):
-                original_flags = set(data["features"])
-                combined_flags = list(original_flags.union(flags_to_add))
+        except Exception as e:
+            self.metrics.error("apply_rewrites")
+            ctx.log.error(f"Error applying rewrite rules: {e}")
 
-                if combined_flags != data["features"]:
-                    data["features"] = combined_flags
-                    modified = True
+    @route("labs.google", content_type="application/json", app="google_labs")
+    def modify_json_response(self, flow: http.HTTPFlow) -> None:
+        labs = self.snapshot_for(flow).compiled.google_labs
+        if labs is None:
+            return
 
-            if modified:
-                flow.response.text = json.dumps(data)
-                ctx.log.info("Modified Copilot features.")
+        try:
+            content = flow.response.content
+            # Cheap length check first; real payloads are never this small
+            if len(content) < 64 and content.strip() == NOT_FOUND_TRUE:
+                flow.response.content = NOT_FOUND_FALSE
+                ctx.log.info("Bypassed notFound JSON.")
 
         except Exception as e:
-            ctx.log.error(f"Error modifying Copilot response: {e}")
+            self.metrics.error("modify_json_response")
+            ctx.log.error(f"Error modifying JSON response: {e}")
 
-    def modify_google_labs_script(self, flow: http.HTTPFlow) -> None:
-        app = self.rules.get("apps", {}).get("google_labs", {})
-        if not app.get("enabled", False):
+    @route("labs.google", "/fx/_next/data/", pattern=LABS_DATA_PATTERN, app="google_labs")
+    def bypass_data_not_found(self, flow: http.HTTPFlow) -> None:
+        labs = self.snapshot_for(flow).compiled.google_labs
+        if labs is None or flow.response.status_code != 404:
             return
 
-        mode = app.get("music_fx_replace", "debug")
         try:
-            content = flow.response.get_text()
-
-            if mode == "debug":
-                new_content = content.replace("/fx/music", "/fx/music?debug")
-                if content != new_content:
-                    flow.response.text = new_content
-                    ctx.log.info("Replaced MusicFX link.")
-            else:
-                new_content = content.replace("/fx/music", f"/fx/music?{mode}")
-                flow.response.text = new_content
-                ctx.log.info("Replaced MusicFX link with custom query.")
+            flow.response.status_code = 200
+            flow.response.content = NOT_FOUND_FALSE
+            flow.response.headers["Content-Type"] = "application/json"
+            ctx.log.info(f"Bypassed 404 notFound for {flow.request.url}")
 
         except Exception as e:
-            ctx.log.error(f"Error modifying Google Labs script: {e}")
+            self.metrics.error("bypass_data_not_found")
+            ctx.log.error(f"Error modifying JSON response: {e}")
 
-    def modify_json_response(self, flow: http.HTTPFlow) -> None:
-        app = self.rules.get("apps", {}).get("google_labs", {})
-        if not app.get("enabled", False) or not app.get("bypass_not_found", False):
+    @route("labs.google", "/fx/_next/data/", pattern=LABS_DATA_PATTERN, hook="request", app="google_labs")
+    def upgrade_head_request(self, flow: http.HTTPFlow) -> None:
+        labs = self.snapshot_for(flow).compiled.google_labs
+        if labs is None:
             return
 
         try:
-            content_type = flow.response.headers.get("content-type", "").lower()
-
-            if "application/json" in content_type:
-                text = flow.response.get_text()
+            if flow.request.method == "HEAD":
+                flow.request.method = "GET"
+                ctx.log.info(f"Replaced HEAD with GET request for {flow.request.url}")
+        except Exception as e:
+            self.metrics.error("upgrade_head_request")
+            ctx.log.error(f"Error modifying request: {e}")
+
+    @route("gemini.google.com", SHIM_PREFIX, hook="request", app="gemini")
+    def serve_gemini_shim(self, flow: http.HTTPFlow) -> None:
+        """Answers the flag shim that rewritten Gemini pages load, without asking upstream."""
+        snapshot = self.snapshot_for(flow)
+        gemini = snapshot.compiled.gemini
+        if gemini is None:
+            return
 
-                if text.strip() == "{\"notFound\":true}":
-                    flow.response.text = "{\"notFound\":false}"
-                    ctx.log.info("Bypassed notFound JSON.")
+        path = flow.request.path.split("?", 1)[0]
+        # The client's own shim, else the active profile's or another one's,
+        # e.g. for a page loaded before the client's mapping changed
+        candidates = (snapshot, self.snapshot, *self.snapshot.profiles.values())
+        shim = next((c.compiled.gemini for c in candidates
+                     if c.compiled.gemini is not None and c.compiled.gemini.shim_path == path), None)
+        etag = f'"{path[len(SHIM_PREFIX):-3]}"'
+        if shim is None:
+            # A page from before a rules change: give it the current flags,
+            # but never under a name whose content is meant to be fixed.
+            headers = {"content-type": "text/javascript; charset=utf-8", "cache-control": "no-store"}
+            flow.response = http.Response.make(200, gemini.shim_js, headers)
+        elif etag in split_etags(flow.request.headers.get("if-none-match")):
+            flow.response = http.Response.make(304, b"", {"etag": etag, "cache-control": IMMUTABLE_CACHE_CONTROL})
+        else:
+            flow.response = http.Response.make(200, shim.shim_js, {
+                "content-type": "text/javascript; charset=utf-8",
+                "cache-control": IMMUTABLE_CACHE_CONTROL,
+                "etag": etag,
+            })
+        flow.metadata["tweaker_local"] = True
+
+    def revalidate_request(self, flow: http.HTTPFlow) -> None:
+        """
+        Handles conditional requests for responses we rewrote. A tag from an
+        older rules version can't match anymore, so it is dropped and the
+        full body fetched. A current one is answered with a local 304 while
+        upstream's copy is still fresh, else forwarded without our suffix so
+        upstream can answer 304 itself.
+        """
+        tags = split_etags(flow.request.headers.get("if-none-match"))
+        ours = [parsed for parsed in map(parse_rewritten_etag, tags) if parsed is not None]
+        if not ours:
+            return
 
-            if flow.response.status_code == 404 and self.google_labs_json_pattern.match(flow.request.url):
-                flow.response.status_code = 200
-                flow.response.text = "{\"notFound\":false}"
-                flow.response.headers["Content-Type"] = "application/json"
-                ctx.log.info(f"Bypassed 404 notFound for {flow.request.url}")
+        version = self.snapshot_for(flow).version
+        current = [upstream for upstream, tag_version in ours if tag_version == version]
+        for upstream in current:
+            if self.validators.is_fresh(flow.request.url, upstream):
+                self.validators.local_304s += 1
+                flow.response = http.Response.make(304, b"", {
+                    "etag": rewritten_etag(upstream, version),
+                    "cache-control": REWRITTEN_CACHE_CONTROL,
+                })
+                return
 
-        except Exception as e:
-            ctx.log.error(f"Error modifying JSON response: {e}")
+        flow.metadata["tweaker_if_none_match"] = tags
+        forward = [upstream for upstream in current if not is_synthetic(upstream)]
+        if forward:
+            flow.request.headers["if-none-match"] = ", ".join(forward)
+        else:
+            flow.request.headers.pop("if-none-match", None)
+        flow.request.headers.pop("if-modified-since", None)
+
+    def retag_not_modified(self, flow: http.HTTPFlow) -> None:
+        """Re-issues our tag on an upstream 304 for a revalidation we forwarded."""
+        headers = flow.response.headers
+        upstream = headers.get("etag") or flow.request.headers.get("if-none-match", "").split(",")[0].strip()
+        if not upstream:
+            return
+        self.validators.upstream_304s += 1
+        self.tag_rewritten(flow, upstream, freshness_lifetime(headers))
+
+    def tag_rewritten(self, flow: http.HTTPFlow, upstream_etag, lifetime, version=None) -> None:
+        """
+        Marks a rewritten static asset as depending on the rules version:
+        its ETag becomes the upstream one plus the version, and clients must
+        revalidate before reuse, so changed rules are never masked by a
+        cached copy. Upstream allowed any cache to keep the asset, so
+        "private, no-cache" only narrows its policy.
+        """
+        headers = flow.response.headers
+        headers["cache-control"] = REWRITTEN_CACHE_CONTROL
+        headers.pop("expires", None)
+        headers.pop("last-modified", None)
+        if not upstream_etag:
+            headers.pop("etag", None)
+            return
+        headers["etag"] = rewritten_etag(upstream_etag, version or self.snapshot_for(flow).version)
+        self.validators.remember(flow.request.url, upstream_etag, lifetime)
+
+    def drop_validators(self, flow: http.HTTPFlow) -> None:
+        """
+        For a rewritten response we don't re-tag: upstream's validators
+        describe its own body, so a client must not revalidate with them.
+        Upstream's cache-control is left as it is.
+        """
+        flow.response.headers.pop("etag", None)
+        flow.response.headers.pop("last-modified", None)
+
+    def finish_rewrite(self, flow: http.HTTPFlow, raw, upstream_etag, lifetime, version) -> None:
+        if flow.response.status_code != 200 or not is_static_asset(flow.response.headers):
+            self.drop_validators(flow)
+            return
+        self.tag_rewritten(flow, upstream_etag or synthetic_etag(raw), lifetime, version)
+
+        # Upstream couldn't answer 304 (no ETag, or it changed), but the
+        # rewrite may still be exactly what the client holds.
+        etag = flow.response.headers["etag"]
+        sent = flow.metadata.get("tweaker_if_none_match", ())
+        if any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in sent):
+            self.validators.local_304s += 1
+            flow.response.status_code = 304
+            flow.response.raw_content = b""
+            flow.response.headers.pop("content-length", None)
+
+    def http_connect(self, flow: http.HTTPFlow) -> None:
+        # Runs before mitmproxy decides whether to intercept the tunnel, so
+        # a host added to the rules is intercepted from its next CONNECT on
+        self.load_rules()
 
     def request(self, flow: http.HTTPFlow) -> None:
         self.load_rules()
 
-        app = self.rules.get("apps", {}).get("google_labs", {})
-        if app.get("enabled", False) and app.get("bypass_not_found", False):
-            try:
-                if flow.request.method == "HEAD" and self.google_labs_json_pattern.match(flow.request.url):
-                    flow.request.method = "GET"
-                    ctx.log.info(f"Replaced HEAD with GET request for {flow.request.url}")
-            except Exception as e:
-                ctx.log.error(f"Error modifying request: {e}")
+        self.revalidate_request(flow)
+        if flow.response is not None:
+            return
+
+        for handler in self.router.match("request", flow.request.pretty_host, flow.request.path):
+            self.call_handler(handler, flow)
 
-    def response(self, flow: http.HTTPFlow) -> None:
+    def wants_body(self, flow: http.HTTPFlow) -> bool:
+        """Whether any active handler could rewrite this response."""
+        compiled = self.snapshot_for(flow).compiled
+        content_type = flow.response.headers.get("content-type", "")
+        routes = self.router.match_routes("response", flow.request.pretty_host, flow.request.path, content_type)
+        # An app's payload compiles to None when it is disabled or has nothing to patch
+        if not any(getattr(compiled, r.app) is not None for r in routes) and not self.rewrite_groups(flow, content_type):
+            return False
+
+        try:
+            content_length = int(flow.response.headers.get("content-length", ""))
+        except ValueError:
+            # Chunked or unknown length: buffer, and mitmproxy's stream_large_bodies
+            # (set from tweaker_max_body_mb) switches to streaming past the cap.
+            return True
+        return content_length <= self.max_body_bytes
+
+    def responseheaders(self, flow: http.HTTPFlow) -> None:
         self.load_rules()
 
-        if self.gemini_url_pattern.match(flow.request.url):
-            self.modify_gemini_script(flow)
+        if flow.response.status_code == 304:
+            if "tweaker_if_none_match" in flow.metadata:
+                self.retag_not_modified(flow)
+            return
 
-        if self.gemini_html_pattern.match(flow.request.url):
-            self.modify_gemini_html(flow)
+        content_type = flow.response.headers.get("content-type", "")
+        for handler in self.router.match("responseheaders", flow.request.pretty_host, flow.request.path, content_type):
+            self.call_handler(handler, flow)
+        if flow.response.stream:
+            return
 
-        if self.copilot_url_pattern.match(flow.request.url):
-            self.modify_copilot_response(flow)
+        # Everything we are not going to touch is streamed, so mitmproxy never
+        # buffers videos, images and downloads just to find nothing matches.
+        if not self.wants_body(flow):
+            flow.response.stream = True
+
+    def call_handler(self, handler, flow) -> None:
+        """Runs one handler, recording its latency and the body size before and after."""
+        response = flow.response
+        raw_in = response.raw_content if response is not None else None
+        stream_in = response.stream if response is not None else None
+        started = time.perf_counter()
+        try:
+            handler(flow)
+        except Exception as e:
+            self.metrics.error(handler.__name__)
+            ctx.log.error(f"Error in {handler.__name__}: {e}")
+        elapsed = time.perf_counter() - started
 
-        if self.google_labs_url_pattern.match(flow.request.url) or self.google_labs_json_pattern.match(flow.request.url):
-            self.modify_google_labs_script(flow)
+        if response is None:
+            self.metrics.observe(handler.__name__, elapsed)
+            return
+        raw_out = flow.response.raw_content
+        self.metrics.observe(
+            handler.__name__,
+            elapsed,
+            len(raw_in) if raw_in is not None else 0,
+            len(raw_out) if raw_out is not None else 0,
+            modified=raw_out is not raw_in or flow.response.stream is not stream_in,
+        )
+
+    def run_handlers(self, handlers, flow):
+        for handler in handlers:
+            self.call_handler(handler, flow)
+
+    async def response(self, flow: http.HTTPFlow) -> None:
+        if flow.response.stream or flow.response.status_code == 304 or flow.metadata.get("tweaker_local"):
+            return
+
+        self.load_rules()
+
+        content_type = flow.response.headers.get("content-type", "")
+        handlers = self.router.match("response", flow.request.pretty_host, flow.request.path, content_type)
+        if self.rewrite_groups(flow, content_type):
+            handlers.append(self.apply_rewrites)
+        if not handlers:
+            return
+
+        snapshot = self.snapshot_for(flow)
+        raw = flow.response.raw_content
+        upstream_etag = flow.response.headers.get("etag")
+        lifetime = freshness_lifetime(flow.response.headers)
+        if raw is None or len(raw) < OFFLOAD_MIN_BYTES:
+            self.run_handlers(handlers, flow)
+        else:
+            # Big bodies are decoded, rewritten and re-encoded on the pool so the
+            # event loop keeps serving every other connection meanwhile.
+            detached = DetachedFlow(flow, snapshot)
+            ok, _ = await self.pool.run(self.run_handlers, handlers, detached)
+            if not ok:
+                for handler in handlers:
+                    self.metrics.error(handler.__name__)
+                ctx.log.warn(f"Rewrite of {flow.request.url} timed out or failed, passing it through unmodified.")
+                return
+            flow.response = detached.response
 
-        self.modify_json_response(flow)
+        new_raw = flow.response.raw_content
+        if raw is not None and new_raw is not raw and new_raw != raw:
+            self.finish_rewrite(flow, raw, upstream_etag, lifetime, snapshot.version)
 
 addons = [
     AITweaker()
@@ -1,11 +1,23 @@
+import asyncio
+import copy
+import hashlib
 import json
 import os
 import shutil
+import threading
 import collections.abc
 
+from routing import APP_HOSTS
+from rewrites import normalize_rewrites
+from rules_compiler import builtin_rewrites, normalize_flags
+from rules_store import encode_rules
+
 PROFILES_FILE = "profiles.json"
 RULES_FILE = "rules.json"
 
+# Updates arriving within this many seconds share one write
+SAVE_DEBOUNCE = 0.1
+
 DEFAULT_PROFILE = {
     "active_profile": "default",
     "profiles": {
@@ -60,8 +72,23 @@ def deep_update(source, overrides):
             source[key] = overrides[key]
     return source
 
+def write_atomic(filename, raw):
+    """Writes via a temp file and rename, so readers never see a half-written file."""
+    tmp = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(raw)
+    os.replace(tmp, filename)
+
 class ConfigManager:
     def __init__(self):
+        # Called with the new rules dict whenever rules.json changes
+        self.rules_listeners = []
+        # filename -> (content hash, mtime_ns, size) of what we last wrote
+        self._written = {}
+        self._write_lock = threading.Lock()
+        self._save_seq = 0
+        self._written_seq = 0
+        self._save_task = None
         self.load_profiles()
 
     def load_profiles(self):
@@ -93,8 +120,71 @@ class ConfigManager:
                 self.profiles_data = DEFAULT_PROFILE
 
     def save_data(self, filename, data):
-        with open(filename, "w") as f:
-            json.dump(data, f, indent=4)
+        self.write_file(filename, json.dumps(data, indent=4).encode())
+
+    def write_file(self, filename, raw, seq=None):
+        """
+        Writes ``raw`` atomically unless the file already holds exactly what we
+        last wrote. ``seq`` orders writes prepared on the loop and performed on
+        threads: an older one never overwrites a newer one. Returns True if
+        the file was written.
+        """
+        digest = hashlib.sha1(raw).hexdigest()
+        with self._write_lock:
+            if seq is not None:
+                if seq < self._written_seq:
+                    return False
+                self._written_seq = seq
+            try:
+                st = os.stat(filename)
+                on_disk = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                on_disk = None
+            last = self._written.get(filename)
+            if last is not None and on_disk is not None and last == (digest, *on_disk):
+                return False
+
+            write_atomic(filename, raw)
+            st = os.stat(filename)
+            self._written[filename] = (digest, st.st_mtime_ns, st.st_size)
+            return True
+
+    def save(self):
+        """Writes profiles.json and rules.json now."""
+        self.save_data(PROFILES_FILE, self.profiles_data)
+        self.generate_rules_json()
+
+    async def save_soon(self):
+        """
+        Persists pending changes off the event loop after SAVE_DEBOUNCE.
+        Every caller within the window waits for the same write, so a burst
+        of toggles costs one write of each file (or none, if the content is
+        unchanged) and callers still return only once it is on disk.
+        """
+        loop = asyncio.get_running_loop()
+        task = self._save_task
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = self._save_task = loop.create_task(self._debounced_save())
+        await asyncio.shield(task)
+
+    async def _debounced_save(self):
+        await asyncio.sleep(SAVE_DEBOUNCE)
+        # Updates from here on schedule a save of their own
+        self._save_task = None
+        self._save_seq += 1
+        seq = self._save_seq
+
+        # Serialized here, as the profile may change while the thread writes
+        profiles_raw = json.dumps(self.profiles_data, indent=4).encode()
+        rules = self.build_rules()
+        rules_raw = encode_rules(rules)
+
+        def write():
+            self.write_file(PROFILES_FILE, profiles_raw, seq)
+            return self.write_file(RULES_FILE, rules_raw, seq)
+
+        if await asyncio.to_thread(write):
+            self.notify_rules(rules)
 
     def get_active_profile(self):
         active_name = self.profiles_data.get("active_profile", "default")
@@ -103,22 +193,114 @@ class ConfigManager:
     def get_full_config(self):
         return self.profiles_data
 
-    def update_active_profile(self, updates):
+    def update_active_profile(self, updates, save=True):
+        """Applies one update. With save=False the caller persists it (see save_soon)."""
+        return self.update_active_profile_batch([updates], save)
+
+    def update_active_profile_batch(self, updates_list, save=True):
+        """
+        Applies several updates in order as one transaction: either all of
+        them land or, if one fails, none does.
+        """
+        active_name = self.profiles_data.get("active_profile", "default")
+        if active_name not in self.profiles_data["profiles"]:
+            return None
+        if not all(isinstance(updates, collections.abc.Mapping) for updates in updates_list):
+            return None
+
+        candidate = copy.deepcopy(self.profiles_data["profiles"][active_name])
+        try:
+            for updates in updates_list:
+                deep_update(candidate, updates)
+        except (AttributeError, TypeError):
+            return None
+        self.profiles_data["profiles"][active_name] = candidate
+
+        if save:
+            self.save()
+        return candidate
+
+    def get_client_profiles(self):
+        """Client address or proxy-auth username -> profile name."""
+        return self.profiles_data.get("client_profiles", {})
+
+    def set_client_profile(self, client, profile_name, save=True):
+        """Maps a client to a profile (None removes the mapping). Returns False for unknown profiles."""
+        if profile_name is not None and profile_name not in self.profiles_data["profiles"]:
+            return False
+        clients = self.profiles_data.setdefault("client_profiles", {})
+        if profile_name is None:
+            clients.pop(client, None)
+        else:
+            clients[client] = profile_name
+        if save:
+            self.save()
+        return True
+
+    def client_profile_names(self):
+        """Profiles some client is mapped to, other than the active one."""
         active_name = self.profiles_data.get("active_profile", "default")
-        if active_name in self.profiles_data["profiles"]:
-            current = self.profiles_data["profiles"][active_name]
+        profiles = self.profiles_data["profiles"]
+        return sorted({name for name in self.get_client_profiles().values() if name in profiles and name != active_name})
+
+    def get_intercept_hosts(self):
+        """Hosts of the enabled apps in any profile in use; everything else is tunnelled."""
+        hosts = set(self.profile_intercept_hosts(self.get_active_profile()))
+        for name in self.client_profile_names():
+            hosts.update(self.profile_intercept_hosts(self.profiles_data["profiles"][name]))
+        return sorted(hosts)
 
-            # Perform deep update
-            deep_update(current, updates)
+    def profile_intercept_hosts(self, profile):
+        return self.build_profile_rules(profile)["intercept_hosts"]
 
-            self.save_data(PROFILES_FILE, self.profiles_data)
-            self.generate_rules_json()
-            return current
-        return None
+    @staticmethod
+    def rules_intercept_hosts(apps, rewrites):
+        """
+        Hosts the rules can touch. Reads the built apps, where a missing
+        "enabled" means off exactly as in the addon, so no host is
+        intercepted for an app that rewrites nothing.
+        """
+        hosts = set()
+        for name, app in apps.items():
+            if app.get("enabled", False):
+                hosts.update(APP_HOSTS.get(name, ()))
+        for group in rewrites:
+            hosts.add(group["host"])
+        return sorted(hosts)
+
+    def add_rules_listener(self, listener):
+        self.rules_listeners.append(listener)
 
     def generate_rules_json(self):
         """Generates the rules.json file used by the mitmproxy addon script."""
-        profile = self.get_active_profile()
+        rules = self.build_rules()
+        if self.write_file(RULES_FILE, encode_rules(rules)):
+            self.notify_rules(rules)
+        return rules
+
+    def notify_rules(self, rules):
+        for listener in self.rules_listeners:
+            listener(rules)
+
+    def build_rules(self):
+        """
+        The rules for the active profile, in the rules.json format. Profiles
+        that clients are mapped to are included under "profiles", with the
+        mapping under "clients", so the addon can precompile each one.
+        """
+        rules = self.build_profile_rules(self.get_active_profile())
+        names = self.client_profile_names()
+        if names:
+            rules["profiles"] = {name: self.build_profile_rules(self.profiles_data["profiles"][name]) for name in names}
+            rules["clients"] = {
+                client: name for client, name in sorted(self.get_client_profiles().items())
+                if name in rules["profiles"]
+            }
+        rules["intercept_hosts"] = self.get_intercept_hosts()
+        return rules
+
+    def build_profile_rules(self, profile):
+        """The compiled-ready rules for one profile."""
         apps_for_backend = {}
 
         if "apps" in profile:
@@ -127,20 +309,14 @@ class ConfigManager:
                 gemini_config = profile["apps"]["gemini"]
                 enabled_flags_configs = {k: v for k, v in gemini_config.get("flag_configs", {}).items() if v.get("enabled", True)}
 
-                enabled_flags = []
-                for id in enabled_flags_configs.keys():
-                    # Keep ranges as strings, numbers as ints if possible, but backend handles mixed
-                    if '-' in id:
-                        enabled_flags.append(id)
-                    else:
-                        try:
-                            enabled_flags.append(int(id))
-                        except ValueError:
-                            enabled_flags.append(id)
+                # Ranges ("a-b") are merged and validated here so the injected
+                # shim can binary-search them instead of scanning a list
+                flags, ranges = normalize_flags(enabled_flags_configs.keys())
 
                 apps_for_backend["gemini"] = {
                     "enabled": gemini_config.get("enabled", True),
-                    "flags": enabled_flags
+                    "flags": flags,
+                    "flag_ranges": ranges
                 }
 
             # Copilot
@@ -157,4 +333,12 @@ class ConfigManager:
             if "google_labs" in profile["apps"]:
                 apps_for_backend["google_labs"] = profile["apps"]["google_labs"]
 
-        self.save_data(RULES_FILE, {"apps": apps_for_backend})
+        # Declarative find/replace rules, validated and grouped per host/path so
+        # the addon builds one single-pass matcher per group
+        rewrites = normalize_rewrites(builtin_rewrites(apps_for_backend) + list(profile.get("rewrites", [])))
+
+        return {
+            "apps": apps_for_backend,
+            "rewrites": rewrites,
+            "intercept_hosts": self.rules_intercept_hosts(apps_for_backend, rewrites)
+        }
@@ -0,0 +1,66 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional fast backend
+    orjson = None
+
+XSSI_PREFIX = b")]}'"
+# What may follow the prefix before the JSON: ")]}'\n", ")]}',\n" and the like
+_PREFIX_TAIL = b", \t\r\n"
+
+
+def loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def split_prefix(body):
+    """Splits off the XSSI prefix exactly as upstream sent it, line break and all."""
+    if not body.startswith(XSSI_PREFIX):
+        return b"", body
+    end = len(XSSI_PREFIX)
+    while end < len(body) and body[end] in _PREFIX_TAIL:
+        end += 1
+    return body[:end], body[end:]
+
+
+def patch_start_payload(body, flags, allow_beta):
+    """
+    Patches a Copilot /c/api/start body. Returns the new body, or None if
+    nothing needs to change, in which case the caller leaves the response
+    untouched (no re-serialization).
+
+    Missing flags are appended after the existing features, so the original
+    order is kept, and the XSSI prefix is put back byte for byte if upstream
+    sent one.
+    """
+    if not flags and not allow_beta:
+        return None
+
+    prefix, payload = split_prefix(body)
+    data = loads(payload)
+    if not isinstance(data, dict):
+        return None
+
+    changed = False
+    if allow_beta and data.get("allowBeta") is not True:
+        data["allowBeta"] = True
+        changed = True
+
+    features = data.get("features")
+    if flags and isinstance(features, list):
+        present = {f for f in features if isinstance(f, str)}
+        missing = [f for f in flags if f not in present]
+        if missing:
+            features.extend(missing)
+            changed = True
+
+    if not changed:
+        return None
+    return prefix + dumps(data)
@@ -0,0 +1,55 @@
+import json
+
+from log_bus import Subscription
+
+DEFAULT_EVENT_BUFFER = 256
+
+
+def encode_event(event_type, data):
+    return json.dumps({"type": event_type, "data": data})
+
+
+class EventHub:
+    """
+    Fan-out of typed JSON events ("status", "config", "metrics", ...) to the
+    /ws/events clients. Each client has a bounded backlog like a LogBus
+    subscriber; events carry full state or deltas, so a client that had to
+    drop some catches up with the next status event.
+    """
+
+    def __init__(self, buffer=DEFAULT_EVENT_BUFFER):
+        self.buffer = buffer
+        self.subscribers = set()
+
+    def publish(self, event_type, data):
+        """Publishes an event. Must be called on the event loop."""
+        if not self.subscribers:
+            return
+        event = encode_event(event_type, data)
+        for subscription in self.subscribers:
+            subscription.put(event)
+
+    def subscribe(self):
+        subscription = Subscription(self.buffer)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+
+
+def metrics_delta(previous, current):
+    """Per-handler counter increases between two metrics snapshots; only handlers that changed."""
+    delta = {}
+    before = (previous or {}).get("handlers", {})
+    for handler, stats in (current or {}).get("handlers", {}).items():
+        old = before.get(handler, {})
+        changed = {}
+        for key, value in stats.items():
+            if not isinstance(value, (int, float)) or value == old.get(key, 0):
+                continue
+            # Counters going down means the proxy restarted: all of it is new
+            changed[key] = value - old.get(key, 0) if value >= old.get(key, 0) else value
+        if changed:
+            delta[handler] = changed
+    return delta
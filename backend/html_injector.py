@@ -0,0 +1,101 @@
+import re
+import zlib
+
+try:
+    import brotli
+except ImportError:  # optional, mitmproxy normally pulls it in
+    brotli = None
+
+# First <head ...> or <body ...> tag; "<header" must not match.
+INJECTION_POINT = re.compile(rb"<(?:head|body)(?=[\s>/])[^>]*>", re.I)
+
+# A "<" without its ">" is held back for at most this many bytes while waiting
+# for the next chunk; longer tags are not worth waiting for.
+MAX_PENDING_TAG = 4096
+
+
+class _ZlibDecoder:
+    def __init__(self):
+        # 32 + MAX_WBITS accepts both gzip and zlib headers
+        self._d = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    def decode(self, data):
+        return self._d.decompress(data) if data else self._d.flush()
+
+
+class _BrotliDecoder:
+    def __init__(self):
+        self._d = brotli.Decompressor()
+
+    def decode(self, data):
+        return self._d.process(data) if data else b""
+
+
+DECODERS = {"": None, "identity": None, "gzip": _ZlibDecoder, "deflate": _ZlibDecoder}
+if brotli is not None:
+    DECODERS["br"] = _BrotliDecoder
+
+
+def can_stream(content_encoding):
+    return content_encoding.strip().lower() in DECODERS
+
+
+def inject(content, injection):
+    """Buffered variant: splices ``injection`` after the first head/body tag."""
+    m = INJECTION_POINT.search(content)
+    if m is None:
+        return injection + content
+    return b"".join((content[:m.end()], injection, content[m.end():]))
+
+
+class HtmlInjector:
+    """
+    A ``flow.response.stream`` callable that injects a snippet right after the
+    first ``<head ...>`` or ``<body ...>`` tag and passes everything else
+    through as it arrives.
+
+    A tag split across chunks is held back only until its closing ``>`` shows
+    up, so the document is never buffered. Compressed bodies are decoded on
+    the fly and sent on as identity; the caller must drop Content-Encoding and
+    Content-Length. If the document ends without either tag, the snippet is
+    appended at the end.
+    """
+
+    def __init__(self, injection, content_encoding=""):
+        factory = DECODERS[content_encoding.strip().lower()]
+        self.injection = injection
+        self.decoder = factory() if factory else None
+        self.pending = b""
+        self.injected = False
+
+    def __call__(self, data):
+        # mitmproxy frames an empty chunk as end-of-body on chunked HTTP/1
+        # connections, so "nothing to send yet" must be an empty list.
+        out = self.feed(data)
+        return [out] if out else []
+
+    def feed(self, data):
+        final = data == b""
+        if self.decoder is not None:
+            data = self.decoder.decode(data)
+        if self.injected:
+            return data
+
+        buf = self.pending + data if self.pending else data
+        m = INJECTION_POINT.search(buf)
+        if m is not None:
+            self.injected = True
+            self.pending = b""
+            return b"".join((buf[:m.end()], self.injection, buf[m.end():]))
+
+        if final:
+            self.injected = True
+            self.pending = b""
+            return buf + self.injection
+
+        cut = buf.rfind(b"<")
+        if cut != -1 and buf.find(b">", cut) == -1 and len(buf) - cut <= MAX_PENDING_TAG:
+            self.pending = buf[cut:]
+            return buf[:cut]
+        self.pending = b""
+        return buf
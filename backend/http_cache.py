@@ -0,0 +1,109 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+
+# Rewritten responses must be revalidated on every use: the body depends on
+# the rules as well as the upstream asset. Revalidation is cheap because the
+# proxy answers it itself while both are unchanged.
+REWRITTEN_CACHE_CONTROL = "private, no-cache"
+# For responses the proxy makes up at content-addressed URLs (the Gemini shim)
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+STATIC_TYPES = ("javascript", "text/css")
+
+# Marks validators the proxy made up; no upstream ETag looks like this
+SYNTHETIC_PREFIX = '"aitweaker-'
+
+_TAG = re.compile(r'^(W/)?"(.*)-tw([0-9a-z]+)"$')
+_MAX_AGE = re.compile(r"(?:^|,)\s*max-age\s*=\s*\"?(\d+)", re.I)
+
+
+def rewritten_etag(upstream_etag, version):
+    """Folds the rules version into an upstream ETag: "abc" -> "abc-tw<version>"."""
+    weak = upstream_etag.startswith("W/")
+    opaque = upstream_etag[2:] if weak else upstream_etag
+    opaque = opaque.strip('"')
+    return f'{"W/" if weak else ""}"{opaque}-tw{version}"'
+
+
+def synthetic_etag(raw_content):
+    """Stand-in upstream validator for assets served without an ETag."""
+    return SYNTHETIC_PREFIX + hashlib.blake2b(raw_content, digest_size=12).hexdigest() + '"'
+
+
+def parse_rewritten_etag(tag):
+    """Returns (upstream_etag, version) for a tag we issued, else None."""
+    m = _TAG.match(tag.strip())
+    if m is None:
+        return None
+    weak, opaque, version = m.groups()
+    return f'{weak or ""}"{opaque}"', version
+
+
+def split_etags(header):
+    """Splits an If-None-Match header into its entity tags."""
+    return [t.strip() for t in re.findall(r'(?:W/)?"[^"]*"', header or "")]
+
+
+def is_synthetic(upstream_etag):
+    """Whether upstream never saw this validator, so it can't be forwarded."""
+    return upstream_etag.startswith(SYNTHETIC_PREFIX)
+
+
+def is_static_asset(headers):
+    """
+    Whether a response is a script or stylesheet that upstream lets any
+    cache keep. Only these get versioned validators: API payloads and pages
+    are often personal, and their caching policy is upstream's to set.
+    """
+    cache_control = headers.get("cache-control", "").lower()
+    if "no-store" in cache_control or "private" in cache_control:
+        return False
+    content_type = headers.get("content-type", "").lower()
+    return any(t in content_type for t in STATIC_TYPES)
+
+
+def freshness_lifetime(headers):
+    """Seconds upstream allows the response to be reused without revalidation."""
+    cache_control = headers.get("cache-control", "")
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return 0
+    m = _MAX_AGE.search(cache_control)
+    if m is None:
+        return 0
+    try:
+        age = int(headers.get("age", "0"))
+    except ValueError:
+        age = 0
+    return max(0, int(m.group(1)) - age)
+
+
+class ValidatorStore:
+    """
+    Remembers, per URL, the upstream validator behind the last rewrite we
+    served and until when upstream said it stays fresh. A conditional request
+    for a fresh, unchanged asset under the current rules gets a local 304.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.local_304s = 0
+        self.upstream_304s = 0
+
+    def remember(self, url, upstream_etag, lifetime):
+        self.entries[url] = (upstream_etag, time.monotonic() + lifetime)
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def is_fresh(self, url, upstream_etag):
+        entry = self.entries.get(url)
+        return entry is not None and entry[0] == upstream_etag and time.monotonic() < entry[1]
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "local_304s": self.local_304s,
+            "upstream_304s": self.upstream_304s,
+        }
@@ -0,0 +1,108 @@
+import datetime
+import logging
+import os
+import re
+import threading
+
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+
+logger = logging.getLogger(__name__)
+
+# mitmproxy's default confdir, where its CA lives (mitmproxy-ca.pem)
+CONFDIR = "~/.mitmproxy"
+CERTS_DIR = "aitweaker-certs"
+# mitmproxy issues leaf certs for a year; replace ours well before they lapse
+RENEW_BEFORE = datetime.timedelta(days=30)
+
+_HOSTNAME = re.compile(r"^[a-z0-9]([a-z0-9-]*[a-z0-9])?(\.[a-z0-9]([a-z0-9-]*[a-z0-9])?)*$")
+
+
+def _key_bytes(cert):
+    return cert.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+class LeafCertCache:
+    """
+    Leaf certificates for the intercepted hosts, signed by mitmproxy's CA
+    and kept on disk, so every mitmdump start loads them with --certs
+    instead of generating one per host on the first handshake.
+
+    mitmproxy's leaf certs carry the CA's own public key, so the files hold
+    only the certificate (mitmdump pairs it with the CA key), and a file
+    whose key is not the current CA's was issued by an old CA and is
+    replaced, as is one close to expiry.
+    """
+
+    def __init__(self, confdir=CONFDIR, key_size=2048):
+        self.confdir = os.path.expanduser(confdir)
+        self.directory = os.path.join(self.confdir, CERTS_DIR)
+        self.key_size = key_size
+        self._store = None
+        self._ca_mtime = None
+        self._lock = threading.Lock()
+
+    def _certstore(self):
+        # Imported here so the backend only loads mitmproxy when certs are needed
+        from mitmproxy.certs import CertStore
+
+        ca_file = os.path.join(self.confdir, "mitmproxy-ca.pem")
+        mtime = os.stat(ca_file).st_mtime_ns if os.path.exists(ca_file) else None
+        if self._store is None or mtime != self._ca_mtime:
+            # Creates the CA the way mitmdump would on its first start
+            self._store = CertStore.from_store(self.confdir, "mitmproxy", self.key_size)
+            self._ca_mtime = os.stat(ca_file).st_mtime_ns
+        return self._store
+
+    def ensure(self, hosts):
+        """
+        Returns {host: cert file} for every valid hostname in ``hosts``,
+        generating only the certs that are missing, stale or near expiry.
+        Blocking; run it off the event loop.
+        """
+        hosts = sorted({h.lower() for h in hosts if _HOSTNAME.match(h.lower())})
+        if not hosts:
+            return {}
+
+        from mitmproxy.certs import dummy_cert
+
+        with self._lock:
+            store = self._certstore()
+            ca_key = _key_bytes(store.default_ca._cert)
+            os.makedirs(self.directory, exist_ok=True)
+
+            files = {}
+            generated = []
+            for host in hosts:
+                path = os.path.join(self.directory, f"{host}.pem")
+                if not self.is_current(path, host, ca_key):
+                    cert = dummy_cert(store.default_privatekey, store.default_ca._cert, host, [x509.DNSName(host)])
+                    tmp = f"{path}.{os.getpid()}.tmp"
+                    with open(tmp, "wb") as f:
+                        f.write(cert.to_pem())
+                    os.replace(tmp, path)
+                    generated.append(host)
+                files[host] = path
+
+        if generated:
+            logger.info(f"Generated certificates for {', '.join(generated)}")
+        return files
+
+    @staticmethod
+    def is_current(path, host, ca_key):
+        try:
+            with open(path, "rb") as f:
+                cert = x509.load_pem_x509_certificate(f.read())
+        except (OSError, ValueError):
+            return False
+
+        if _key_bytes(cert) != ca_key:
+            return False
+        # cryptography < 42 has no *_utc accessors; this one is naive UTC
+        if cert.not_valid_after - datetime.datetime.utcnow() < RENEW_BEFORE:
+            return False
+        try:
+            names = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+        except x509.ExtensionNotFound:
+            return False
+        return host in names.get_values_for_type(x509.DNSName)
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+from collections import deque
+
+DEFAULT_HISTORY = 500
+DEFAULT_SUBSCRIBER_BUFFER = 1000
+
+
+class Subscription:
+    """One consumer's view of the bus: a bounded backlog that drops its oldest lines when full."""
+
+    def __init__(self, max_lines):
+        self.buffer = deque()
+        self.max_lines = max_lines
+        self.dropped = 0
+        self._ready = asyncio.Event()
+
+    def put(self, line):
+        if len(self.buffer) >= self.max_lines:
+            self.buffer.popleft()
+            self.dropped += 1
+        self.buffer.append(line)
+        self._ready.set()
+
+    async def get_batch(self):
+        """Waits for at least one line, then returns everything queued."""
+        while not self.buffer:
+            self._ready.clear()
+            await self._ready.wait()
+        batch = list(self.buffer)
+        self.buffer.clear()
+        return batch
+
+
+class LogBus:
+    """
+    Fan-out of proxy log lines to any number of subscribers.
+
+    The bus keeps the last ``history`` lines in a ring buffer, which new
+    subscribers get first, and each subscriber has its own bounded backlog,
+    so memory stays flat whether nobody or a stalled client is listening.
+
+    Reader threads call publish_threadsafe. Lines collect in a pending deque
+    and are handed to the loop with one call_soon_threadsafe per burst rather
+    than a coroutine per line.
+    """
+
+    def __init__(self, history=DEFAULT_HISTORY, subscriber_buffer=DEFAULT_SUBSCRIBER_BUFFER):
+        self.history = deque(maxlen=history)
+        self.subscriber_buffer = subscriber_buffer
+        self.subscribers = set()
+        self.dropped = 0
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._flush_scheduled = False
+
+    def publish(self, line):
+        """Publishes a line. Must be called on the event loop."""
+        self.history.append(line)
+        for subscription in self.subscribers:
+            subscription.put(line)
+
+    def publish_threadsafe(self, line, loop):
+        with self._lock:
+            if len(self._pending) >= self.history.maxlen:
+                # The loop is not keeping up: only the newest lines matter
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append(line)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        try:
+            loop.call_soon_threadsafe(self._flush)
+        except RuntimeError:
+            # Loop closed during shutdown
+            pass
+
+    def _flush(self):
+        with self._lock:
+            lines = list(self._pending)
+            self._pending.clear()
+            self._flush_scheduled = False
+        for line in lines:
+            self.publish(line)
+
+    def subscribe(self, replay=True):
+        subscription = Subscription(self.subscriber_buffer)
+        if replay:
+            for line in self.history:
+                subscription.put(line)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
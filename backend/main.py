@@ -1,16 +1,23 @@
 import os
-import socket
-from fastapi import FastAPI, WebSocket, HTTPException
+from fastapi import FastAPI, WebSocket, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 import uvicorn
 import asyncio
+from contextlib import aclosing
 
 from config_manager import ConfigManager
-from proxy_manager import ProxyManager
+from proxy_manager import ProxyManager, PROXY_MODES
+from metrics import METRICS_FILE, render_prometheus
+from network import NetworkInfo
+from events import EventHub, encode_event, metrics_delta
+from static_files import FrontendManifest
+from rules_store import encode_rules, rules_version
+
+# How often proxy state and metrics are checked for changes to push on /ws/events
+EVENTS_INTERVAL = 1.0
 
 app = FastAPI()
 
@@ -25,13 +32,27 @@ app.add_middleware(
 
 config_manager = ConfigManager()
 proxy_manager = ProxyManager()
+# An in-process proxy gets profile changes pushed instead of watching rules.json
+config_manager.add_rules_listener(proxy_manager.update_rules)
+events = EventHub()
+network = NetworkInfo(on_change=lambda ip: events.publish("status", current_status()))
+config_manager.add_rules_listener(lambda rules: events.publish("config", {"rules_version": rules_version(encode_rules(rules))}))
 
 class ProfileUpdate(BaseModel):
     updates: Dict[str, Any]
 
+class ProfileBatchUpdate(BaseModel):
+    updates: List[Dict[str, Any]]
+
+class ClientProfile(BaseModel):
+    client: str # client IP address or proxy-auth username
+    profile: Optional[str] = None # None removes the mapping
+
 class ProxyControl(BaseModel):
-    action: str # "start" or "stop"
+    action: str # "start", "stop" or "restart"
     port: Optional[int] = 8080
+    mode: Optional[str] = None # "subprocess" (default) or "inprocess"
+    workers: Optional[int] = None # mitmdump processes in subprocess mode
 
 @app.on_event("startup")
 async def startup_event():
@@ -42,34 +63,98 @@ async def startup_event():
     profile = config_manager.get_active_profile()
     # Optional: auto-start
 
-@app.get("/status")
-async def get_status():
-    hostname = socket.gethostname()
-    local_ip = socket.gethostbyname(hostname)
-    try:
-        # Try to find the actual outbound IP
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
-    except Exception:
-        pass
+    # Mint leaf certs for the intercepted hosts now, not on the first
+    # handshake after each proxy start
+    await proxy_manager.prepare_certs(config_manager.get_intercept_hosts())
+
+    network.start()
+    app.state.events_task = asyncio.create_task(publish_events())
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    network.stop()
+    # Don't lose an update still inside the save debounce window
+    config_manager.save()
+
+def metrics_path():
+    # Written by the addon inside the mitmdump process, which runs in backend/
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), METRICS_FILE)
+
+def current_status():
     return {
         "running": proxy_manager.is_running,
         "port": proxy_manager.port,
-        "ip": local_ip
+        "mode": proxy_manager.mode,
+        "workers": proxy_manager.worker_states(),
+        "ip": network.local_ip or "Loading..."
     }
 
+async def publish_events():
+    """Pushes status changes and metrics deltas to /ws/events clients."""
+    last_status = None
+    last_metrics = None
+    while True:
+        await asyncio.sleep(EVENTS_INTERVAL)
+        if not events.subscribers:
+            continue
+        status = current_status()
+        # Uptimes tick every second; only real state changes are pushed
+        comparable = {**status, "workers": [{**w, "uptime": 0} for w in status["workers"]]}
+        if comparable != last_status:
+            last_status = comparable
+            events.publish("status", status)
+        snapshot = proxy_manager.metrics_snapshot(metrics_path())
+        delta = metrics_delta(last_metrics, snapshot)
+        last_metrics = snapshot
+        if delta:
+            events.publish("metrics", delta)
+
+@app.get("/status")
+async def get_status():
+    return current_status()
+
 @app.post("/control")
 async def control_proxy(control: ProxyControl):
     if control.action == "start":
-        await proxy_manager.start_proxy(control.port)
+        if control.mode is not None:
+            if control.mode not in PROXY_MODES:
+                raise HTTPException(status_code=400, detail="Invalid mode")
+            if not proxy_manager.is_running:
+                proxy_manager.mode = control.mode
+        if control.workers is not None:
+            if control.workers < 1:
+                raise HTTPException(status_code=400, detail="Invalid worker count")
+            if not proxy_manager.is_running:
+                proxy_manager.workers = control.workers
+        await proxy_manager.start_proxy(
+            control.port,
+            allow_hosts=config_manager.get_intercept_hosts(),
+            rules=config_manager.build_rules(),
+        )
+    elif control.action == "restart":
+        await proxy_manager.restart_proxy(
+            allow_hosts=config_manager.get_intercept_hosts(),
+            rules=config_manager.build_rules(),
+        )
     elif control.action == "stop":
         await proxy_manager.stop_proxy()
     else:
          raise HTTPException(status_code=400, detail="Invalid action")
-    return {"status": "ok", "running": proxy_manager.is_running}
+    events.publish("status", current_status())
+    return {
+        "status": "ok",
+        "running": proxy_manager.is_running,
+        "mode": proxy_manager.mode,
+        "workers": proxy_manager.worker_states(),
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    snapshot = proxy_manager.metrics_snapshot(metrics_path())
+    return PlainTextResponse(
+        render_prometheus(snapshot, proxy_manager.is_running),
+        media_type="text/plain; version=0.0.4",
+    )
 
 @app.get("/config")
 async def get_config():
@@ -80,11 +165,34 @@ async def update_config(data: ProfileUpdate):
     if not data.updates:
         raise HTTPException(status_code=400, detail="No updates provided")
 
-    updated_profile = config_manager.update_active_profile(data.updates)
+    updated_profile = config_manager.update_active_profile(data.updates, save=False)
+    if not updated_profile:
+        raise HTTPException(status_code=404, detail="Active profile not found or update failed")
+    await config_manager.save_soon()
+    return updated_profile
+
+@app.post("/config/batch")
+async def update_config_batch(data: ProfileBatchUpdate):
+    if not data.updates:
+        raise HTTPException(status_code=400, detail="No updates provided")
+
+    updated_profile = config_manager.update_active_profile_batch(data.updates, save=False)
     if not updated_profile:
         raise HTTPException(status_code=404, detail="Active profile not found or update failed")
+    await config_manager.save_soon()
     return updated_profile
 
+@app.get("/clients")
+async def get_clients():
+    return config_manager.get_client_profiles()
+
+@app.post("/clients")
+async def set_client_profile(data: ClientProfile):
+    if not config_manager.set_client_profile(data.client, data.profile, save=False):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    await config_manager.save_soon()
+    return config_manager.get_client_profiles()
+
 @app.get("/cert")
 async def get_cert():
     # The mitmproxy cert is usually in ~/.mitmproxy/mitmproxy-ca-cert.pem
@@ -99,11 +207,28 @@ async def get_cert():
 @app.websocket("/ws/logs")
 async def websocket_logs(websocket: WebSocket):
     await websocket.accept()
+    # aclosing() unsubscribes as soon as the client goes away
+    try:
+        async with aclosing(proxy_manager.get_logs()) as logs:
+            async for frame in logs:
+                await websocket.send_text(frame)
+    except Exception:
+        pass
+
+@app.websocket("/ws/events")
+async def websocket_events(websocket: WebSocket):
+    await websocket.accept()
+    subscription = events.subscribe()
     try:
-        async for log in proxy_manager.get_logs():
-            await websocket.send_text(log)
+        # Current state first, then changes as they happen
+        await websocket.send_text(encode_event("status", current_status()))
+        while True:
+            for event in await subscription.get_batch():
+                await websocket.send_text(event)
     except Exception:
         pass
+    finally:
+        events.unsubscribe(subscription)
 
 # Mount frontend if available (for production/docker/local)
 possible_paths = [
@@ -117,24 +242,23 @@ for path in possible_paths:
         frontend_path = path
         break
 
+# First path segments of the backend's own routes: unknown paths under them
+# are 404s rather than the SPA's index.html
+BACKEND_PREFIXES = frozenset({"api", "ws", "status", "control", "config", "cert", "metrics", "clients", "assets"})
+
 if frontend_path:
-    # Serve static assets first
-    app.mount("/assets", StaticFiles(directory=os.path.join(frontend_path, "assets")), name="assets")
+    # Indexed (and compressed) once; requests never touch the disk
+    frontend = FrontendManifest.build(frontend_path)
 
     # Serve index.html for any path that isn't an API route to support React Router
     @app.get("/{full_path:path}")
-    async def serve_frontend(full_path: str):
-        if full_path.startswith("api") or full_path.startswith("ws") or full_path == "status" or full_path == "control" or full_path == "config" or full_path == "cert" or full_path.startswith("assets"):
-             # Let FastAPI handle 404 for API routes or static assets not found
-             raise HTTPException(status_code=404, detail="Not Found")
-
-        # Check if file exists in dist (e.g. favicon.ico, etc, but not assets as they are mounted)
-        file_path = os.path.join(frontend_path, full_path)
-        if os.path.exists(file_path) and os.path.isfile(file_path):
-            return FileResponse(file_path)
-
-        # Otherwise serve index.html (SPA)
-        return FileResponse(os.path.join(frontend_path, "index.html"))
+    async def serve_frontend(full_path: str, request: Request):
+        asset = frontend.get(full_path)
+        if asset is None:
+            if full_path.split("/", 1)[0] in BACKEND_PREFIXES or frontend.index is None:
+                raise HTTPException(status_code=404, detail="Not Found")
+            asset = frontend.index
+        return frontend.respond(asset, request.headers)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
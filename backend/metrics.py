@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+import time
+
+# The addon writes its counters here (relative to backend/, where both the
+# proxy and the API run); main.py serves them on /metrics.
+METRICS_FILE = "metrics.json"
+FLUSH_INTERVAL = 1.0
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+COUNTERS = (
+    ("flows", "Flows a handler ran on."),
+    ("modified", "Flows a handler changed."),
+    ("bytes_in", "Body bytes (as sent on the wire) before the handler ran."),
+    ("bytes_out", "Body bytes (as sent on the wire) after the handler ran."),
+    ("errors", "Handler errors."),
+    ("cache_hits", "Rewrites served from the rewrite cache."),
+)
+
+
+class HandlerStats:
+    __slots__ = ("flows", "modified", "bytes_in", "bytes_out", "errors", "cache_hits", "buckets", "seconds")
+
+    def __init__(self):
+        self.flows = 0
+        self.modified = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.seconds = 0.0
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name, _ in COUNTERS}
+        data["buckets"] = list(self.buckets)
+        data["seconds"] = self.seconds
+        return data
+
+
+class Metrics:
+    """
+    Per-handler counters and latency histograms, recorded by the addon.
+
+    Updates are plain integer bumps under a lock (handlers also run on the
+    rewrite pool's threads). The proxy runs in its own process, so instead
+    of exporting over a socket the addon periodically writes a snapshot to
+    METRICS_FILE with an atomic rename, which the API reads on demand.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def _stats(self, name):
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = HandlerStats()
+        return stats
+
+    def observe(self, name, seconds, bytes_in=0, bytes_out=0, modified=False):
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        with self._lock:
+            stats = self._stats(name)
+            stats.flows += 1
+            stats.modified += modified
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            stats.buckets[bucket] += 1
+            stats.seconds += seconds
+            self.dirty = True
+
+    def error(self, name):
+        with self._lock:
+            self._stats(name).errors += 1
+            self.dirty = True
+
+    def cache_hit(self, name):
+        with self._lock:
+            self._stats(name).cache_hits += 1
+            self.dirty = True
+
+    def snapshot(self, **gauges):
+        """A JSON-able view of the counters, plus any extra gauge groups (e.g. pool=...)."""
+        with self._lock:
+            self.dirty = False
+            handlers = {name: stats.to_dict() for name, stats in self.handlers.items()}
+        return {"time": time.time(), "handlers": handlers, "gauges": gauges}
+
+    def write(self, path, **gauges):
+        data = json.dumps(self.snapshot(**gauges))
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+def worker_metrics_file(path, index):
+    """Per-worker snapshot path when several proxy processes run: metrics-<index>.json."""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{index}{ext}"
+
+
+# Gauges that don't add up across workers: high-water marks take the
+# largest value, averages are weighted by the jobs behind each.
+MAX_GAUGES = frozenset({"max_queue_depth", "wait_max_ms"})
+MEAN_GAUGES = frozenset({"wait_avg_ms"})
+
+
+def _gauge_weight(values):
+    """Jobs a worker's pool averages are taken over."""
+    return sum(values.get(key, 0) for key in ("completed", "timeouts", "errors"))
+
+
+def merge_snapshots(snapshots):
+    """Merges several workers' snapshots into one; None if there are none."""
+    snapshots = [s for s in snapshots if s]
+    if not snapshots:
+        return None
+
+    handlers = {}
+    groups = {}
+    for snapshot in snapshots:
+        for name, stats in snapshot.get("handlers", {}).items():
+            merged = handlers.setdefault(name, HandlerStats().to_dict())
+            for key, value in stats.items():
+                if key == "buckets":
+                    merged[key] = [a + b for a, b in zip(merged[key], value)]
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        for group, values in snapshot.get("gauges", {}).items():
+            groups.setdefault(group, []).append(values)
+
+    gauges = {}
+    for group, workers in groups.items():
+        merged = gauges[group] = {}
+        total_weight = sum(_gauge_weight(values) for values in workers)
+        for values in workers:
+            for key, value in values.items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                if key in MAX_GAUGES:
+                    merged[key] = max(merged.get(key, value), value)
+                elif key in MEAN_GAUGES:
+                    share = _gauge_weight(values) / total_weight if total_weight else 1 / len(workers)
+                    merged[key] = merged.get(key, 0) + value * share
+                else:
+                    merged[key] = merged.get(key, 0) + value
+    # Age is that of the stalest worker
+    return {"time": min(s.get("time", 0) for s in snapshots), "handlers": handlers, "gauges": gauges}
+
+
+def read_snapshot(path):
+    """The last snapshot the proxy wrote, or None."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def render_prometheus(snapshot, running):
+    """Renders a snapshot in the Prometheus text exposition format."""
+    lines = [
+        "# HELP aitweaker_proxy_running Whether the proxy process is running.",
+        "# TYPE aitweaker_proxy_running gauge",
+        f"aitweaker_proxy_running {int(bool(running))}",
+    ]
+    if not snapshot:
+        return "\n".join(lines) + "\n"
+
+    lines += [
+        "# HELP aitweaker_metrics_age_seconds Seconds since the proxy last wrote its metrics.",
+        "# TYPE aitweaker_metrics_age_seconds gauge",
+        f"aitweaker_metrics_age_seconds {max(0.0, time.time() - snapshot.get('time', 0)):.3f}",
+    ]
+
+    handlers = snapshot.get("handlers", {})
+    for name, help_text in COUNTERS:
+        lines.append(f"# HELP aitweaker_handler_{name}_total {help_text}")
+        lines.append(f"# TYPE aitweaker_handler_{name}_total counter")
+        for handler, stats in sorted(handlers.items()):
+            lines.append(f"aitweaker_handler_{name}_total{_labels(handler=handler)} {stats.get(name, 0)}")
+
+    lines.append("# HELP aitweaker_handler_duration_seconds Time spent in a handler.")
+    lines.append("# TYPE aitweaker_handler_duration_seconds histogram")
+    for handler, stats in sorted(handlers.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), stats.get("buckets", ())):
+            cumulative += count
+            lines.append(f"aitweaker_handler_duration_seconds_bucket{_labels(handler=handler, le=bound)} {cumulative}")
+        lines.append(f"aitweaker_handler_duration_seconds_sum{_labels(handler=handler)} {stats.get('seconds', 0.0)}")
+        lines.append(f"aitweaker_handler_duration_seconds_count{_labels(handler=handler)} {cumulative}")
+
+    for group, values in sorted(snapshot.get("gauges", {}).items()):
+        for key, value in sorted(values.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"# TYPE aitweaker_{group}_{key} gauge")
+                lines.append(f"aitweaker_{group}_{key} {value}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import socket
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = 30.0
+
+
+def discover_local_ip():
+    """The LAN address other devices should use as proxy host. Blocking: may wait on DNS."""
+    local_ip = None
+    try:
+        local_ip = socket.gethostbyname(socket.gethostname())
+    except OSError:
+        pass
+    try:
+        # Try to find the actual outbound IP (UDP connect sends no packets)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(("8.8.8.8", 80))
+            local_ip = s.getsockname()[0]
+        finally:
+            s.close()
+    except OSError:
+        pass
+    return local_ip or "127.0.0.1"
+
+
+class NetworkInfo:
+    """
+    Cached network discovery. Lookups run on a thread every REFRESH_INTERVAL
+    seconds, so request handlers read ``local_ip`` without ever blocking on
+    a slow resolver; ``on_change`` is called when the address changes (e.g.
+    after switching Wi-Fi).
+    """
+
+    def __init__(self, discover=discover_local_ip, on_change=None):
+        self.discover = discover
+        self.on_change = on_change
+        self.local_ip = None
+        self._task = None
+
+    async def refresh(self):
+        try:
+            local_ip = await asyncio.to_thread(self.discover)
+        except Exception as e:
+            logger.error(f"Network discovery failed: {e}")
+            return
+        if local_ip != self.local_ip:
+            self.local_ip = local_ip
+            if self.on_change is not None:
+                self.on_change(local_ip)
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(REFRESH_INTERVAL)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+
+from mitmproxy import addons, log, master, options
+
+from addon_proxy import AITweaker
+from routing import host_patterns
+from rules_store import MemoryRulesStore
+
+# Server and HTTP client chatter from the backend itself is not proxy output.
+IGNORED_LOGGERS = ("uvicorn", "fastapi", "httpx", "httpcore", "asyncio")
+
+
+class LogBusHandler(log.MitmLogHandler):
+    """Forwards mitmproxy and addon log records to the LogBus, as the subprocess's stdout would."""
+
+    def __init__(self, bus, loop):
+        super().__init__(level=logging.INFO)
+        self.bus = bus
+        self.loop = loop
+        self.formatter = log.MitmFormatter(False)
+
+    def filter(self, record):
+        return super().filter(record) and not record.name.startswith(IGNORED_LOGGERS)
+
+    def emit(self, record):
+        # Records also come from the rewrite pool's threads
+        self.bus.publish_threadsafe(self.format(record), self.loop)
+
+
+class StartedSignal:
+    """Set once the master has set up its servers and fired the running hook."""
+
+    def __init__(self):
+        self.event = asyncio.Event()
+
+    def running(self):
+        self.event.set()
+
+
+class InProcessProxy:
+    """
+    mitmproxy's master running as a task on the backend's own event loop,
+    with AITweaker registered directly instead of loaded from a script.
+
+    Rules come from a MemoryRulesStore that ConfigManager updates are pushed
+    into, logs go straight to the LogBus and metrics are read from the addon,
+    so nothing is round-tripped through rules.json, stdout or metrics.json.
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.master = None
+        self.addon = None
+        self.store = None
+        self.task = None
+        self._handler = None
+        self._root_level = None
+
+    @property
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    async def start(self, port, rules, allow_hosts=None, cert_files=None):
+        loop = asyncio.get_running_loop()
+        opts = options.Options(listen_port=port)
+        # A bare Master rather than DumpMaster: DumpMaster's errorcheck addon
+        # calls sys.exit() on any error logged during startup, which in here
+        # would take the whole backend down with it.
+        self.master = master.Master(opts)
+        self.master.addons.add(*addons.default_addons())
+
+        self.store = MemoryRulesStore(rules)
+        self.addon = AITweaker(rules_store=self.store)
+        started = StartedSignal()
+        self.master.addons.add(self.addon, started)
+        # Like the mitmdump command line; applied once every addon has loaded its options
+        updates = {"block_global": False, "tweaker_metrics_file": ""}
+        if allow_hosts is not None:
+            updates["allow_hosts"] = host_patterns(allow_hosts)
+        if cert_files:
+            updates["certs"] = [f"{host}={path}" for host, path in sorted(cert_files.items())]
+        opts.update(**updates)
+
+        self._handler = LogBusHandler(self.bus, loop)
+        self._handler.install()
+        # ctx.log in the addon logs through the root logger, so it has to
+        # pass INFO while the proxy runs; stop() puts the backend's level back.
+        root = logging.getLogger()
+        if root.getEffectiveLevel() > logging.INFO:
+            self._root_level = root.level
+            root.setLevel(logging.INFO)
+
+        self.task = loop.create_task(self.master.run())
+        waiter = loop.create_task(started.event.wait())
+        await asyncio.wait([self.task, waiter], return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        if not self.master.addons.get("proxyserver").listen_addrs():
+            await self.stop()
+            raise RuntimeError(f"could not listen on port {port}")
+
+    def update_rules(self, rules):
+        if self.store is not None and self.store.publish(rules):
+            # Swaps the addon's snapshot and pushes allow_hosts to the master now
+            self.addon.load_rules()
+
+    def metrics(self):
+        if self.addon is None:
+            return None
+        return self.addon.metrics.snapshot(
+            pool=self.addon.pool.stats(),
+            cache=self.addon.rewrite_cache.stats(),
+            http=self.addon.validators.stats(),
+        )
+
+    async def stop(self):
+        if self.master is None:
+            return
+        self.master.shutdown()
+        try:
+            await self.task
+        finally:
+            self._handler.uninstall()
+            if self._root_level is not None:
+                logging.getLogger().setLevel(self._root_level)
+                self._root_level = None
+            self.master = None
+            self.task = None
@@ -1,63 +1,170 @@
-import subprocess
-import threading
 import asyncio
 import os
 
+from leaf_certs import LeafCertCache
+from log_bus import LogBus
+from metrics import METRICS_FILE, merge_snapshots, read_snapshot, worker_metrics_file
+from proxy_workers import WorkerPool
+from routing import host_patterns
+
+# Minimum gap between WebSocket frames; lines arriving meanwhile share a frame.
+LOG_BATCH_INTERVAL = 0.1
+
+# "subprocess" runs mitmdump with the addon script; "inprocess" embeds
+# mitmproxy in the backend's event loop (see proxy_core.py).
+PROXY_MODES = ("subprocess", "inprocess")
+
+DEFAULT_WORKERS = 1
+
 class ProxyManager:
-    def __init__(self):
-        self.process = None
-        self.log_queue = asyncio.Queue()
+    def __init__(self, mode=None, workers=None, extra_args=None, metrics_file=METRICS_FILE):
+        self.pool = None
+        self.inprocess = None
+        self.mode = mode or os.environ.get("AITWEAKER_PROXY_MODE", "subprocess")
+        self.workers = workers or int(os.environ.get("AITWEAKER_PROXY_WORKERS", DEFAULT_WORKERS))
+        # Appended to every mitmdump command line, e.g. extra -s scripts. Set
+        # the metrics file through metrics_file: mitmdump mishandles an addon
+        # option given twice with --set.
+        self.extra_args = list(extra_args or [])
+        self.metrics_file = metrics_file
+        self.leaf_certs = LeafCertCache()
+        self.cert_files = {}
+        self.logs = LogBus()
         self.is_running = False
         self.port = 8080
+        self.allow_hosts = None
+
+    def _build_cmd(self, port, index):
+        """The mitmdump command line for one worker (index is None when it is the only one)."""
+        # --set block_global=false is needed to allow remote connections
+        cmd = ["mitmdump", "-s", "addon_proxy.py", "-p", str(port), "--set", "block_global=false"] + self.extra_args
+        if index is not None:
+            cmd += ["--listen-host", "127.0.0.1", "--set", f"tweaker_metrics_file={self.worker_metrics_path(index)}"]
+        elif self.metrics_file != METRICS_FILE:
+            cmd += ["--set", f"tweaker_metrics_file={self.metrics_file}"]
+        if self.allow_hosts is not None:
+            # Only decrypt hosts the rules can modify; the addon keeps this
+            # list in sync when the profile changes while the proxy runs.
+            for pattern in host_patterns(self.allow_hosts):
+                cmd += ["--allow-hosts", pattern]
+        return cmd + self.certs_args()
+
+    def worker_metrics_path(self, index):
+        """The metrics file a worker's addon writes, which doubles as its heartbeat."""
+        return self.metrics_file if index is None else worker_metrics_file(self.metrics_file, index)
 
-    async def start_proxy(self, port=8080):
+    def certs_args(self):
+        """--certs options for the pre-generated leaf certs, so mitmdump doesn't mint them per start."""
+        args = []
+        for host, path in sorted(self.cert_files.items()):
+            args += ["--certs", f"{host}={path}"]
+        return args
+
+    async def prepare_certs(self, hosts):
+        """Makes sure there are current leaf certs for hosts; only reads the files when they are."""
+        try:
+            self.cert_files = await asyncio.to_thread(self.leaf_certs.ensure, hosts or [])
+        except Exception as e:
+            # Not fatal: mitmdump then generates them on the fly as before
+            self.cert_files = {}
+            self.logs.publish(f"Could not prepare certificates: {str(e)}")
+
+    async def start_proxy(self, port=8080, allow_hosts=None, rules=None):
         if self.is_running:
             return
 
         self.port = port
-        # Command to run mitmdump with the addon script
-        # --set block_global=false is needed to allow remote connections
-        cmd = ["mitmdump", "-s", "addon_proxy.py", "-p", str(port), "--set", "block_global=false"]
+        await self.prepare_certs(allow_hosts)
+        if self.mode == "inprocess":
+            await self._start_inprocess(port, allow_hosts, rules)
+            return
 
+        self.allow_hosts = allow_hosts
+        self.pool = WorkerPool(self.logs, self._build_cmd, os.path.dirname(os.path.abspath(__file__)), self.workers,
+                               heartbeat_file=self.worker_metrics_path)
         try:
-            # Use unbuffered output
-            self.process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1,
-                universal_newlines=True,
-                cwd=os.path.dirname(os.path.abspath(__file__))
-            )
+            await self.pool.start(port)
             self.is_running = True
+            if self.workers > 1:
+                self.logs.publish(f"Proxy started on port {port} with {self.workers} workers")
+            else:
+                self.logs.publish(f"Proxy started on port {port}")
+        except Exception as e:
+            await self.pool.stop()
+            self.pool = None
+            self.logs.publish(f"Failed to start proxy: {str(e)}")
+            self.is_running = False
 
-            loop = asyncio.get_running_loop()
-            # Start threads to read logs
-            threading.Thread(target=self._read_stream, args=(self.process.stdout, "INFO", loop), daemon=True).start()
-            threading.Thread(target=self._read_stream, args=(self.process.stderr, "ERROR", loop), daemon=True).start()
+    async def restart_proxy(self, allow_hosts=None, rules=None):
+        """Rolling restart: workers are replaced one at a time while the others keep serving."""
+        if allow_hosts is not None:
+            await self.prepare_certs(allow_hosts)
+        if self.inprocess is not None and self.inprocess.is_running:
+            await self.inprocess.stop()
+            self.is_running = False
+            await self._start_inprocess(self.port, allow_hosts, rules)
+            return
+        if self.pool is not None:
+            if allow_hosts is not None:
+                self.allow_hosts = allow_hosts
+            await self.pool.rolling_restart(self.port)
+            self.logs.publish("Proxy workers restarted")
 
-            await self.log_queue.put(f"Proxy started on port {port}")
+    def worker_states(self):
+        return self.pool.states() if self.pool is not None else []
+
+    async def _start_inprocess(self, port, allow_hosts, rules):
+        # Imported on first use so the subprocess mode never loads mitmproxy here
+        from proxy_core import InProcessProxy
+
+        try:
+            if self.inprocess is None:
+                self.inprocess = InProcessProxy(self.logs)
+            await self.inprocess.start(port, rules or {}, allow_hosts, self.cert_files)
+            self.is_running = True
+            self.logs.publish(f"Proxy started in-process on port {port}")
         except Exception as e:
-            await self.log_queue.put(f"Failed to start proxy: {str(e)}")
+            self.logs.publish(f"Failed to start proxy: {str(e)}")
             self.is_running = False
 
+    def update_rules(self, rules):
+        """Pushes regenerated rules to an in-process proxy; mitmdump picks up rules.json itself."""
+        if self.inprocess is not None:
+            self.inprocess.update_rules(rules)
+
+    def metrics_snapshot(self, path):
+        """Live counters from an in-process proxy, else the last snapshots the mitmdump workers wrote."""
+        if self.inprocess is not None and self.inprocess.is_running:
+            return self.inprocess.metrics()
+        if self.pool is not None and self.pool.count > 1:
+            return merge_snapshots([read_snapshot(worker_metrics_file(path, i)) for i in range(self.pool.count)])
+        return read_snapshot(path)
+
     async def stop_proxy(self):
-        if self.process:
-            self.process.terminate()
-            self.process = None
+        if self.inprocess is not None and self.inprocess.is_running:
+            await self.inprocess.stop()
             self.is_running = False
-            await self.log_queue.put("Proxy stopped")
-
-    def _read_stream(self, stream, level, loop):
-        """Reads stdout/stderr from the subprocess and puts lines into the async queue."""
-        for line in iter(stream.readline, ''):
-            if line:
-                # We need to run the async put in a thread-safe way
-                asyncio.run_coroutine_threadsafe(self.log_queue.put(line.strip()), loop)
+            self.logs.publish("Proxy stopped")
+        if self.pool:
+            await self.pool.stop()
+            self.pool = None
+            self.is_running = False
+            self.logs.publish("Proxy stopped")
 
     async def get_logs(self):
-        """Generator to stream logs to WebSocket."""
-        while True:
-            log = await self.log_queue.get()
-            yield log
+        """
+        Generator to stream logs to one WebSocket: recent history first, then
+        newline-joined batches of lines, at most one frame per LOG_BATCH_INTERVAL.
+        """
+        subscription = self.logs.subscribe()
+        reported = 0
+        try:
+            while True:
+                batch = await subscription.get_batch()
+                if subscription.dropped > reported:
+                    batch.insert(0, f"[{subscription.dropped - reported} log lines dropped, client too slow]")
+                    reported = subscription.dropped
+                yield "\n".join(batch)
+                await asyncio.sleep(LOG_BATCH_INTERVAL)
+        finally:
+            self.logs.unsubscribe(subscription)
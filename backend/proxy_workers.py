@@ -0,0 +1,335 @@
+import asyncio
+import os
+import socket
+import subprocess
+import threading
+import time
+
+HEALTH_INTERVAL = 2.0
+# mitmdump's own "HTTP(S) proxy listening at *:8080." line: the worker is serving
+READY_MARKER = " listening at "
+# The addon bumps its metrics file every second (FLUSH_INTERVAL); a worker
+# whose file goes this long without a bump has a stuck event loop.
+HEARTBEAT_TIMEOUT = 10.0
+# A worker that hasn't reported listening by then is not going to
+READY_TIMEOUT = 30.0
+# A worker that dies sooner than this after starting is restarted with backoff.
+MIN_UPTIME = 10.0
+MAX_BACKOFF = 30.0
+DRAIN_TIMEOUT = 10.0
+PIPE_CHUNK = 64 * 1024
+
+
+def free_port():
+    """An unused loopback port for a worker behind the acceptor."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ProxyWorker:
+    """One mitmdump process, its log reader threads and its health state."""
+
+    def __init__(self, index, port, cmd, logs, cwd, heartbeat_file=None):
+        self.index = index
+        self.port = port
+        self.cmd = cmd
+        self.logs = logs
+        self.cwd = cwd
+        self.heartbeat_file = os.path.join(cwd or "", heartbeat_file) if heartbeat_file else None
+        self.process = None
+        self.healthy = False
+        self.ready = False
+        self.refused = False
+        self.spawned_at = 0.0
+        self.draining = False
+        self.connections = 0
+        self.restarts = 0
+        self.started_at = 0.0
+        self.backoff = 1.0
+        self.next_start = 0.0
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def spawn(self, loop):
+        self.process = subprocess.Popen(
+            self.cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            universal_newlines=True,
+            cwd=self.cwd
+        )
+        self.healthy = False
+        self.ready = False
+        self.refused = False
+        self.started_at = time.monotonic()
+        # Wall clock, to compare with the heartbeat file's mtime
+        self.spawned_at = time.time()
+        for stream in (self.process.stdout, self.process.stderr):
+            threading.Thread(target=self._read_stream, args=(stream, loop), daemon=True).start()
+
+    def _read_stream(self, stream, loop):
+        prefix = f"[w{self.index}] " if self.index is not None else ""
+        for line in iter(stream.readline, ''):
+            if line:
+                if not self.ready and READY_MARKER in line:
+                    self.ready = True
+                self.logs.publish_threadsafe(prefix + line.strip(), loop)
+
+    async def check(self):
+        """
+        Marks the worker healthy if it is alive, has reported listening, its
+        addon's heartbeat is recent and the acceptor hasn't been refused.
+
+        No probe connection: mitmdump logs a connect/disconnect pair for
+        every one, which would flood the log bus.
+        """
+        self.healthy = self.alive and self.ready and not self.refused and not self.stale()
+        return self.healthy
+
+    def stale(self):
+        """Whether the addon stopped bumping its heartbeat file (counted from spawn if never written)."""
+        if self.heartbeat_file is None:
+            return False
+        try:
+            beat = os.stat(self.heartbeat_file).st_mtime
+        except OSError:
+            beat = 0.0
+        return time.time() - max(beat, self.spawned_at) > HEARTBEAT_TIMEOUT
+
+    def wedged(self):
+        """Alive but not serving: refused a connection, stuck, or never came up."""
+        if not self.alive:
+            return False
+        if not self.ready:
+            return time.monotonic() - self.started_at > READY_TIMEOUT
+        return self.refused or self.stale()
+
+    def refuse(self):
+        """Called by the acceptor when the worker refused a connection; sticks until the worker is replaced."""
+        self.refused = True
+        self.healthy = False
+
+    async def wait_healthy(self, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if await self.check():
+                return True
+            if not self.alive:
+                return False
+            await asyncio.sleep(0.1)
+        return False
+
+    def terminate(self):
+        self.healthy = False
+        if self.process is not None:
+            self.process.terminate()
+
+    def kill(self):
+        self.healthy = False
+        if self.process is not None:
+            self.process.kill()
+
+    def state(self):
+        return {
+            "index": self.index,
+            "pid": self.process.pid if self.process is not None else None,
+            "port": self.port,
+            "alive": self.alive,
+            "healthy": self.healthy,
+            "connections": self.connections,
+            "restarts": self.restarts,
+            "uptime": round(time.monotonic() - self.started_at, 1) if self.alive else 0,
+        }
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(PIPE_CHUNK)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        pass
+
+
+class FrontAcceptor:
+    """
+    Listens on the public proxy port and splices each client connection to
+    the healthy worker with the fewest open connections.
+
+    mitmproxy works per TCP connection, so a plain byte pipe is enough; TLS
+    and rewriting stay in the workers, the acceptor only copies bytes. A
+    portable alternative to SO_REUSEPORT, which mitmproxy doesn't set and
+    Windows doesn't have, and it lets a restarting worker drain.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.server = None
+        self.open_writers = set()
+        self.tasks = set()
+
+    def pick(self):
+        candidates = [w for w in self.workers if w.healthy and not w.draining]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda w: w.connections)
+
+    async def start(self, port):
+        self.server = await asyncio.start_server(self.handle, host="0.0.0.0", port=port)
+
+    async def handle(self, client_reader, client_writer):
+        worker = self.pick()
+        if worker is None:
+            client_writer.close()
+            return
+
+        worker.connections += 1
+        self.tasks.add(asyncio.current_task())
+        try:
+            try:
+                worker_reader, worker_writer = await asyncio.open_connection("127.0.0.1", worker.port)
+            except OSError:
+                worker.refuse()
+                client_writer.close()
+                return
+            self.open_writers.update((client_writer, worker_writer))
+            await asyncio.gather(_pipe(client_reader, worker_writer), _pipe(worker_reader, client_writer))
+            worker_writer.close()
+            client_writer.close()
+            self.open_writers.difference_update((client_writer, worker_writer))
+        finally:
+            worker.connections -= 1
+            self.tasks.discard(asyncio.current_task())
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            # Closing the server leaves accepted connections open; end them too
+            for writer in list(self.open_writers):
+                writer.close()
+            if self.tasks:
+                await asyncio.wait(list(self.tasks), timeout=1.0)
+            await self.server.wait_closed()
+            self.server = None
+
+
+class WorkerPool:
+    """
+    Supervises the proxy workers: restarts crashed ones with backoff and
+    replaces them one at a time on a rolling restart.
+
+    With a single worker, mitmdump listens on the public port itself; with
+    more, each gets a loopback port behind a FrontAcceptor.
+    """
+
+    def __init__(self, logs, build_cmd, cwd, count=1, heartbeat_file=None):
+        self.logs = logs
+        self.build_cmd = build_cmd
+        self.cwd = cwd
+        self.count = count
+        # heartbeat_file(index) -> path the worker's addon keeps bumping, or None
+        self.heartbeat_file = heartbeat_file or (lambda index: None)
+        self.workers = []
+        self.acceptor = None
+        self._supervisor = None
+
+    def _new_worker(self, index, public_port):
+        if self.count == 1:
+            return ProxyWorker(None, public_port, self.build_cmd(public_port, None), self.logs, self.cwd,
+                               self.heartbeat_file(None))
+        port = free_port()
+        return ProxyWorker(index, port, self.build_cmd(port, index), self.logs, self.cwd, self.heartbeat_file(index))
+
+    async def start(self, port):
+        loop = asyncio.get_running_loop()
+        self.workers = [self._new_worker(i, port) for i in range(self.count)]
+        for worker in self.workers:
+            worker.spawn(loop)
+        if self.count > 1:
+            self.acceptor = FrontAcceptor(self.workers)
+            await self.acceptor.start(port)
+        self._supervisor = loop.create_task(self.supervise())
+
+    async def supervise(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            for worker in list(self.workers):
+                if worker.draining:
+                    continue
+                if worker.alive:
+                    if await worker.check():
+                        if time.monotonic() - worker.started_at > MIN_UPTIME:
+                            worker.backoff = 1.0
+                    elif worker.wedged():
+                        # Killed, not terminated: a stuck event loop won't handle SIGTERM.
+                        # The next round sees it dead and restarts it.
+                        self.logs.publish(f"Proxy worker {worker.index or 0} stopped responding, killing it")
+                        worker.kill()
+                    continue
+
+                now = time.monotonic()
+                if worker.next_start == 0.0:
+                    code = worker.process.returncode if worker.process is not None else None
+                    crashed_early = now - worker.started_at < MIN_UPTIME
+                    worker.next_start = now + (worker.backoff if crashed_early else 0)
+                    if crashed_early:
+                        worker.backoff = min(worker.backoff * 2, MAX_BACKOFF)
+                    self.logs.publish(f"Proxy worker {worker.index or 0} exited with code {code}, restarting")
+                if now >= worker.next_start:
+                    worker.next_start = 0.0
+                    worker.restarts += 1
+                    worker.spawn(loop)
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def rolling_restart(self, port):
+        """Replaces the workers one by one, each only after its successor is healthy."""
+        loop = asyncio.get_running_loop()
+        for i, old in enumerate(list(self.workers)):
+            if self.count == 1:
+                # Only one process can own the public port: restart in place.
+                old.draining = True
+                old.terminate()
+                await asyncio.to_thread(old.process.wait)
+                new = self._new_worker(i, port)
+                new.spawn(loop)
+                self.workers[i] = new
+                continue
+
+            new = self._new_worker(i, port)
+            new.spawn(loop)
+            if not await new.wait_healthy(DRAIN_TIMEOUT):
+                new.terminate()
+                self.logs.publish(f"Replacement for proxy worker {i} failed its health check, keeping the old one")
+                continue
+            new.restarts = old.restarts + 1
+            self.workers[i] = new
+            old.draining = True
+
+            deadline = time.monotonic() + DRAIN_TIMEOUT
+            while old.connections and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            old.terminate()
+
+    async def stop(self):
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
+        if self.acceptor is not None:
+            await self.acceptor.stop()
+            self.acceptor = None
+        for worker in self.workers:
+            worker.terminate()
+        self.workers = []
+
+    def states(self):
+        return [worker.state() for worker in self.workers]
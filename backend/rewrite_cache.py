@@ -0,0 +1,75 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+DEFAULT_CACHE_MB = 64
+
+
+class RewriteCache:
+    """
+    LRU cache of rewritten response bodies with a byte budget.
+
+    Entries are keyed by (handler, rules version, upstream validator, content
+    encoding) and hold the final, already re-compressed body, so a hit skips
+    decoding, rewriting and re-encoding entirely. A value of ``None`` records
+    that the handler left the body unchanged. Safe to share between the
+    rewrite pool's threads.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def validator(raw_content, etag=None, url=""):
+        """A strong ETag (scoped to its URL) if upstream sent one, otherwise a hash of the raw body."""
+        if etag and not etag.startswith("W/"):
+            return f"etag:{url}:{etag}"
+        return "blake2b:" + hashlib.blake2b(raw_content, digest_size=16).hexdigest()
+
+    def get(self, key):
+        """Returns (found, body)."""
+        with self._lock:
+            try:
+                body = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, body
+
+    def put(self, key, body):
+        cost = len(body) if body is not None else 0
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            if key in self.entries:
+                old = self.entries.pop(key)
+                self.size -= len(old) if old is not None else 0
+            self.entries[key] = body
+            self.size += cost
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted) if evicted is not None else 0
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
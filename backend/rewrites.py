@@ -0,0 +1,195 @@
+import re
+
+# Backreferences inside a pattern would point at the wrong group once the
+# pattern is nested in the combined alternation.
+_BACKREF = re.compile(rb"\\[1-9]|\(\?P=")
+
+
+def replace_all(data, find, replace):
+    """
+    Replaces every occurrence of ``find`` in ``data`` without leaving bytes.
+
+    bytes.replace sizes the result exactly and fills it in one pass, so the
+    only copy made is the result itself; assembling it from memoryview slices
+    costs a Python object per match and peaks higher on dense bundles (see
+    benchmarks/bench_rewrite_memory.py). If nothing matches, ``data`` is
+    returned as-is (same object), which callers use to skip re-encoding.
+    """
+    if data.find(find) == -1:
+        return data
+    return data.replace(find, replace)
+
+
+def _validate_rule(rule):
+    """Returns a normalized {"find", "replace", "regex"} dict, or None if unusable."""
+    if not isinstance(rule, dict) or not rule.get("enabled", True):
+        return None
+    find = rule.get("find")
+    replace = rule.get("replace", "")
+    if not isinstance(find, str) or not find or not isinstance(replace, str):
+        return None
+    is_regex = bool(rule.get("regex", False))
+    if is_regex:
+        try:
+            # Wrapped in a group, as it will be inside the combined matcher;
+            # this also rejects global inline flags that only work at the start.
+            re.compile(f"(?:{find})".encode())
+        except (re.error, UnicodeEncodeError):
+            return None
+    return {"find": find, "replace": replace, "regex": is_regex}
+
+
+def normalize_rewrites(rewrites):
+    """
+    Validates declarative rewrite rules and groups them by host, path prefix
+    and content type, keeping their order (earlier rules win when two match
+    at the same position, literal rules before regex ones). Invalid rules
+    are dropped.
+
+    Input rules look like::
+
+        {"host": "labs.google", "path": "/fx/", "content_type": "javascript",
+         "find": "/fx/music", "replace": "/fx/music?debug", "regex": false}
+
+    Already grouped entries (the output format, with a "rules" list) are
+    accepted too, so normalizing is idempotent.
+    """
+    flat = []
+    for entry in rewrites or []:
+        if isinstance(entry, dict) and isinstance(entry.get("rules"), (list, tuple)):
+            scope = {k: entry.get(k) for k in ("host", "path", "content_type")}
+            flat.extend({**rule, **scope} for rule in entry["rules"] if isinstance(rule, dict))
+        else:
+            flat.append(entry)
+
+    groups = {}
+    for rule in flat:
+        if not isinstance(rule, dict) or not isinstance(rule.get("host"), str) or not rule["host"]:
+            continue
+        normalized = _validate_rule(rule)
+        if normalized is None:
+            continue
+        key = (rule["host"].lower(), rule.get("path") or "/", (rule.get("content_type") or "").lower())
+        groups.setdefault(key, []).append(normalized)
+
+    return [
+        {"host": host, "path": path, "content_type": content_type, "rules": rules}
+        for (host, path, content_type), rules in groups.items()
+    ]
+
+
+def literal_trie_pattern(literals):
+    """
+    One regex matching any of ``literals``, shaped as a trie: shared prefixes
+    are matched once and each branch point tests a single byte, so the cost
+    per position depends on the literals' length, not on how many there are.
+    A branch point tries its branches in order of the earliest literal below
+    each, so of two literals where one is a prefix of the other, the one
+    listed first wins, as in a plain alternation.
+    """
+    trie = {}
+    for index, find in enumerate(literals):
+        node = trie
+        for byte in find:
+            node = node.setdefault(byte, {})
+        node.setdefault(None, index)
+
+    def build(node):
+        """(lowest rule index below ``node``, pattern for the rest of the literals)."""
+        prefix = b""
+        # Unbranched runs are walked here, so only branch points recurse
+        while len(node) == 1 and None not in node:
+            (byte, node), = node.items()
+            prefix += re.escape(bytes([byte]))
+        options = []
+        for key, child in node.items():
+            if key is None:
+                # A literal ends here: the empty branch
+                options.append((child, b""))
+            else:
+                first, rest = build(child)
+                options.append((first, re.escape(bytes([key])) + rest))
+        options.sort(key=lambda option: option[0])
+        if len(options) == 1:
+            return options[0][0], prefix + options[0][1]
+        return options[0][0], prefix + b"(?:" + b"|".join(fragment for _, fragment in options) + b")"
+
+    return build(trie)[1]
+
+
+class MultiRewriter:
+    """
+    Applies any number of literal and regex find/replace rules to a body in a
+    single linear pass.
+
+    Literal rules are merged into one trie-shaped pattern (see
+    literal_trie_pattern), so adding literals doesn't slow the scan; the
+    match is looked up in a dict for its replacement. Regex rules are
+    alternatives next to it, each in a named group so ``\\1`` is expanded
+    against the rule's own pattern; they cost a branch per position each.
+    Where a literal and a regex rule match at the same position the literal
+    wins. A single literal rule skips the regex engine and uses
+    bytes.replace. Regex patterns that can't share the alternation (e.g.
+    ones using backreferences) fall back to one pass per regex rule.
+    """
+
+    def __init__(self, rules):
+        self.rules = [
+            (r["find"].encode(), r["replace"].encode(), r.get("regex", False))
+            for r in rules
+        ]
+        self._literal = None
+        self._pattern = None
+        self._passes = ()
+        if len(self.rules) == 1 and not self.rules[0][2]:
+            self._literal = self.rules[0][:2]
+            return
+
+        self._literals = {}
+        for find, replace, is_regex in self.rules:
+            if not is_regex:
+                # The first rule for a literal wins
+                self._literals.setdefault(find, replace)
+        trie = literal_trie_pattern(list(self._literals)) if self._literals else None
+
+        alternatives = [b"(?P<lit>%s)" % trie] if trie is not None else []
+        self._by_group = {}
+        regex_rules = [(find, replace) for find, replace, is_regex in self.rules if is_regex]
+        for i, (find, replace) in enumerate(regex_rules):
+            name = f"r{i}"
+            alternatives.append(b"(?P<%s>%s)" % (name.encode(), find))
+            self._by_group[name] = (re.compile(find), replace)
+
+        if not any(_BACKREF.search(find) for find, _ in regex_rules):
+            try:
+                self._pattern = re.compile(b"|".join(alternatives))
+                return
+            except re.error:
+                pass
+        passes = [(re.compile(trie), self._literal_replacement)] if trie is not None else []
+        passes += [(re.compile(find), replace) for find, replace in regex_rules]
+        self._passes = tuple(passes)
+
+    def _literal_replacement(self, m):
+        return self._literals[m.group()]
+
+    def _replacement(self, m):
+        if m.lastgroup == "lit":
+            return self._literals[m.group()]
+        own, replace = self._by_group[m.lastgroup]
+        return own.match(m.string, m.start()).expand(replace)
+
+    def apply(self, data):
+        """Returns the rewritten body, or ``data`` itself if nothing matched."""
+        if self._literal is not None:
+            return replace_all(data, *self._literal)
+        if self._pattern is not None:
+            return self._sub(self._pattern, self._replacement, data)
+        for pattern, replace in self._passes:
+            data = self._sub(pattern, replace, data)
+        return data
+
+    @staticmethod
+    def _sub(pattern, replace, data):
+        new_data, count = pattern.subn(replace, data)
+        return new_data if count else data
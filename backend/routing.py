@@ -0,0 +1,144 @@
+import re
+
+# Hosts each app's routes can touch. The backend derives mitmproxy's allow_hosts
+# from this, so every other host is tunnelled without TLS interception.
+APP_HOSTS = {
+    "gemini": ("gemini.google.com", "www.gstatic.com"),
+    "copilot": ("copilot.microsoft.com",),
+    "google_labs": ("labs.google",),
+}
+
+# Always intercepted so the certificate onboarding page keeps working.
+ALWAYS_INTERCEPT = ("mitm.it",)
+
+
+def host_patterns(hosts):
+    """Turns hostnames into anchored regexes for mitmproxy's allow_hosts option."""
+    # mitmproxy also matches the Host header of CONNECT requests, which carries the port
+    return [rf"^{re.escape(host)}(:\d+)?$" for host in sorted(set(hosts) | set(ALWAYS_INTERCEPT))]
+
+
+class Route:
+    """A declarative matcher: exact host, then path prefix, then an optional
+    path regex and content-type substring."""
+    __slots__ = ("host", "prefix", "pattern", "content_type", "hook", "app", "handler", "order")
+
+    def __init__(self, host, prefix="/", pattern=None, content_type=None, hook="response", app=None):
+        self.host = host.lower()
+        self.prefix = prefix
+        self.pattern = re.compile(pattern, re.S) if isinstance(pattern, str) else pattern
+        self.content_type = content_type.lower() if content_type else None
+        self.hook = hook
+        self.app = app
+        self.handler = None
+        self.order = 0
+
+    def segment(self):
+        """First path segment of the prefix, or None if the prefix doesn't pin one."""
+        parts = self.prefix.split("/", 2)
+        if len(parts) < 3 and not self.prefix.endswith("/"):
+            # "/app" may still be followed by "?..." or "s", so only index complete segments
+            return None
+        return parts[1] or None
+
+    def matches(self, path, content_type):
+        if not path.startswith(self.prefix):
+            return False
+        if self.pattern is not None and not self.pattern.match(path):
+            return False
+        if self.content_type is not None and self.content_type not in content_type:
+            return False
+        return True
+
+
+def route(host, prefix="/", pattern=None, content_type=None, hook="response", app=None):
+    """Registers the decorated method as a handler for flows matching the route.
+    Stack the decorator to register one handler under several routes."""
+    def decorator(func):
+        if "_routes" not in func.__dict__:
+            func._routes = []
+        func._routes.append(Route(host, prefix, pattern, content_type, hook, app))
+        return func
+    return decorator
+
+
+class Router:
+    """
+    Dispatch table indexed by hook, exact host and first path segment.
+
+    Flows to hosts without any route cost a single dict miss; matched hosts only
+    test the few routes registered under their first path segment.
+    """
+
+    def __init__(self):
+        self.routes = []
+        self._table = {}
+
+    @classmethod
+    def from_object(cls, obj):
+        """Builds a router from the @route-decorated methods of ``obj``, in definition order."""
+        router = cls()
+        seen = set()
+        for klass in reversed(type(obj).__mro__):
+            for name, func in vars(klass).items():
+                if name in seen or not callable(func) or "_routes" not in getattr(func, "__dict__", {}):
+                    continue
+                seen.add(name)
+                for r in func._routes:
+                    router.add(r, getattr(obj, name))
+        return router
+
+    def add(self, r, handler):
+        bound = Route(r.host, r.prefix, r.pattern, r.content_type, r.hook, r.app)
+        bound.handler = handler
+        bound.order = len(self.routes)
+        self.routes.append(bound)
+        self._build()
+
+    def _build(self):
+        table = {}
+        for r in self.routes:
+            hosts = table.setdefault(r.hook, {})
+            hosts.setdefault(r.host, {"segments": {}, "any": []})
+            entry = hosts[r.host]
+            seg = r.segment()
+            if seg is None:
+                entry["any"].append(r)
+            else:
+                entry["segments"].setdefault(seg, []).append(r)
+
+        for hosts in table.values():
+            for host, entry in hosts.items():
+                wildcard = entry["any"]
+                compiled = {seg: tuple(sorted(rs + wildcard, key=lambda r: r.order))
+                            for seg, rs in entry["segments"].items()}
+                hosts[host] = (compiled, tuple(wildcard))
+        self._table = table
+
+    def candidates(self, hook, host, path):
+        """Routes that could match the flow before its content-type is known."""
+        entry = self._table.get(hook, {}).get(host)
+        if entry is None:
+            return ()
+        segments, wildcard = entry
+        if segments:
+            end = path.find("/", 1)
+            seg = path[1:end] if end != -1 else path[1:].split("?", 1)[0]
+            return segments.get(seg, wildcard)
+        return wildcard
+
+    def match_routes(self, hook, host, path, content_type=""):
+        """Returns every route matching a flow, in registration order."""
+        candidates = self.candidates(hook, host, path)
+        if not candidates:
+            return []
+        content_type = content_type.lower()
+        return [r for r in candidates if r.matches(path, content_type)]
+
+    def match(self, hook, host, path, content_type=""):
+        """Returns the handlers for a flow, each at most once, in registration order."""
+        handlers = []
+        for r in self.match_routes(hook, host, path, content_type):
+            if r.handler not in handlers:
+                handlers.append(r.handler)
+        return handlers
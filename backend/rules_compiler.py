@@ -0,0 +1,217 @@
+import bisect
+import hashlib
+import json
+from collections import namedtuple
+
+from rewrites import MultiRewriter, normalize_rewrites
+
+# Per-app artifacts the addon's hot path splices or looks up directly.
+# An app that is missing, disabled or has nothing to patch compiles to None.
+GeminiPayload = namedtuple(
+    "GeminiPayload", ["flags", "ranges", "script_injection", "html_injection", "shim_path", "shim_js"]
+)
+CopilotPatch = namedtuple("CopilotPatch", ["flags", "allow_beta"])
+LabsPatch = namedtuple("LabsPatch", ["bypass_not_found"])
+RewriteGroup = namedtuple("RewriteGroup", ["path", "content_type", "rewriter"])
+# ``rewrites`` maps host -> tuple of RewriteGroup; hosts without rules are absent.
+CompiledRules = namedtuple("CompiledRules", ["version", "gemini", "copilot", "google_labs", "rewrites"])
+
+# Gemini pages load the flag shim from here instead of inlining it. The proxy
+# answers the path itself, and the name carries a hash of the script, so
+# browsers may cache it for good.
+SHIM_PREFIX = "/__aitweaker/shim-"
+
+# Where the MusicFX link lives in Labs bundles and page data.
+LABS_MUSIC_PATHS = ("/fx/_next/static/chunks/pages/index-", "/fx/_next/data/")
+
+
+def normalize_flags(ids, ranges=()):
+    """
+    Splits flag IDs into exact IDs and merged, sorted ``[lo, hi]`` ranges.
+
+    Accepts ints, numeric strings and "a-b" range strings. Invalid ranges are
+    dropped and IDs already covered by a range are folded into it, so the
+    injected shim gets the smallest possible Set and interval table.
+    """
+    exact = set()
+    intervals = []
+    for r in ranges:
+        try:
+            intervals.append((int(r[0]), int(r[1])))
+        except (TypeError, ValueError, IndexError):
+            continue
+    for flag in ids:
+        if isinstance(flag, int):
+            exact.add(flag)
+            continue
+        flag = str(flag).strip()
+        lo, sep, hi = flag.partition("-")
+        if sep and lo.strip().isdigit() and hi.strip().isdigit():
+            intervals.append((int(lo), int(hi)))
+        elif flag.isdigit():
+            exact.add(int(flag))
+        elif flag and not sep:
+            exact.add(flag)
+
+    merged = []
+    for lo, hi in sorted((lo, hi) for lo, hi in intervals if lo <= hi):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+
+    starts = [lo for lo, _ in merged]
+
+    def covered(flag):
+        if not isinstance(flag, int):
+            return False
+        i = bisect.bisect_right(starts, flag) - 1
+        return i >= 0 and flag <= merged[i][1]
+
+    flags = sorted((f for f in exact if not covered(f)), key=lambda f: (isinstance(f, str), f))
+    return flags, merged
+
+
+def _flag_lookup_js(flags, ranges):
+    """JS defining ext_has(id): a Set for exact IDs, binary search over ranges."""
+    bounds = [b for r in ranges for b in r]
+    return f"""const ext_ids = new Set({json.dumps(list(flags))});
+        const ext_ranges = {json.dumps(bounds)};
+        const ext_has = function(id) {{
+            if (ext_ids.has(id)) return true;
+            const n = typeof id === "number" ? id : Number(id);
+            if (n !== n) return false;
+            if (n !== id && ext_ids.has(n)) return true;
+            let lo = 0, hi = (ext_ranges.length >> 1) - 1;
+            while (lo <= hi) {{
+                const mid = (lo + hi) >> 1;
+                if (n < ext_ranges[2 * mid]) hi = mid - 1;
+                else if (n > ext_ranges[2 * mid + 1]) lo = mid + 1;
+                else return true;
+            }}
+            return false;
+        }};"""
+
+
+def gemini_script_injection(flags, ranges=()):
+    return f"""
+;(function(){{
+    try {{
+        {_flag_lookup_js(flags, ranges)}
+        const originalFlagFunc = self.getFlag;
+
+        self.getFlag = function(id, fallback) {{
+            if (ext_has(id)) return true;
+            return originalFlagFunc.call(self, id, fallback);
+        }};
+    }} catch (e) {{}}
+}})();
+"""
+
+
+def gemini_shim_js(flags, ranges=()):
+    return f"""(function() {{
+    try {{
+        {_flag_lookup_js(flags, ranges)}
+        let originalGetFlag;
+        Object.defineProperty(window, 'getFlag', {{
+            configurable: true,
+            enumerable: true,
+            get: function() {{
+                return function(id, fallback) {{
+                    if (ext_has(id)) return true;
+                    if (originalGetFlag) return originalGetFlag.call(window, id, fallback);
+                    return fallback;
+                }};
+            }},
+            set: function(newValue) {{
+                originalGetFlag = newValue;
+            }}
+        }});
+    }} catch (e) {{ console.error("AI Tweaker Injection Error:", e); }}
+}})();
+"""
+
+
+def gemini_shim_path(shim_js):
+    return f"{SHIM_PREFIX}{hashlib.blake2b(shim_js, digest_size=8).hexdigest()}.js"
+
+
+def gemini_html_injection(shim_path):
+    # A plain blocking script on purpose: getFlag must be in place before
+    # Gemini's own scripts run. After the first page it comes from cache.
+    return f'<script src="{shim_path}"></script>'
+
+
+def _compile_gemini(app):
+    # rules.json from ConfigManager is already normalized; this also covers
+    # hand-written files that still carry "a-b" strings in "flags".
+    flags, ranges = normalize_flags(app.get("flags", []), app.get("flag_ranges", []))
+    shim_js = gemini_shim_js(flags, ranges).encode()
+    shim_path = gemini_shim_path(shim_js)
+    return GeminiPayload(
+        flags=tuple(flags),
+        ranges=tuple(tuple(r) for r in ranges),
+        script_injection=gemini_script_injection(flags, ranges).encode(),
+        html_injection=gemini_html_injection(shim_path).encode(),
+        shim_path=shim_path,
+        shim_js=shim_js,
+    )
+
+
+def _compile_copilot(app):
+    # De-duplicated, first occurrence wins, so appended flags keep the configured order
+    flags = tuple(dict.fromkeys(app.get("flags", [])))
+    return CopilotPatch(flags=flags, allow_beta=bool(app.get("allow_beta", False)))
+
+
+def _compile_google_labs(app):
+    # The MusicFX links are declarative rewrites; the handlers only do the bypass
+    if not app.get("bypass_not_found", False):
+        return None
+    return LabsPatch(bypass_not_found=True)
+
+
+def builtin_rewrites(apps):
+    """Declarative rules equivalent to app settings that are plain find/replace."""
+    labs = apps.get("google_labs")
+    if not labs or not labs.get("enabled", False):
+        return []
+    mode = labs.get("music_fx_replace", "debug")
+    return [
+        {"host": "labs.google", "path": path, "find": "/fx/music", "replace": f"/fx/music?{mode}"}
+        for path in LABS_MUSIC_PATHS
+    ]
+
+
+def compile_rewrites(rewrites):
+    """Builds one MultiRewriter per (host, path, content type) group."""
+    compiled = {}
+    for group in normalize_rewrites(rewrites):
+        compiled.setdefault(group["host"], []).append(
+            RewriteGroup(group["path"], group["content_type"], MultiRewriter(group["rules"]))
+        )
+    return {host: tuple(groups) for host, groups in compiled.items()}
+
+
+COMPILERS = {
+    "gemini": _compile_gemini,
+    "copilot": _compile_copilot,
+    "google_labs": _compile_google_labs,
+}
+
+
+def compile_rules(rules, version=None):
+    """
+    Turns a rules.json document into the ready-to-use payloads for every
+    enabled app. Runs once per rules version, never per flow.
+    """
+    apps = rules.get("apps", {})
+    compiled = {}
+    for name, compiler in COMPILERS.items():
+        app = apps.get(name)
+        compiled[name] = compiler(app) if app and app.get("enabled", False) else None
+    # ConfigManager writes the built-in rules into "rewrites" itself; older
+    # files without the key get them derived from the app settings here.
+    rewrites = rules["rewrites"] if "rewrites" in rules else builtin_rewrites(apps)
+    return CompiledRules(version=version, rewrites=compile_rewrites(rewrites), **compiled)
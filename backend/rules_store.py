@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from types import MappingProxyType
+
+from rules_compiler import compile_rules
+
+logger = logging.getLogger(__name__)
+
+RULES_PATH = "rules.json"
+
+
+def encode_rules(rules):
+    # rules.json is only read by the addon, so no indentation
+    return json.dumps(rules, separators=(",", ":")).encode()
+
+
+def rules_version(raw):
+    """The version of encoded rules: a short hash of the rules.json bytes."""
+    return hashlib.sha1(raw).hexdigest()[:12]
+
+
+def freeze(value):
+    """Recursively convert dicts/lists into read-only mappings/tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class RulesSnapshot:
+    """
+    An immutable view of one version of rules.json.
+
+    ``version`` is a short content hash, so two processes that loaded the same
+    file agree on it. ``compiled`` holds the per-app payloads built from it.
+    """
+    __slots__ = ("rules", "version", "compiled", "profiles", "clients")
+
+    def __init__(self, rules, version):
+        object.__setattr__(self, "compiled", compile_rules(rules, version))
+        object.__setattr__(self, "rules", freeze(rules))
+        object.__setattr__(self, "version", version)
+
+        # Every profile a client is mapped to is compiled now, so picking a
+        # client's rules per flow is one dict lookup.
+        profiles = {
+            name: RulesSnapshot.from_rules(profile_rules)
+            for name, profile_rules in (rules.get("profiles") or {}).items()
+            if isinstance(profile_rules, dict)
+        }
+        clients = {
+            client: profiles[name]
+            for client, name in (rules.get("clients") or {}).items()
+            if name in profiles
+        }
+        object.__setattr__(self, "profiles", MappingProxyType(profiles))
+        object.__setattr__(self, "clients", MappingProxyType(clients))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RulesSnapshot is immutable")
+
+    def for_client(self, address, username=None):
+        """The snapshot for a client, by proxy-auth username first, then address."""
+        clients = self.clients
+        if not clients:
+            return self
+        if username is not None and username in clients:
+            return clients[username]
+        return clients.get(address, self)
+
+    @classmethod
+    def from_bytes(cls, raw):
+        return cls(json.loads(raw), rules_version(raw))
+
+    @classmethod
+    def from_rules(cls, rules):
+        # Same version as the rules.json these rules would be written to
+        return cls(rules, rules_version(encode_rules(rules)))
+
+
+EMPTY_SNAPSHOT = RulesSnapshot({}, "empty")
+
+
+class RulesStore:
+    """
+    Loads rules.json once and only re-reads it when the file changes.
+
+    The file is stat()ed at most every ``check_interval`` seconds. A change in
+    mtime, size or inode triggers a reload; if the new content fails to parse
+    (e.g. a half-written file) the last good snapshot is kept and the reload
+    is retried on the next check.
+    """
+
+    def __init__(self, path=RULES_PATH, check_interval=0.5):
+        self.path = path
+        self.check_interval = check_interval
+        self.snapshot = EMPTY_SNAPSHOT
+        self._stat_key = None
+        self._next_check = 0.0
+
+    def get(self):
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self.refresh()
+        return self.snapshot
+
+    def refresh(self):
+        """Reloads the rules if the file changed. Returns True on a swap."""
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if self._stat_key != "missing":
+                logger.error(f"Error loading rules: {e}")
+                self._stat_key = "missing"
+            return False
+
+        stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stat_key == self._stat_key:
+            return False
+
+        try:
+            with open(self.path, "rb") as f:
+                snapshot = RulesSnapshot.from_bytes(f.read())
+        except Exception as e:
+            # Leave _stat_key untouched so the next check retries the read.
+            logger.error(f"Error loading rules, keeping version {self.snapshot.version}: {e}")
+            return False
+
+        self._stat_key = stat_key
+        if snapshot.version == self.snapshot.version:
+            return False
+        self.snapshot = snapshot
+        return True
+
+
+class MemoryRulesStore:
+    """
+    A RulesStore fed directly with rule dicts instead of a file, for a proxy
+    running inside the backend process. ``get()`` costs an attribute read.
+    """
+
+    def __init__(self, rules=None):
+        self.snapshot = RulesSnapshot.from_rules(rules) if rules is not None else EMPTY_SNAPSHOT
+
+    def get(self):
+        return self.snapshot
+
+    def publish(self, rules):
+        """Swaps in new rules. Returns True if they differ from the current ones."""
+        snapshot = RulesSnapshot.from_rules(rules)
+        if snapshot.version == self.snapshot.version:
+            return False
+        self.snapshot = snapshot
+        return True
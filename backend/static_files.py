@@ -0,0 +1,164 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # optional; gzip alone is still served
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Vite names everything under assets/ by content hash, so it never changes
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# index.html and other unhashed files: reuse, but only after a (cheap, 304) check
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+MIN_COMPRESS_BYTES = 1024
+COMPRESSIBLE_TYPES = (
+    "text/", "application/javascript", "application/json", "application/manifest+json",
+    "application/xml", "image/svg+xml", "application/wasm",
+)
+# mimetypes depends on the platform's tables (sparse on Termux); pin what the bundle uses
+CONTENT_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+    ".mjs": "text/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".json": "application/json",
+    ".map": "application/json",
+    ".svg": "image/svg+xml",
+    ".webmanifest": "application/manifest+json",
+    ".wasm": "application/wasm",
+    ".woff2": "font/woff2",
+}
+# Preferred first
+ENCODINGS = ("br", "gzip")
+_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def content_type_for(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in CONTENT_TYPES:
+        return CONTENT_TYPES[ext]
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def accepted_encodings(header):
+    """Codings the client accepts (q > 0) from an Accept-Encoding header."""
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _compress(encoding, data):
+    if encoding == "br":
+        # Not 11: this runs at every backend start, on phones too
+        return brotli.compress(data, quality=9) if brotli is not None else None
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+class StaticAsset:
+    """One file of the bundle with every encoding of its body, ready to send."""
+    __slots__ = ("content_type", "cache_control", "etags", "bodies")
+
+    def __init__(self, content_type, cache_control, etag, bodies):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.bodies = bodies
+        # Each encoding is its own representation, so each gets its own strong tag
+        self.etags = {
+            encoding: etag if encoding == "identity" else f'"{etag[1:-1]}-{encoding}"'
+            for encoding in bodies
+        }
+
+    def pick(self, accept_encoding):
+        accepted = accepted_encodings(accept_encoding)
+        for encoding in ENCODINGS:
+            if encoding in self.bodies and encoding in accepted:
+                return encoding
+        return "identity"
+
+
+class FrontendManifest:
+    """
+    The frontend's dist directory, read once into memory.
+
+    Lookups are a dict access instead of path checks against the disk, and
+    every compressible file is held identity, gzip and (if the brotli module
+    is available) brotli encoded. .gz/.br files shipped next to an asset are
+    used as they are; otherwise the variant is made here, once.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.assets = {}
+        self.index = None
+
+    @classmethod
+    def build(cls, root):
+        manifest = cls(root)
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith((".gz", ".br")):
+                    continue
+                path = os.path.join(directory, filename)
+                relative = os.path.relpath(path, root).replace(os.sep, "/")
+                manifest.assets[relative] = manifest._load(path, relative)
+        manifest.index = manifest.assets.get("index.html")
+        logger.info(f"Indexed {len(manifest.assets)} frontend files from {root}")
+        return manifest
+
+    def _load(self, path, relative):
+        with open(path, "rb") as f:
+            data = f.read()
+        content_type = content_type_for(relative)
+        hashed = relative.startswith("assets/")
+        etag = '"' + hashlib.blake2b(data, digest_size=8).hexdigest() + '"'
+        bodies = {"identity": data}
+        if len(data) >= MIN_COMPRESS_BYTES and content_type.startswith(COMPRESSIBLE_TYPES):
+            for encoding in ENCODINGS:
+                if os.path.exists(path + _SUFFIXES[encoding]):
+                    with open(path + _SUFFIXES[encoding], "rb") as f:
+                        body = f.read()
+                else:
+                    body = _compress(encoding, data)
+                if body is not None and len(body) < len(data):
+                    bodies[encoding] = body
+        cache_control = IMMUTABLE_CACHE_CONTROL if hashed else REVALIDATE_CACHE_CONTROL
+        return StaticAsset(content_type, cache_control, etag, bodies)
+
+    def get(self, path):
+        return self.assets.get(path)
+
+    def respond(self, asset, headers):
+        """The response for ``asset`` given the request headers: 304, compressed or plain."""
+        encoding = asset.pick(headers.get("accept-encoding"))
+        etag = asset.etags[encoding]
+        response_headers = {"etag": etag, "cache-control": asset.cache_control}
+        if len(asset.bodies) > 1:
+            response_headers["vary"] = "Accept-Encoding"
+
+        if_none_match = headers.get("if-none-match")
+        if if_none_match:
+            sent = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in sent or not sent.isdisjoint(asset.etags.values()):
+                return Response(status_code=304, headers=response_headers)
+
+        if encoding != "identity":
+            response_headers["content-encoding"] = encoding
+        return Response(asset.bodies[encoding], media_type=asset.content_type, headers=response_headers)
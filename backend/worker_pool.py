@@ -0,0 +1,88 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_TIMEOUT = 5.0
+
+
+class RewritePool:
+    """
+    Runs CPU-heavy rewrites off the event loop on a bounded thread pool.
+
+    At most ``max_inflight`` jobs are handed to the pool at once; the rest wait
+    on a semaphore, which is what ``queue_depth`` and the wait times measure.
+    A job that doesn't finish within ``timeout`` seconds is abandoned and the
+    caller falls back to the unmodified response, so a slow rewrite can never
+    hold a connection hostage.
+
+    Threads rather than processes: flows and rules snapshots would have to be
+    pickled across a process boundary, and zlib/brotli release the GIL for
+    the (de)compression that dominates large rewrites.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_inflight=None, timeout=DEFAULT_TIMEOUT):
+        self.workers = workers
+        self.max_inflight = max_inflight or workers * 2
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="aitweaker-rewrite")
+        self._semaphore = None
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.inflight = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def run(self, fn, *args):
+        """Returns (True, result), or (False, None) on timeout or error."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        queued = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queue_depth -= 1
+        waited = time.perf_counter() - queued
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+        self.inflight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result = await asyncio.wait_for(loop.run_in_executor(self.executor, fn, *args), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return False, None
+        except Exception:
+            self.errors += 1
+            return False, None
+        finally:
+            self.inflight -= 1
+            self._semaphore.release()
+        self.completed += 1
+        return True, result
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        started = self.completed + self.timeouts + self.errors
+        return {
+            "workers": self.workers,
+            "max_inflight": self.max_inflight,
+            "inflight": self.inflight,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "completed": self.completed,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "wait_avg_ms": (self.wait_total / started * 1000) if started else 0.0,
+            "wait_max_ms": self.wait_max * 1000,
+        }
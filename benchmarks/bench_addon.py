@@ -0,0 +1,305 @@
+"""
+Offline benchmark of the AITweaker addon on synthetic mitmproxy flows.
+
+Every scenario builds its flows with mitmproxy's test helpers and drives
+them through the addon's hooks the way mitmproxy would: request,
+responseheaders, then either the streaming callable (chunk by chunk) or
+response. Reported per scenario:
+
+    ns/flow     median wall time through all hooks
+    peak KB     tracemalloc peak above the flow's own footprint, one flow
+
+plus, per handler, the average time from the addon's own metrics and the
+largest tracemalloc peak a single call of it reached in those traced flows.
+
+The rewrite cache is cleared before every flow, so rewrites are measured
+cold; pass --warm to measure cache hits instead.
+
+Results are compared against benchmarks/baseline.json. A scenario slower
+than its baseline by more than --tolerance, or a scenario or handler using
+more peak memory than --mem-tolerance allows, fails the run (exit status 1). Timings only mean
+something on the machine that recorded the baseline: refresh it there with
+--save-baseline.
+
+Run from the repository root:
+
+    python benchmarks/bench_addon.py [--only gemini_bundle] [--number 1.0] [--save-baseline]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from mitmproxy import ctx
+from mitmproxy.test import tflow, tutils
+
+from addon_proxy import NOT_FOUND_TRUE, AITweaker
+from config_manager import DEFAULT_PROFILE
+from copilot_patch import XSSI_PREFIX
+from rewrites import normalize_rewrites
+from rules_compiler import builtin_rewrites, normalize_flags
+from rules_store import MemoryRulesStore
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+STREAM_CHUNK = 64 * 1024
+
+
+class QuietLog:
+    def info(self, txt):
+        pass
+
+    warn = error = debug = info
+
+
+def bench_rules():
+    """Rules as ConfigManager generates them for the default profile, with every app switched on."""
+    gemini = DEFAULT_PROFILE["profiles"]["default"]["apps"]["gemini"]
+    flags, ranges = normalize_flags(gemini["flag_configs"].keys())
+    apps = {
+        "gemini": {"enabled": True, "flags": flags, "flag_ranges": ranges},
+        "copilot": {"enabled": True, "flags": ["feature-new-a", "feature-new-b"], "allow_beta": True},
+        "google_labs": {"enabled": True, "music_fx_replace": "debug", "bypass_not_found": True},
+    }
+    return {"apps": apps, "rewrites": normalize_rewrites(builtin_rewrites(apps))}
+
+
+def make_flow(host, path, content, content_type, status_code=200, encoding=None, headers=None):
+    flow = tflow.tflow(req=tutils.treq(host=host, path=path.encode()), resp=tutils.tresp(status_code=status_code))
+    flow.request.headers["host"] = host
+    flow.response.headers["content-type"] = content_type
+    if encoding:
+        flow.response.headers["content-encoding"] = encoding
+    for name, value in (headers or {}).items():
+        flow.response.headers[name] = value
+    flow.response.content = content
+    return flow
+
+
+def gemini_bundle_body(size_mb):
+    chunk = b'function(a,b){return a.get(b)||_.Bk(a,"45709348")};var c=' + b"x" * 180 + b";\n"
+    return chunk * (size_mb * 1024 * 1024 // len(chunk))
+
+
+def gemini_html_body():
+    head = b"<!doctype html><html lang=en><head><meta charset=utf-8><title>Gemini</title>"
+    filler = b"<script nonce=abc>window.WIZ_global_data={" + b'"k":"v",' * 40000 + b"};</script>"
+    return head + filler + b"</head><body><c-wiz></c-wiz></body></html>"
+
+
+def copilot_body():
+    data = {
+        "allowBeta": False,
+        "features": [f"feature-{i:04d}" for i in range(400)],
+        "conversations": [{"id": f"c{i}", "title": f"Conversation {i}"} for i in range(50)],
+    }
+    return XSSI_PREFIX + json.dumps(data).encode()
+
+
+def labs_chunk_body():
+    return (b'function p(){return fetch("/fx/music")};var q="' + b"y" * 300 + b'";\n') * 2000
+
+
+# What Next.js sends for a getStaticProps page that returned notFound, on its
+# client-side data route (/_next/data/<buildId>/<page>.json)
+LABS_DATA_PATH = "/fx/_next/data/Xk3d9Qf2mYpL7sVb0Rz4T/en/tools/music-fx.json"
+LABS_404_HEADERS = {
+    "cache-control": "private, no-cache, no-store, max-age=0, must-revalidate",
+    "x-nextjs-matched-path": "/tools/music-fx",
+    "vary": "RSC, Next-Router-State-Tree, Next-Router-Prefetch, Accept-Encoding",
+}
+
+
+SCENARIOS = {
+    # name: (flow factory, default number of flows)
+    "gemini_bundle": (lambda: make_flow(
+        "www.gstatic.com", "/_/mss/boq-bard-web/_/js/k=boq.js/m=_b", BUNDLE, "text/javascript", encoding="gzip"), 5),
+    "gemini_html": (lambda: make_flow(
+        "gemini.google.com", "/app", HTML, "text/html; charset=utf-8", encoding="gzip"), 50),
+    "copilot_start": (lambda: make_flow(
+        "copilot.microsoft.com", "/c/api/start", COPILOT, "application/json"), 500),
+    "labs_chunk": (lambda: make_flow(
+        "labs.google", "/fx/_next/static/chunks/pages/index-3f2a.js", LABS_CHUNK, "application/javascript"), 100),
+    "labs_404": (lambda: make_flow(
+        "labs.google", LABS_DATA_PATH, NOT_FOUND_TRUE, "application/json", status_code=404, headers=LABS_404_HEADERS), 1000),
+    "passthrough_image": (lambda: make_flow(
+        "www.gstatic.com", "/images/logo.png", IMAGE, "image/png"), 1000),
+    "passthrough_host": (lambda: make_flow(
+        "example.com", "/", b"<html></html>", "text/html"), 2000),
+}
+
+
+def drive(addon, flow, loop):
+    """Runs one flow through the hooks like mitmproxy does."""
+    addon.request(flow)
+    if flow.response is None:
+        return
+    addon.responseheaders(flow)
+    stream = flow.response.stream
+    if callable(stream):
+        raw = flow.response.raw_content
+        for i in range(0, len(raw), STREAM_CHUNK):
+            stream(raw[i:i + STREAM_CHUNK])
+        stream(b"")
+    elif not stream:
+        loop.run_until_complete(addon.response(flow))
+
+
+class AllocationTracer:
+    """
+    tracemalloc peaks for one traced flow, overall and per handler call.
+
+    reset_peak() is global, so the flow's own peak is carried across the
+    resets done around each handler.
+    """
+
+    def __init__(self):
+        self.base = tracemalloc.get_traced_memory()[0]
+        self.peak = 0
+        self.handlers = {}
+
+    def checkpoint(self):
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1] - self.base)
+
+    def wrap(self, call_handler):
+        def traced(handler, flow):
+            self.checkpoint()
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            call_handler(handler, flow)
+            self.checkpoint()
+            peak = tracemalloc.get_traced_memory()[1] - start
+            name = handler.__name__
+            self.handlers[name] = max(self.handlers.get(name, 0), peak)
+        return traced
+
+
+def run_scenario(addon, loop, factory, number, warm):
+    timings = []
+    for _ in range(number):
+        flow = factory()
+        if not warm:
+            addon.rewrite_cache.clear()
+        started = time.perf_counter_ns()
+        drive(addon, flow, loop)
+        timings.append(time.perf_counter_ns() - started)
+
+    flow = factory()
+    if not warm:
+        addon.rewrite_cache.clear()
+    tracemalloc.start()
+    tracer = AllocationTracer()
+    # Every handler call, inline or on the rewrite pool, goes through call_handler
+    addon.call_handler = tracer.wrap(addon.call_handler)
+    try:
+        drive(addon, flow, loop)
+        tracer.checkpoint()
+    finally:
+        del addon.call_handler
+        tracemalloc.stop()
+    return {
+        "ns_per_flow": int(statistics.median(timings)),
+        "peak_kb": round(tracer.peak / 1024, 1),
+        "handler_peak_kb": {name: round(peak / 1024, 1) for name, peak in sorted(tracer.handlers.items())},
+    }
+
+
+def check(results, baseline, tolerance, mem_tolerance):
+    failures = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result["ns_per_flow"] > base["ns_per_flow"] * (1 + tolerance):
+            failures.append(f"{name}: {result['ns_per_flow']} ns/flow vs baseline {base['ns_per_flow']}")
+        # Small absolute slack: tiny scenarios peak at a few KB of noise
+        if result["peak_kb"] > base["peak_kb"] * (1 + mem_tolerance) + 16:
+            failures.append(f"{name}: peak {result['peak_kb']} KB vs baseline {base['peak_kb']}")
+        for handler, peak in result["handler_peak_kb"].items():
+            base_peak = base.get("handler_peak_kb", {}).get(handler)
+            if base_peak is not None and peak > base_peak * (1 + mem_tolerance) + 16:
+                failures.append(f"{name}: {handler} peak {peak} KB vs baseline {base_peak}")
+    return failures
+
+
+def main():
+    global BUNDLE, HTML, COPILOT, LABS_CHUNK, IMAGE
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", action="append", choices=sorted(SCENARIOS), help="Run only these scenarios.")
+    parser.add_argument("--number", type=float, default=1.0, help="Multiplier for each scenario's flow count.")
+    parser.add_argument("--bundle-mb", type=int, default=8)
+    parser.add_argument("--warm", action="store_true", help="Keep the rewrite cache between flows.")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed slowdown vs baseline (0.5 = 50%%).")
+    parser.add_argument("--mem-tolerance", type=float, default=0.25, help="Allowed peak memory growth vs baseline.")
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    BUNDLE = gemini_bundle_body(args.bundle_mb)
+    HTML = gemini_html_body()
+    COPILOT = copilot_body()
+    LABS_CHUNK = labs_chunk_body()
+    IMAGE = os.urandom(512 * 1024)
+
+    ctx.log = QuietLog()
+    addon = AITweaker(rules_store=MemoryRulesStore(bench_rules()))
+    addon.metrics_file = ""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    results = {}
+    names = args.only or list(SCENARIOS)
+    print(f"{'scenario':<20}{'flows':>7}{'ns/flow':>14}{'peak KB':>12}")
+    try:
+        for name in names:
+            factory, number = SCENARIOS[name]
+            number = max(1, int(number * args.number))
+            result = results[name] = run_scenario(addon, loop, factory, number, args.warm)
+            print(f"{name:<20}{number:>7}{result['ns_per_flow']:>14,}{result['peak_kb']:>12,.1f}")
+    finally:
+        addon.pool.shutdown()
+        loop.close()
+
+    handler_peaks = {}
+    for result in results.values():
+        for handler, peak in result["handler_peak_kb"].items():
+            handler_peaks[handler] = max(handler_peaks.get(handler, 0), peak)
+    print(f"\n{'handler':<26}{'flows':>7}{'avg ns':>14}{'cache hits':>12}{'peak KB':>12}")
+    for handler, stats in sorted(addon.metrics.snapshot()["handlers"].items()):
+        avg = int(stats["seconds"] / stats["flows"] * 1e9) if stats["flows"] else 0
+        peak = f"{handler_peaks[handler]:,.1f}" if handler in handler_peaks else "-"
+        print(f"{handler:<26}{stats['flows']:>7}{avg:>14,}{stats['cache_hits']:>12}{peak:>12}")
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(BASELINE):
+            with open(BASELINE) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nSaved baseline to {BASELINE}")
+        return 0
+
+    if not os.path.exists(BASELINE):
+        print("\nNo baseline yet; record one with --save-baseline.")
+        return 0
+    with open(BASELINE) as f:
+        failures = check(results, json.load(f), args.tolerance, args.mem_tolerance)
+    if failures:
+        print("\nRegressions against baseline:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    print("\nNo regressions against baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Microbenchmark of the Copilot /c/api/start patch: the old always-reserialize
+handler against copilot_patch.patch_start_payload, with and without the
+optional orjson backend, on a realistic start payload.
+
+Run from the repository root:
+
+    python benchmarks/bench_copilot_patch.py [--features 400] [--number 2000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+import copilot_patch
+
+
+def make_payload(n_features):
+    data = {
+        "allowBeta": False,
+        "features": [f"feature-{i:04d}-{'x' * 12}" for i in range(n_features)],
+        "user": {"id": "a" * 32, "locale": "en-US", "region": "US", "tier": "free"},
+        "conversations": [
+            {"id": f"c{i}", "title": f"Conversation {i}", "updatedAt": "2025-01-01T00:00:00Z"}
+            for i in range(50)
+        ],
+        "settings": {f"setting{i}": i % 2 == 0 for i in range(100)},
+    }
+    return b")]}'" + json.dumps(data).encode()
+
+
+def legacy_patch(body, flags, allow_beta):
+    """The handler as it was: always parse, set-union, and usually re-serialize."""
+    content = body.decode()
+    if content.startswith(")]}'"):
+        content = content[4:]
+    data = json.loads(content)
+    modified = False
+    if allow_beta and data.get("allowBeta") != True:
+        data["allowBeta"] = True
+        modified = True
+    if "features" in data and isinstance(data["features"], list):
+        combined = list(set(data["features"]).union(set(flags)))
+        if combined != data["features"]:
+            data["features"] = combined
+            modified = True
+    return json.dumps(data).encode() if modified else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--features", type=int, default=400)
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    body = make_payload(args.features)
+    present = ("feature-0001-xxxxxxxxxxxx", "feature-0002-xxxxxxxxxxxx")
+    scenarios = {
+        "defaults (no flags, no beta)": ((), False),
+        "flags already present": (present, False),
+        "two flags missing + beta": (("new-flag-a", "new-flag-b"), True),
+    }
+
+    backends = [("json", None)]
+    if copilot_patch.orjson is not None:
+        backends.append(("orjson", copilot_patch.orjson))
+    saved = copilot_patch.orjson
+
+    print(f"start payload: {len(body) / 1024:.1f} KB, {args.features} features")
+    print(f"{'scenario':<30}{'legacy':>12}" + "".join(f"{name:>12}" for name, _ in backends))
+    try:
+        for label, (flags, beta) in scenarios.items():
+            legacy = timeit.timeit(lambda: legacy_patch(body, flags, beta), number=args.number) / args.number
+            row = f"{label:<30}{legacy * 1e6:>9.1f} us"
+            for _, module in backends:
+                copilot_patch.orjson = module
+                t = timeit.timeit(lambda: copilot_patch.patch_start_payload(body, flags, beta), number=args.number)
+                row += f"{t / args.number * 1e6:>9.1f} us"
+            print(row)
+    finally:
+        copilot_patch.orjson = saved
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+"""
+End-to-end load test: how many concurrent devices one machine can serve.
+
+Starts a local stand-in upstream that serves recorded-style Gemini,
+gstatic, Copilot and Labs responses over TLS, then the real proxy through
+ProxyManager (mitmdump workers and all), redirected to the stand-in by
+load_redirect.py. Concurrent HTTPS clients, one connection each like
+separate devices, then request a weighted mix through the proxy for
+--duration seconds. Everything stays on 127.0.0.1; nothing goes out.
+
+The same mix is first sent straight to the upstream, so latency is also
+reported as added by the proxy (proxied minus direct, per percentile).
+Proxy RSS and CPU are sampled from /proc, so this runs on Linux only. The
+clients run in this process: if it pins a core while the proxy's CPU is
+well below the workers' share, the generator is the bottleneck, not the
+proxy.
+
+The proxy runs with its own rules file (every app enabled), so the
+backend's rules.json is left alone. Run from the repository root:
+
+    python benchmarks/bench_load.py [--clients 50] [--duration 20] [--workers 1]
+"""
+import argparse
+import asyncio
+import datetime
+import gzip
+import hashlib
+import ipaddress
+import json
+import os
+import random
+import ssl
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+import httpx
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from addon_proxy import NOT_FOUND_TRUE
+from bench_addon import (LABS_404_HEADERS, LABS_DATA_PATH, bench_rules, copilot_body, gemini_bundle_body,
+                         gemini_html_body, labs_chunk_body)
+from metrics import FLUSH_INTERVAL
+from proxy_manager import ProxyManager
+from proxy_workers import free_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.join(os.path.dirname(HERE), "backend")
+HOSTS = ["gemini.google.com", "www.gstatic.com", "copilot.microsoft.com", "labs.google"]
+SAMPLE_INTERVAL = 0.25
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+
+def recorded_responses(bundle_mb):
+    """name -> (weight, host, path, status, headers, body) as the stand-in sends them."""
+    js = {"content-type": "text/javascript", "content-encoding": "gzip", "cache-control": "public, max-age=3600"}
+    html = {"content-type": "text/html; charset=utf-8", "content-encoding": "gzip", "cache-control": "no-cache"}
+    responses = {
+        "gemini_html": (20, "gemini.google.com", "/app", 200, html, gzip.compress(gemini_html_body())),
+        "gemini_bundle": (5, "www.gstatic.com", "/_/mss/boq-bard-web/_/js/k=boq.js/m=_b", 200, js,
+                          gzip.compress(gemini_bundle_body(bundle_mb))),
+        "gstatic_other": (15, "www.gstatic.com", "/images/branding/logo.png", 200,
+                          {"content-type": "image/png"}, os.urandom(32 * 1024)),
+        "copilot_start": (25, "copilot.microsoft.com", "/c/api/start", 200,
+                          {"content-type": "application/json"}, copilot_body()),
+        "labs_chunk": (20, "labs.google", "/fx/_next/static/chunks/pages/index-3f2a.js", 200,
+                       {"content-type": "application/javascript"}, labs_chunk_body()),
+        "labs_404": (15, "labs.google", LABS_DATA_PATH, 404,
+                     {"content-type": "application/json", **LABS_404_HEADERS}, NOT_FOUND_TRUE),
+    }
+    for weight, host, path, status, headers, body in responses.values():
+        headers["etag"] = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+    return responses
+
+
+def self_signed_context(directory):
+    """TLS context for the stand-in upstream, with a throwaway certificate for all HOSTS."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "aitweaker load test upstream")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(hours=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName(
+            [x509.DNSName(h) for h in HOSTS] + [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(directory, "upstream.pem")
+    with open(cert_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_path)
+    return context
+
+
+class StandInUpstream:
+    """A keep-alive HTTP/1.1 server answering by Host header and path from the recorded responses."""
+
+    def __init__(self, responses):
+        self.by_target = {(host, path): (status, headers, body)
+                          for _, host, path, status, headers, body in responses.values()}
+        self.server = None
+        self.port = None
+        self.writers = set()
+
+    async def start(self, context):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0, ssl=context)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        # Kept-alive connections from the proxy would otherwise outlive the server
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                _, target, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                if int(headers.get("content-length", 0)):
+                    await reader.readexactly(int(headers["content-length"]))
+
+                host = headers.get("host", "").split(":")[0]
+                status, response_headers, body = self.by_target.get((host, target), (404, {}, b""))
+                if status == 200 and headers.get("if-none-match") == response_headers.get("etag"):
+                    status, body = 304, b""
+                out = [f"HTTP/1.1 {status} X", f"content-length: {len(body)}"]
+                out += [f"{k}: {v}" for k, v in response_headers.items() if status != 304 or k in ("etag", "cache-control")]
+                writer.write("\r\n".join(out).encode() + b"\r\n\r\n" + body)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError, ValueError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+
+class ProcessSampler:
+    """RSS and CPU time of the proxy processes, read from /proc."""
+
+    def __init__(self, pids_fn):
+        self.pids_fn = pids_fn
+        self.peak_rss = 0
+        self.rss = []
+        self.cpu_start = None
+        self.cpu_end = None
+        self.started = self.ended = 0.0
+
+    @staticmethod
+    def _read(pid):
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / CLK_TCK  # utime + stime
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:")) * 1024
+        return cpu, rss
+
+    def sample(self):
+        cpu = rss = 0
+        for pid in self.pids_fn():
+            try:
+                c, r = self._read(pid)
+            except (OSError, StopIteration):
+                continue
+            cpu += c
+            rss += r
+        return cpu, rss
+
+    async def run(self):
+        self.started = time.monotonic()
+        self.cpu_start, _ = self.sample()
+        try:
+            while True:
+                await asyncio.sleep(SAMPLE_INTERVAL)
+                self.cpu_end, rss = self.sample()
+                self.ended = time.monotonic()
+                self.rss.append(rss)
+                self.peak_rss = max(self.peak_rss, rss)
+        except asyncio.CancelledError:
+            pass
+
+    def cpu_percent(self):
+        if self.cpu_end is None or self.ended <= self.started:
+            return 0.0
+        return 100 * (self.cpu_end - self.cpu_start) / (self.ended - self.started)
+
+
+def request_plan(responses, seed):
+    """An endless weighted sequence of scenario names for one client."""
+    rng = random.Random(seed)
+    names = list(responses)
+    weights = [responses[n][0] for n in names]
+    while True:
+        yield rng.choices(names, weights)[0]
+
+
+async def client_loop(client, base, responses, seed, deadline, results, direct):
+    for name in request_plan(responses, seed):
+        if time.monotonic() >= deadline:
+            return
+        _, host, path, *_ = responses[name]
+        url = f"{base}{path}" if direct else f"https://{host}{path}"
+        headers = {"host": host} if direct else None
+        started = time.perf_counter()
+        try:
+            response = await client.get(url, headers=headers)
+            await response.aread()
+            ok = response.status_code < 500
+            size = len(response.content)
+        except httpx.HTTPError:
+            ok, size = False, 0
+        results.append((name, time.perf_counter() - started, ok, size))
+
+
+async def run_phase(clients, duration, responses, base=None, proxy=None):
+    """Drives ``clients`` concurrent clients for ``duration`` seconds; returns (results, elapsed)."""
+    results = []
+    pool = [httpx.AsyncClient(proxy=proxy, verify=False, timeout=30.0) for _ in range(clients)]
+    try:
+        started = time.monotonic()
+        deadline = started + duration
+        await asyncio.gather(*(
+            client_loop(client, base, responses, i, deadline, results, proxy is None)
+            for i, client in enumerate(pool)
+        ))
+        return results, time.monotonic() - started
+    finally:
+        await asyncio.gather(*(client.aclose() for client in pool))
+
+
+def percentiles(latencies):
+    if len(latencies) < 2:
+        value = latencies[0] if latencies else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+
+def summarize(results):
+    by_name = {}
+    for name, latency, ok, size in results:
+        entry = by_name.setdefault(name, {"latencies": [], "errors": 0, "bytes": 0})
+        entry["latencies"].append(latency)
+        entry["errors"] += not ok
+        entry["bytes"] += size
+    by_name["all"] = {
+        "latencies": [r[1] for r in results],
+        "errors": sum(not r[2] for r in results),
+        "bytes": sum(r[3] for r in results),
+    }
+    return {name: {"requests": len(e["latencies"]), "errors": e["errors"], "bytes": e["bytes"],
+                   "p": percentiles(e["latencies"])} for name, e in by_name.items()}
+
+
+async def wait_for_proxy(manager, timeout=30.0):
+    for worker in manager.pool.workers:
+        if not await worker.wait_healthy(timeout):
+            raise RuntimeError(f"proxy worker on port {worker.port} did not come up")
+
+
+async def run(args):
+    responses = recorded_responses(args.bundle_mb)
+    tmp = tempfile.mkdtemp(prefix="aitweaker-load-")
+    upstream = StandInUpstream(responses)
+    await upstream.start(self_signed_context(tmp))
+
+    rules_file = os.path.join(tmp, "rules.json")
+    with open(rules_file, "w") as f:
+        json.dump(bench_rules(), f)
+
+    port = args.port or free_port()
+    manager = ProxyManager(mode="subprocess", workers=args.workers, extra_args=[
+        "-s", os.path.join(HERE, "load_redirect.py"),
+        "--set", "connection_strategy=lazy",
+        "--set", "ssl_insecure=true",
+        "--set", f"loadtest_upstream=127.0.0.1:{upstream.port}",
+        "--set", f"tweaker_rules_file={rules_file}",
+    ], metrics_file=os.path.join(tmp, "metrics.json"))
+    subscription = manager.logs.subscribe(replay=False)
+    sampler = ProcessSampler(lambda: [w.process.pid for w in manager.pool.workers if w.alive])
+    try:
+        print(f"Direct to upstream: {args.clients} clients for {args.direct_duration}s")
+        direct, _ = await run_phase(args.clients, args.direct_duration, responses,
+                                    base=f"https://127.0.0.1:{upstream.port}")
+
+        await manager.start_proxy(port, allow_hosts=HOSTS)
+        if not manager.is_running:
+            raise RuntimeError("proxy failed to start:\n" + "\n".join(subscription.buffer))
+        await wait_for_proxy(manager)
+        proxy = f"http://127.0.0.1:{port}"
+
+        # Certificate generation and first rewrites are not steady state
+        await run_phase(args.clients, args.warmup, responses, proxy=proxy)
+
+        print(f"Through the proxy: {args.clients} clients for {args.duration}s, {args.workers} worker(s)")
+        sampling = asyncio.create_task(sampler.run())
+        proxied, elapsed = await run_phase(args.clients, args.duration, responses, proxy=proxy)
+        sampling.cancel()
+        await sampling
+        # Let the workers flush their handler counters
+        await asyncio.sleep(FLUSH_INTERVAL * 1.5)
+        handlers = (manager.metrics_snapshot(manager.metrics_file) or {}).get("handlers", {})
+    finally:
+        await manager.stop_proxy()
+        await upstream.stop()
+        manager.logs.unsubscribe(subscription)
+
+    direct_stats = summarize(direct)
+    proxied_stats = summarize(proxied)
+    total = proxied_stats["all"]
+    report = {
+        "clients": args.clients,
+        "workers": args.workers,
+        "duration": elapsed,
+        "throughput_rps": total["requests"] / elapsed,
+        "throughput_mbps": total["bytes"] / elapsed / 1e6,
+        "errors": total["errors"],
+        "proxy_peak_rss_mb": sampler.peak_rss / 1e6,
+        "proxy_cpu_percent": sampler.cpu_percent(),
+        "scenarios": {},
+        "handlers": handlers,
+    }
+
+    print(f"\n{'scenario':<16}{'requests':>9}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'+p50 ms':>9}{'+p95 ms':>9}{'+p99 ms':>9}")
+    for name in list(responses) + ["all"]:
+        stats = proxied_stats.get(name)
+        if not stats:
+            continue
+        base = direct_stats.get(name, {"p": (0.0, 0.0, 0.0)})["p"]
+        added = [max(0.0, p - b) for p, b in zip(stats["p"], base)]
+        report["scenarios"][name] = {
+            "requests": stats["requests"],
+            "errors": stats["errors"],
+            "latency_ms": [round(p * 1000, 2) for p in stats["p"]],
+            "added_ms": [round(a * 1000, 2) for a in added],
+        }
+        print(f"{name:<16}{stats['requests']:>9}{stats['errors']:>8}"
+              + "".join(f"{p * 1000:>9.1f}" for p in stats["p"])
+              + "".join(f"{a * 1000:>9.1f}" for a in added))
+
+    print(f"\n{'handler':<26}{'flows':>8}{'modified':>10}{'errors':>8}")
+    for name, stats in sorted(handlers.items()):
+        print(f"{name:<26}{stats['flows']:>8}{stats['modified']:>10}{stats['errors']:>8}")
+
+    print(f"\nThroughput: {report['throughput_rps']:.0f} req/s, {report['throughput_mbps']:.1f} MB/s")
+    print(f"Proxy: peak RSS {report['proxy_peak_rss_mb']:.0f} MB, CPU {report['proxy_cpu_percent']:.0f}% "
+          f"(100% = one core)")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=50, help="Concurrent clients (one connection each).")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds of load through the proxy.")
+    parser.add_argument("--direct-duration", type=float, default=5.0, help="Seconds of direct load for the baseline.")
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--workers", type=int, default=1, help="Proxy worker processes.")
+    parser.add_argument("--port", type=int, default=0, help="Proxy port (default: a free one).")
+    parser.add_argument("--bundle-mb", type=int, default=6)
+    parser.add_argument("--json", help="Also write the report to this file.")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""
+Peak memory of one rewrite per flow: the old str path (get_text/str.replace/
+set text) against the bytes path the addon uses now.
+
+Each variant runs in its own subprocess so ru_maxrss is not polluted by the
+other. Run from the repository root:
+
+    python benchmarks/bench_rewrite_memory.py [--size-mb 8]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+VARIANTS = ("str-labs", "bytes-labs", "str-gemini", "bytes-gemini")
+
+
+def make_bundle(size_mb):
+    chunk = b'function a(){return "/fx/music"};var b="\xc3\xa9t\xc3\xa9";' + b"x" * 200 + b"\n"
+    return chunk * (size_mb * 1024 * 1024 // len(chunk))
+
+
+def make_flow(body, encoding):
+    from mitmproxy.test import tflow, tutils
+
+    flow = tflow.tflow(req=tutils.treq(host="labs.google"), resp=True)
+    flow.response.headers["content-type"] = "application/javascript; charset=utf-8"
+    if encoding != "identity":
+        flow.response.headers["content-encoding"] = encoding
+    flow.response.content = body
+    return flow
+
+
+def run_variant(variant, size_mb, encoding):
+    from rules_compiler import compile_rules
+
+    compiled = compile_rules({"apps": {
+        "gemini": {"enabled": True, "flags": list(range(45700000, 45700050))},
+        "google_labs": {"enabled": True, "music_fx_replace": "debug"},
+    }})
+    flow = make_flow(make_bundle(size_mb), encoding)
+    injection = compiled.gemini.script_injection
+    # The MusicFX link swap is a built-in declarative rewrite for Labs bundles
+    labs_rewriter = compiled.rewrites["labs.google"][0].rewriter
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+
+    if variant == "str-labs":
+        content = flow.response.get_text()
+        new_content = content.replace("/fx/music", "/fx/music?debug")
+        if content != new_content:
+            flow.response.text = new_content
+    elif variant == "bytes-labs":
+        content = flow.response.content
+        new_content = labs_rewriter.apply(content)
+        if new_content is not content:
+            flow.response.content = new_content
+    elif variant == "str-gemini":
+        flow.response.text = injection.decode() + flow.response.get_text()
+    elif variant == "bytes-gemini":
+        flow.response.content = injection + flow.response.content
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"tracemalloc_peak_mb": peak / 2**20, "rss_growth_mb": (rss_after - rss_before) / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=8)
+    parser.add_argument("--encoding", default="identity", choices=["identity", "gzip", "br"])
+    parser.add_argument("--variant", choices=VARIANTS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        print(json.dumps(run_variant(args.variant, args.size_mb, args.encoding)))
+        return
+
+    print(f"{args.size_mb} MB bundle, {args.encoding}")
+    print(f"{'variant':<14}{'peak (tracemalloc)':>20}{'RSS growth':>14}")
+    for variant in VARIANTS:
+        out = subprocess.run(
+            [sys.executable, __file__, "--variant", variant, "--size-mb", str(args.size_mb), "--encoding", args.encoding],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(out)
+        print(f"{variant:<14}{result['tracemalloc_peak_mb']:>17.1f} MB{result['rss_growth_mb']:>11.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
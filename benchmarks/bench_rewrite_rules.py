@@ -0,0 +1,78 @@
+"""
+How the cost of a declarative rewrite grows with the number of rules:
+MultiRewriter against one bytes.replace per rule, on a script bundle where
+the first two rules match often and the rest never do (the usual case for
+feature switches that only some builds carry).
+
+MultiRewriter should stay roughly flat as literal rules are added; the
+per-rule loop grows linearly. --regex adds that many regex rules on top,
+which are expected to cost a branch each. Run from the repository root:
+
+    python benchmarks/bench_rewrite_rules.py [--size-mb 7] [--rules 2 10 50 200]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from rewrites import MultiRewriter
+
+
+def make_bundle(size_mb):
+    chunk = (b'function a(){return "/fx/music"};var b=_.Bk(a,"45709348")||isBeta===false;'
+             b'const c={enabled:!1,flag:"x"};' + b"x" * 60 + b"\n")
+    return chunk * (size_mb * 1024 * 1024 // len(chunk))
+
+
+def make_rules(count, regex):
+    rules = [
+        {"find": "/fx/music", "replace": "/fx/music?debug"},
+        {"find": "isBeta===false", "replace": "isBeta===true"},
+    ]
+    rules += [{"find": f"feature{i}Enabled=!1", "replace": f"feature{i}Enabled=!0"} for i in range(count - 2)]
+    rules = rules[:count]
+    rules += [{"find": rf"flag{i}:\"(\w+)\"", "replace": rf"flag{i}:\"\1-on\"", "regex": True} for i in range(regex)]
+    return rules
+
+
+def per_rule_loop(rules, data):
+    for rule in rules:
+        data = data.replace(rule["find"].encode(), rule["replace"].encode())
+    return data
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=7)
+    parser.add_argument("--rules", type=int, nargs="+", default=[2, 10, 50, 200])
+    parser.add_argument("--regex", type=int, default=0, help="Regex rules added to each run.")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    body = make_bundle(args.size_mb)
+    print(f"{len(body) / 2**20:.1f} MB bundle, {args.regex} regex rules")
+    print(f"{'rules':>6}{'MultiRewriter':>16}{'per-rule loop':>16}")
+    for count in args.rules:
+        rules = make_rules(count, args.regex)
+        rewriter = MultiRewriter(rules)
+        multi = best_of(args.repeat, lambda: rewriter.apply(body))
+        if args.regex:
+            loop = "-"
+        else:
+            loop = f"{best_of(args.repeat, lambda: per_rule_loop(rules, body)) * 1000:>13.0f} ms"
+        print(f"{count:>6}{multi * 1000:>13.0f} ms{loop:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+mitmproxy script used by bench_load.py: sends every request to the local
+stand-in upstream instead of the real host, keeping the Host header so the
+addon still routes on the original hostname.
+
+Needs --set connection_strategy=lazy, so no connection to the real host is
+attempted before the request is redirected, and --set ssl_insecure=true for
+the stand-in's self-signed certificate.
+"""
+from mitmproxy import ctx
+
+
+class Redirect:
+    def load(self, loader):
+        loader.add_option(
+            name="loadtest_upstream",
+            typespec=str,
+            default="",
+            help="host:port of the stand-in upstream.",
+        )
+
+    def request(self, flow):
+        if not ctx.options.loadtest_upstream or flow.response is not None:
+            # Answered locally (e.g. a 304 from the addon)
+            return
+        host, port = ctx.options.loadtest_upstream.rsplit(":", 1)
+        original = flow.request.host_header
+        flow.request.host = host
+        flow.request.port = int(port)
+        flow.request.host_header = original
+
+
+addons = [Redirect()]
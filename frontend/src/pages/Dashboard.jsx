@@ -12,9 +12,26 @@ export default function Dashboard() {
   const logContainerRef = useRef(null);
 
   useEffect(() => {
-    fetchStatus();
-    const interval = setInterval(fetchStatus, 5000);
-    return () => clearInterval(interval);
+    // Status is pushed on /ws/events (current state on connect, then changes)
+    let ws;
+    let retry;
+    let closed = false;
+    const connect = () => {
+      ws = new WebSocket(`${API_URL.replace('http', 'ws')}/ws/events`);
+      ws.onmessage = (event) => {
+        const message = JSON.parse(event.data);
+        if (message.type === 'status') setStatus(message.data);
+      };
+      ws.onclose = () => {
+        if (!closed) retry = setTimeout(connect, 2000);
+      };
+    };
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(retry);
+      ws.close();
+    };
   }, []);
 
   useEffect(() => {
@@ -22,7 +39,9 @@ export default function Dashboard() {
     const ws = new WebSocket(`${API_URL.replace('http', 'ws')}/ws/logs`);
 
     ws.onmessage = (event) => {
-      setLogs((prev) => [...prev.slice(-100), event.data]); // Keep last 100 logs
+      // Each frame is a batch of newline-separated lines
+      const lines = event.data.split('\n');
+      setLogs((prev) => [...prev, ...lines].slice(-100)); // Keep last 100 logs
     };
 
     return () => ws.close();
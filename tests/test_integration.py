@@ -113,7 +113,7 @@ def test_proxy_rules_generation():
 def test_addon_proxy_logic():
     """Test the addon proxy logic (unit test)."""
     from backend.addon_proxy import AITweaker
-    from mitmproxy.http import HTTPFlow
+    from mitmproxy.test import tflow, tutils
     from mitmproxy import ctx
     from unittest.mock import MagicMock
 
@@ -132,26 +132,887 @@ def test_addon_proxy_logic():
         }
     }
 
-    # Mock Flow
-    # We need to properly mock attributes for mitmproxy Flow objects
-    flow = MagicMock()
-
-    # Mock request
-    request_mock = MagicMock()
-    request_mock.url = "https://www.gstatic.com/some/path/m=_b"
-    flow.request = request_mock
-
-    # Mock response
-    response_mock = MagicMock()
-    response_mock.get_text.return_value = "original code;"
-    flow.response = response_mock
+    # Test flow for a gstatic bundle
+    flow = tflow.tflow(
+        req=tutils.treq(host="www.gstatic.com", path=b"/some/path/m=_b"),
+        resp=tutils.tresp(content=b"original code;")
+    )
 
     # Run modification
     addon.modify_gemini_script(flow)
 
     # Check injection
-    # We verify that we set flow.response.text
-    assert flow.response.text is not None
     injected_text = flow.response.text
-    assert 'const ext_flags = ["12345"]' in injected_text
+    assert 'const ext_ids = new Set([12345])' in injected_text
     assert 'self.getFlag = function' in injected_text
+    assert injected_text.endswith("original code;")
+
+def test_rules_store_reloads_only_on_change(tmp_path):
+    """Test that the rules snapshot is reused until rules.json changes, and survives a bad write."""
+    from backend.rules_store import RulesStore
+
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"apps": {"gemini": {"enabled": True, "flags": [1]}}}))
+
+    store = RulesStore(str(path), check_interval=0)
+    first = store.get()
+    assert first.rules["apps"]["gemini"]["flags"] == (1,)
+    assert store.get() is first
+
+    # A half-written file keeps the last good snapshot
+    path.write_text('{"apps": {"gemini"')
+    assert store.get() is first
+
+    path.write_text(json.dumps({"apps": {"gemini": {"enabled": True, "flags": [2]}}}))
+    second = store.get()
+    assert second is not first
+    assert second.version != first.version
+    assert second.rules["apps"]["gemini"]["flags"] == (2,)
+
+def test_addon_routing_table():
+    """Test that flows are dispatched by host, path prefix and content-type."""
+    from backend.addon_proxy import AITweaker
+
+    addon = AITweaker()
+    router = addon.router
+
+    def names(hook, host, path, content_type=""):
+        return [h.__name__ for h in router.match(hook, host, path, content_type)]
+
+    assert names("response", "www.gstatic.com", "/_/mss/boq-bard-web/_/js/k=x/m=_b?wli=1") == ["modify_gemini_script"]
+    assert names("response", "www.gstatic.com", "/images/logo.png") == []
+    assert names("response", "gemini.google.com", "/app/123", "text/html; charset=utf-8") == ["modify_gemini_html"]
+    assert names("response", "gemini.google.com", "/", "text/html") == ["modify_gemini_html"]
+    assert names("response", "gemini.google.com", "/app", "application/json") == []
+    assert names("response", "copilot.microsoft.com", "/c/api/start?x=1") == ["modify_copilot_response"]
+    assert names("response", "labs.google", "/fx/_next/data/abc/fx/music.json") == ["bypass_data_not_found"]
+    assert names("response", "labs.google", "/fx/_next/data/abc/fx/music.json", "application/json") == [
+        "modify_json_response", "bypass_data_not_found"]
+    assert names("response", "labs.google", "/_next/image", "image/webp") == []
+    assert names("request", "labs.google", "/fx/_next/data/abc/fx/music.json") == ["upgrade_head_request"]
+    assert names("response", "example.com", "/app") == []
+
+def test_addon_streams_untouched_responses():
+    """Test that responseheaders streams everything no enabled rule could rewrite."""
+    from backend.addon_proxy import AITweaker
+    from mitmproxy.test import tflow, tutils
+
+    addon = AITweaker()
+    addon.rules = {"apps": {"gemini": {"enabled": True, "flags": [1]}, "copilot": {"enabled": False}}}
+    addon.load_rules = lambda: None
+
+    def headers_flow(host, path, **headers):
+        flow = tflow.tflow(req=tutils.treq(host=host, path=path.encode()), resp=tutils.tresp(content=None))
+        flow.request.headers["host"] = host
+        flow.response.headers.clear()
+        for k, v in headers.items():
+            flow.response.headers[k.replace("_", "-")] = v
+        addon.responseheaders(flow)
+        return flow.response.stream
+
+    assert headers_flow("video.example.com", "/big.mp4", content_type="video/mp4") is True
+    assert headers_flow("www.gstatic.com", "/js/m=_b", content_length="1000") is False
+    # Matched host, but the body is above the size cap
+    addon.max_body_bytes = 500
+    assert headers_flow("www.gstatic.com", "/js/m=_b", content_length="1000") is True
+    # Matched route whose app is disabled
+    assert headers_flow("copilot.microsoft.com", "/c/api/start") is True
+
+    # Labs: only JSON and page data are rewritable, and only with the bypass on
+    addon.max_body_bytes = 32 * 1024 * 1024
+    addon.rules = {"apps": {"google_labs": {"enabled": True, "bypass_not_found": False}}}
+    assert headers_flow("labs.google", "/fx/api/session", content_type="application/json") is True
+    addon.rules = {"apps": {"google_labs": {"enabled": True, "bypass_not_found": True}}}
+    assert headers_flow("labs.google", "/fx/api/session", content_type="application/json") is False
+    assert headers_flow("labs.google", "/fx/_next/data/b/music.json", content_type="text/plain") is False
+    assert headers_flow("labs.google", "/_next/image", content_type="image/webp") is True
+    assert headers_flow("labs.google", "/fx/clip.mp4", content_type="video/mp4") is True
+
+def test_intercept_hosts_follow_enabled_apps():
+    """Test that only hosts of enabled apps are intercepted, and every route is covered."""
+    from backend.addon_proxy import AITweaker
+    from backend.routing import APP_HOSTS
+
+    cm = ConfigManager()
+    assert set(cm.get_intercept_hosts()) == {
+        "gemini.google.com", "www.gstatic.com", "copilot.microsoft.com", "labs.google"
+    }
+
+    response = client.post("/config", json={"updates": {"apps": {
+        "gemini": {"enabled": True},
+        "copilot": {"enabled": False}
+    }}})
+    assert response.status_code == 200
+    with open(RULES_FILE, 'r') as f:
+        rules = json.load(f)
+    assert "copilot.microsoft.com" not in rules["intercept_hosts"]
+    assert "gemini.google.com" in rules["intercept_hosts"]
+
+    for r in AITweaker().router.routes:
+        assert r.host in APP_HOSTS[r.app]
+
+    # A Labs entry without "enabled" is off for the addon, so it isn't intercepted either
+    assert "labs.google" not in cm.profile_intercept_hosts({"apps": {"google_labs": {"bypass_not_found": True}}})
+
+def test_rewrite_cache_reuses_encoded_body():
+    """Test that a repeat fetch of the same bundle is served from the rewrite cache."""
+    from backend.addon_proxy import AITweaker
+    from mitmproxy.test import tflow, tutils
+    from mitmproxy import ctx
+    from unittest.mock import MagicMock
+
+    ctx.log = MagicMock()
+    addon = AITweaker()
+    addon.rules = {"apps": {"gemini": {"enabled": True, "flags": [12345]}}}
+
+    def fetch():
+        flow = tflow.tflow(req=tutils.treq(host="www.gstatic.com", path=b"/js/m=_b"), resp=True)
+        flow.response.headers["content-encoding"] = "gzip"
+        flow.response.content = b"original code;" * 100
+        addon.modify_gemini_script(flow)
+        return flow.response
+
+    first = fetch()
+    second = fetch()
+    assert addon.rewrite_cache.stats()["misses"] == 1
+    assert addon.rewrite_cache.stats()["hits"] == 1
+    assert second.raw_content == first.raw_content
+    assert second.headers["content-length"] == str(len(second.raw_content))
+    assert b"12345" in second.content
+
+    # A new rules version must not reuse the old rewrite
+    addon.rules = {"apps": {"gemini": {"enabled": True, "flags": [67890]}}}
+    assert b"67890" in fetch().content
+    assert addon.rewrite_cache.stats()["misses"] == 2
+
+def test_compile_rules_payloads():
+    """Test that rules compile once into spliceable payloads tagged with the rules version."""
+    from backend.rules_compiler import compile_rules
+
+    compiled = compile_rules({
+        "apps": {
+            "gemini": {"enabled": True, "flags": [1, 2]},
+            "copilot": {"enabled": False, "flags": ["x"]},
+            "google_labs": {"enabled": True, "music_fx_replace": "debug"}
+        }
+    }, version="v1")
+
+    assert compiled.version == "v1"
+    assert compiled.copilot is None
+    assert isinstance(compiled.gemini.script_injection, bytes)
+    assert b"[1, 2]" in compiled.gemini.shim_js
+    assert compiled.gemini.html_injection == f'<script src="{compiled.gemini.shim_path}"></script>'.encode()
+    assert compiled.rewrites["labs.google"][0].rewriter.apply(b'"/fx/music"') == b'"/fx/music?debug"'
+
+def test_flag_ranges_are_merged():
+    """Test that "a-b" flag IDs become merged numeric ranges and covered IDs are folded in."""
+    from backend.rules_compiler import normalize_flags
+
+    flags, ranges = normalize_flags(["10-20", "15-30", "31-35", "25", "40", "x", "9-3", "abc-def"])
+    assert ranges == [[10, 35]]
+    assert flags == [40, "x"]
+
+    cm = ConfigManager()
+    cm.update_active_profile({"apps": {"gemini": {"flag_configs": {"45000000-45000100": {"enabled": True}}}}})
+    with open(RULES_FILE, 'r') as f:
+        gemini = json.load(f)["apps"]["gemini"]
+    assert [45000000, 45000100] in gemini["flag_ranges"]
+    assert all(isinstance(f, int) for f in gemini["flags"])
+
+def test_streaming_html_injector_handles_split_tags():
+    """Test that the HTML injector finds a <head ...> tag split across chunks, including gzip bodies."""
+    import gzip
+    from backend.html_injector import HtmlInjector
+
+    page = b'<!doctype html><html><header></header><head lang="en"><title>x</title></head><body></body></html>'
+    expected = page.replace(b'<head lang="en">', b'<head lang="en"><script>S</script>')
+
+    for size in (1, 3, 7, 64):
+        injector = HtmlInjector(b"<script>S</script>")
+        out = b"".join(b"".join(injector(page[i:i + size])) for i in range(0, len(page), size))
+        out += b"".join(injector(b""))
+        assert out == expected
+
+    injector = HtmlInjector(b"<script>S</script>", "gzip")
+    compressed = gzip.compress(page)
+    out = b"".join(b"".join(injector(compressed[i:i + 10])) for i in range(0, len(compressed), 10))
+    out += b"".join(injector(b""))
+    assert out == expected
+
+    # No head/body tag at all: appended at the end
+    injector = HtmlInjector(b"<s>")
+    assert b"".join(injector(b"<p>hi</p>") + injector(b"")) == b"<p>hi</p><s>"
+
+def test_large_rewrites_run_on_pool():
+    """Test that big bodies are rewritten on the worker pool, and a timeout passes them through."""
+    import asyncio
+    import time
+    from backend.addon_proxy import AITweaker
+    from backend.worker_pool import RewritePool
+    from mitmproxy.test import tflow, tutils
+    from mitmproxy import ctx
+    from unittest.mock import MagicMock
+
+    ctx.log = MagicMock()
+    addon = AITweaker()
+    addon.rules = {"apps": {"gemini": {"enabled": True, "flags": [7]}}}
+    addon.load_rules = lambda: None
+    body = b"x" * (256 * 1024)
+
+    def bundle_flow():
+        flow = tflow.tflow(req=tutils.treq(host="www.gstatic.com", path=b"/js/m=_b"), resp=True)
+        flow.request.headers["host"] = "www.gstatic.com"
+        flow.response.content = body
+        return flow
+
+    flow = bundle_flow()
+    asyncio.run(addon.response(flow))
+    assert flow.response.content.endswith(body)
+    assert b"new Set([7])" in flow.response.content
+    assert addon.pool.stats()["completed"] == 1
+
+    addon.pool = RewritePool(workers=1, timeout=0.01)
+    addon.run_handlers = lambda handlers, f: time.sleep(0.2)
+    flow = bundle_flow()
+    asyncio.run(addon.response(flow))
+    assert flow.response.content == body
+    assert addon.pool.stats()["timeouts"] == 1
+
+def test_copilot_patch_keeps_order_and_prefix():
+    """Test that the Copilot patcher appends only missing flags, keeps the XSSI prefix and skips no-ops."""
+    from backend.copilot_patch import patch_start_payload, loads
+
+    body = b""")]}'{"allowBeta": true, "features": ["b", "a", "c"]}"""
+
+    assert patch_start_payload(body, (), False) is None
+    assert patch_start_payload(body, ("a", "c"), True) is None
+
+    patched = patch_start_payload(body, ("c", "d"), False)
+    assert patched.startswith(b")]}'")
+    data = loads(patched[4:])
+    assert data["features"] == ["b", "a", "c", "d"]
+    assert data["allowBeta"] is True
+
+    patched = patch_start_payload(b'{"allowBeta": false, "features": []}', (), True)
+    assert loads(patched) == {"allowBeta": True, "features": []}
+
+    # The prefix's line break comes back too, for clients that drop the first line
+    patched = patch_start_payload(b')]}\'\n{"allowBeta": false}', (), True)
+    assert patched.startswith(b")]}'\n{")
+    assert loads(patched.split(b"\n", 1)[1]) == {"allowBeta": True}
+
+def test_declarative_rewrites_single_pass():
+    """Test that literal and regex rewrite rules from the profile are applied in one pass."""
+    from backend.addon_proxy import AITweaker
+    from backend.rewrites import MultiRewriter, literal_trie_pattern
+    from mitmproxy.test import tflow, tutils
+    from mitmproxy import ctx
+    from unittest.mock import MagicMock
+
+    rewriter = MultiRewriter([
+        {"find": "foo", "replace": "bar"},
+        {"find": "bar", "replace": "foo"},
+        {"find": r"v(\d+)", "replace": r"version-\1", "regex": True},
+    ])
+    # Swapping proves a single pass: a second pass would undo the first rule
+    assert rewriter.apply(b"foo bar v12") == b"bar foo version-12"
+    unchanged = b"nothing here"
+    assert rewriter.apply(unchanged) is unchanged
+    # Literals share one trie-shaped pattern; of two overlapping ones, the first listed wins
+    assert literal_trie_pattern([b"foobar", b"foo", b"foobaz"]) == b"foo(?:ba(?:r|z)|)"
+    assert MultiRewriter([{"find": "foo", "replace": "1"}, {"find": "foobar", "replace": "2"}]).apply(b"foobar") == b"1bar"
+    assert MultiRewriter([{"find": "foobar", "replace": "2"}, {"find": "foo", "replace": "1"}]).apply(b"foobar") == b"2"
+
+    cm = ConfigManager()
+    cm.update_active_profile({
+        "apps": {"google_labs": {"enabled": True, "music_fx_replace": "debug"}},
+        "rewrites": [
+            {"host": "example.org", "path": "/js/", "find": "isBeta=false", "replace": "isBeta=true"},
+            {"host": "example.org", "path": "/js/", "find": "(", "regex": True}
+        ]
+    })
+    with open(RULES_FILE, 'r') as f:
+        rules = json.load(f)
+    # The invalid regex is dropped, the built-in Labs rewrite is declarative too
+    assert {"host": "example.org", "path": "/js/", "content_type": "",
+            "rules": [{"find": "isBeta=false", "replace": "isBeta=true", "regex": False}]} in rules["rewrites"]
+    assert any(g["host"] == "labs.google" for g in rules["rewrites"])
+    assert "example.org" in rules["intercept_hosts"]
+
+    ctx.log = MagicMock()
+    addon = AITweaker()
+    addon.rules = rules
+    def rewrite(path):
+        flow = tflow.tflow(req=tutils.treq(host="example.org", path=path), resp=True)
+        flow.request.headers["host"] = "example.org"
+        flow.response.content = b"var isBeta=false;"
+        addon.apply_rewrites(flow)
+        return flow.response.content
+
+    assert rewrite(b"/js/app.js") == b"var isBeta=true;"
+    # Same body, no ETag, outside the group's path: not served the cached rewrite
+    assert rewrite(b"/other/app.js") == b"var isBeta=false;"
+
+
+def test_rewritten_responses_revalidate_by_rules_version():
+    """Test that rewritten assets carry the rules version in their ETag and revalidate cheaply."""
+    import asyncio
+    from backend.addon_proxy import AITweaker
+    from mitmproxy.test import tflow, tutils
+    from mitmproxy import ctx
+    from unittest.mock import MagicMock
+
+    ctx.log = MagicMock()
+    addon = AITweaker()
+    addon.rules = {"apps": {"gemini": {"enabled": True, "flags": [1]}}}
+    addon.load_rules = lambda: None
+
+    def bundle_flow(if_none_match=None):
+        flow = tflow.tflow(req=tutils.treq(host="www.gstatic.com", path=b"/js/m=_b"), resp=True)
+        flow.request.headers["host"] = "www.gstatic.com"
+        if if_none_match:
+            flow.request.headers["if-none-match"] = if_none_match
+        flow.response.headers["etag"] = '"v1"'
+        flow.response.headers["cache-control"] = "public, max-age=31536000, immutable"
+        flow.response.headers["content-type"] = "text/javascript"
+        flow.response.content = b"code;"
+        return flow
+
+    flow = bundle_flow()
+    asyncio.run(addon.response(flow))
+    etag = flow.response.headers["etag"]
+    assert etag == f'"v1-tw{addon.snapshot.version}"'
+    assert flow.response.headers["cache-control"] == "private, no-cache"
+
+    # Same rules, upstream still fresh: answered locally
+    flow = bundle_flow(etag)
+    addon.request(flow)
+    assert flow.response.status_code == 304
+    assert flow.response.headers["etag"] == etag
+
+    # Rules changed: the old tag is dropped and the full body refetched
+    addon.rules = {"apps": {"gemini": {"enabled": True, "flags": [2]}}}
+    flow = bundle_flow(etag)
+    flow.response = None
+    addon.request(flow)
+    assert flow.response is None
+    assert "if-none-match" not in flow.request.headers
+
+    # Current tag but unknown freshness: forwarded without the suffix, 304 re-tagged
+    addon.validators.entries.clear()
+    current = f'"v1-tw{addon.snapshot.version}"'
+    flow = bundle_flow(current)
+    flow.response = None
+    addon.request(flow)
+    assert flow.request.headers["if-none-match"] == '"v1"'
+    flow.response = tutils.tresp(status_code=304, content=b"", headers=((b"etag", b'"v1"'),))
+    addon.responseheaders(flow)
+    assert flow.response.headers["etag"] == current
+    assert addon.validators.stats()["upstream_304s"] == 1
+
+    # API payloads keep upstream's policy and get no validator of ours
+    addon.rules = {"apps": {"copilot": {"enabled": True, "flags": ["x"]}}}
+    flow = tflow.tflow(req=tutils.treq(host="copilot.microsoft.com", path=b"/c/api/start"), resp=True)
+    flow.request.headers["host"] = "copilot.microsoft.com"
+    flow.response.headers["content-type"] = "application/json"
+    flow.response.headers["cache-control"] = "no-store"
+    flow.response.headers["etag"] = '"c1"'
+    flow.response.content = b'{"features":[]}'
+    asyncio.run(addon.response(flow))
+    assert b'"x"' in flow.response.content
+    assert flow.response.headers["cache-control"] == "no-store"
+    assert "etag" not in flow.response.headers
+
+    # Only validators we made up are withheld from upstream
+    from backend.http_cache import is_synthetic, synthetic_etag
+    assert is_synthetic(synthetic_etag(b"code;"))
+    assert not is_synthetic('"h123"')
+
+
+def test_handler_metrics_exported(tmp_path, monkeypatch):
+    """Test that handler counters and latencies reach the Prometheus /metrics route."""
+    import backend.main
+    from backend.addon_proxy import AITweaker
+    from mitmproxy.test import tflow, tutils
+    from mitmproxy import ctx
+    from unittest.mock import MagicMock
+
+    ctx.log = MagicMock()
+    addon = AITweaker()
+    addon.rules = {"apps": {"gemini": {"enabled": True, "flags": [1]}}}
+    addon.metrics_file = str(tmp_path / "metrics.json")
+
+    for _ in range(2):
+        flow = tflow.tflow(req=tutils.treq(host="www.gstatic.com", path=b"/js/m=_b"), resp=True)
+        flow.response.content = b"code;"
+        addon.run_handlers([addon.modify_gemini_script], flow)
+    addon.write_metrics()
+
+    stats = addon.metrics.snapshot()["handlers"]["modify_gemini_script"]
+    assert stats["flows"] == 2 and stats["modified"] == 2 and stats["cache_hits"] == 1
+    assert stats["bytes_out"] > stats["bytes_in"] == 10
+
+    monkeypatch.setattr(backend.main, "METRICS_FILE", addon.metrics_file)
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.text
+    assert 'aitweaker_handler_flows_total{handler="modify_gemini_script"} 2' in body
+    assert 'aitweaker_handler_duration_seconds_count{handler="modify_gemini_script"} 2' in body
+    assert "aitweaker_cache_hits 1" in body
+
+    # Nothing new: the file is only touched, which the worker pool reads as a heartbeat
+    os.utime(addon.metrics_file, (0, 0))
+    written = open(addon.metrics_file).read()
+    addon.heartbeat()
+    assert os.stat(addon.metrics_file).st_mtime > 0
+    assert open(addon.metrics_file).read() == written
+
+
+def test_worker_snapshots_merge_gauges_by_kind():
+    """Test that merged worker gauges sum counts, keep high-water marks and weight averages by jobs."""
+    from backend.metrics import merge_snapshots
+
+    merged = merge_snapshots([
+        {"time": 5, "gauges": {"pool": {"completed": 9, "errors": 1, "wait_avg_ms": 2.0, "wait_max_ms": 30, "max_queue_depth": 4}}},
+        {"time": 3, "gauges": {"pool": {"completed": 30, "wait_avg_ms": 10.0, "wait_max_ms": 50, "max_queue_depth": 1}}},
+        None,
+    ])
+    pool = merged["gauges"]["pool"]
+    assert merged["time"] == 3
+    assert pool["completed"] == 39 and pool["errors"] == 1
+    assert pool["wait_max_ms"] == 50 and pool["max_queue_depth"] == 4
+    assert pool["wait_avg_ms"] == pytest.approx((2.0 * 10 + 10.0 * 30) / 40)
+
+
+def test_log_bus_fans_out_with_bounded_memory():
+    """Test that every log subscriber gets every line, with history replay and drop counting."""
+    import asyncio
+    import threading
+    from backend.log_bus import LogBus
+
+    async def scenario():
+        bus = LogBus(history=3, subscriber_buffer=4)
+        for i in range(5):
+            bus.publish(f"old {i}")
+        first = bus.subscribe()
+        second = bus.subscribe(replay=False)
+        assert await first.get_batch() == ["old 2", "old 3", "old 4"]
+
+        # Lines from reader threads arrive in one scheduled flush
+        loop = asyncio.get_running_loop()
+        t = threading.Thread(target=lambda: [bus.publish_threadsafe(f"line {i}", loop) for i in range(3)])
+        t.start()
+        t.join()
+        assert await first.get_batch() == await second.get_batch() == ["line 0", "line 1", "line 2"]
+
+        # A subscriber that stops reading only loses its own oldest lines
+        for i in range(6):
+            bus.publish(f"burst {i}")
+        assert await second.get_batch() == ["burst 2", "burst 3", "burst 4", "burst 5"]
+        assert second.dropped == 2
+        assert len(bus.history) == 3
+
+        bus.unsubscribe(first)
+        bus.publish("after")
+        assert "after" not in first.buffer and len(bus.subscribers) == 1
+
+    asyncio.run(scenario())
+
+
+def test_in_process_proxy_takes_pushed_rules():
+    """Test that the embedded proxy rewrites traffic and applies pushed rules without a restart."""
+    import asyncio
+    import socket
+    import threading
+    import httpx
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from backend.proxy_manager import ProxyManager
+    from backend.rewrites import normalize_rewrites
+    from backend.routing import host_patterns
+
+    class Upstream(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = b"hello world"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    upstream = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    def rules(replace):
+        return {"apps": {}, "rewrites": normalize_rewrites([{"host": "127.0.0.1", "find": "hello", "replace": replace}])}
+
+    async def scenario():
+        import logging
+        root = logging.getLogger()
+        root_level = root.level
+        root.setLevel(logging.WARNING)
+        manager = ProxyManager(mode="inprocess")
+        logs = manager.logs.subscribe()
+        await manager.start_proxy(port, rules=rules("bye"))
+        assert manager.is_running
+        url = f"http://127.0.0.1:{upstream.server_address[1]}/"
+        try:
+            async with httpx.AsyncClient(proxy=f"http://127.0.0.1:{port}") as client:
+                assert (await client.get(url)).text == "bye world"
+                manager.update_rules({**rules("ciao"), "intercept_hosts": ["127.0.0.1"]})
+                # Interception follows at once, without waiting for a flow
+                assert manager.inprocess.master.options.allow_hosts == host_patterns(["127.0.0.1"])
+                assert (await client.get(url)).text == "ciao world"
+            snapshot = manager.metrics_snapshot("missing.json")
+            assert snapshot["handlers"]["apply_rewrites"]["modified"] == 2
+        finally:
+            await manager.stop_proxy()
+            upstream.shutdown()
+        assert not manager.is_running
+        # The backend's own logging is back as it was
+        assert root.level == logging.WARNING
+        root.setLevel(root_level)
+        lines = await logs.get_batch()
+        assert any("Applied rewrite rules" in line for line in lines)
+
+    asyncio.run(scenario())
+
+
+def test_worker_pool_supervises_and_balances(monkeypatch, tmp_path):
+    """Test that proxy workers sit behind one port, get restarted after a crash or a stall and roll over one by one."""
+    import asyncio
+    import signal
+    import sys
+    import backend.proxy_workers as proxy_workers
+    from backend.log_bus import LogBus
+
+    monkeypatch.setattr(proxy_workers, "HEALTH_INTERVAL", 0.05)
+    monkeypatch.setattr(proxy_workers, "MIN_UPTIME", 0)
+    monkeypatch.setattr(proxy_workers, "HEARTBEAT_TIMEOUT", 0.5)
+    # Stand-in for mitmdump: answers each connection with its worker index and
+    # bumps its heartbeat file like the addon's metrics flush
+    script = (
+        "import asyncio, os, sys\n"
+        "async def beat():\n"
+        "    while True:\n"
+        "        open(sys.argv[3], 'a').close(); os.utime(sys.argv[3]); await asyncio.sleep(0.05)\n"
+        "async def handle(r, w):\n"
+        "    await r.read(1)\n"
+        "    w.write(sys.argv[2].encode()); await w.drain(); w.close()\n"
+        "async def main():\n"
+        "    server = await asyncio.start_server(handle, '127.0.0.1', int(sys.argv[1]))\n"
+        "    print(f'HTTP(S) proxy listening at *:{sys.argv[1]}.', flush=True)\n"
+        "    asyncio.ensure_future(beat())\n"
+        "    await server.serve_forever()\n"
+        "asyncio.run(main())\n"
+    )
+
+    async def ask(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"?")
+        await writer.drain()
+        answer = await reader.read()
+        writer.close()
+        return answer
+
+    async def until(predicate):
+        for _ in range(200):
+            if predicate():
+                return
+            await asyncio.sleep(0.05)
+        raise AssertionError("timed out")
+
+    async def scenario():
+        heartbeat = lambda index: str(tmp_path / f"beat-{index}")
+        pool = proxy_workers.WorkerPool(
+            LogBus(), lambda port, index: [sys.executable, "-c", script, str(port), str(index), heartbeat(index)], None,
+            count=2, heartbeat_file=heartbeat,
+        )
+        port = proxy_workers.free_port()
+        await pool.start(port)
+        try:
+            await until(lambda: all(w.healthy for w in pool.workers))
+            assert {await ask(port), await ask(port)} <= {b"0", b"1"}
+
+            crashed = pool.workers[0]
+            crashed.process.kill()
+            await until(lambda: crashed.restarts == 1 and crashed.healthy)
+            assert await ask(port) in (b"0", b"1")
+
+            pids = {w.process.pid for w in pool.workers}
+            await pool.rolling_restart(port)
+            assert not pids & {w.process.pid for w in pool.workers}
+            assert [s["restarts"] for s in pool.states()] == [2, 1]
+            assert await ask(port) in (b"0", b"1")
+
+            # Alive but stuck: its heartbeat goes stale, it is killed and replaced
+            stuck = pool.workers[1]
+            os.kill(stuck.process.pid, signal.SIGSTOP)
+            await until(lambda: stuck.restarts == 2 and stuck.healthy)
+            assert await ask(port) in (b"0", b"1")
+
+            # A refused connection keeps the worker out until it is replaced
+            refused = pool.workers[0]
+            refused.refuse()
+            await asyncio.sleep(0.01)
+            assert not refused.healthy
+            await until(lambda: refused.restarts == 3 and refused.healthy)
+        finally:
+            await pool.stop()
+
+    asyncio.run(scenario())
+
+
+def test_config_saves_are_batched_and_skipped_when_unchanged(monkeypatch):
+    """Test that rapid updates share one atomic write and unchanged rules are not rewritten."""
+    import asyncio
+    import backend.config_manager as config_module
+
+    cm = ConfigManager()
+    cm.generate_rules_json()
+    pushed = []
+    cm.add_rules_listener(pushed.append)
+    writes = []
+    real_write = config_module.write_atomic
+    monkeypatch.setattr(config_module, "write_atomic", lambda f, raw: (writes.append(f), real_write(f, raw)))
+
+    # Unchanged rules: nothing is written or pushed
+    cm.generate_rules_json()
+    assert writes == [] and pushed == []
+
+    # A failing batch changes nothing
+    assert cm.update_active_profile_batch([{"apps": {"copilot": {"enabled": False}}}, "bad"]) is None
+    assert cm.get_active_profile()["apps"]["copilot"]["enabled"] is True
+
+    async def burst():
+        # Ends on copilot disabled
+        toggles = [{"apps": {"copilot": {"enabled": i % 2 == 0}}} for i in range(4)]
+        for updates in toggles:
+            cm.update_active_profile(updates, save=False)
+        await asyncio.gather(*(cm.save_soon() for _ in toggles))
+
+    asyncio.run(burst())
+    assert sorted(writes) == [PROFILES_FILE, RULES_FILE]
+    assert len(pushed) == 1 and "copilot.microsoft.com" not in pushed[0]["intercept_hosts"]
+    with open(RULES_FILE) as f:
+        assert json.load(f) == pushed[0]
+    assert not [f for f in os.listdir(".") if f.endswith(".tmp")]
+
+
+def test_clients_get_their_own_precompiled_profile():
+    """Test that each client mapped to a profile gets that profile's rules."""
+    from backend.addon_proxy import AITweaker
+    from mitmproxy.test import tflow, tutils
+    from mitmproxy import ctx
+    from unittest.mock import MagicMock
+
+    cm = ConfigManager()
+    kids = json.loads(json.dumps(cm.get_active_profile()))
+    kids["apps"]["gemini"]["flag_configs"] = {"777": {"enabled": True}}
+    cm.profiles_data["profiles"]["kids"] = kids
+    assert not cm.set_client_profile("10.0.0.9", "missing")
+    assert cm.set_client_profile("10.0.0.9", "kids", save=False)
+    assert cm.set_client_profile("alice", "kids", save=False)
+    rules = cm.build_rules()
+    assert set(rules["profiles"]) == {"kids"}
+    assert rules["clients"] == {"10.0.0.9": "kids", "alice": "kids"}
+
+    ctx.log = MagicMock()
+    addon = AITweaker()
+    addon.rules = rules
+    assert addon.snapshot.profiles["kids"] is addon.snapshot.clients["alice"]
+
+    def inject(address, user=None):
+        flow = tflow.tflow(req=tutils.treq(host="www.gstatic.com", path=b"/js/m=_b"), resp=True)
+        flow.client_conn.peername = (address, 5000)
+        if user:
+            flow.metadata["proxyauth"] = (user, "secret")
+        flow.response.content = b"code;"
+        addon.modify_gemini_script(flow)
+        return flow.response.content
+
+    assert b"new Set([777])" in inject("10.0.0.9")
+    assert b"new Set([777])" in inject("10.0.0.5", "alice")
+    assert b"777" not in inject("10.0.0.5")
+
+
+def test_events_stream_pushes_status_and_config():
+    """Test that /ws/events sends the current status, then config changes, without network calls per request."""
+    import asyncio
+    import backend.main as main
+    from backend.events import metrics_delta
+    from backend.network import NetworkInfo
+
+    changes = []
+    network = NetworkInfo(discover=lambda: "192.168.1.7", on_change=changes.append)
+    asyncio.run(network.refresh())
+    asyncio.run(network.refresh())
+    assert network.local_ip == "192.168.1.7" and changes == ["192.168.1.7"]
+
+    with client.websocket_connect("/ws/events") as ws:
+        first = json.loads(ws.receive_text())
+        assert first["type"] == "status" and first["data"]["running"] is False
+        # Flip whatever earlier tests left, so the rules really change
+        enabled = not main.config_manager.get_active_profile()["apps"]["copilot"]["enabled"]
+        response = client.post("/config", json={"updates": {"apps": {"copilot": {"enabled": enabled}}}})
+        assert response.status_code == 200
+        event = json.loads(ws.receive_text())
+        assert event["type"] == "config"
+        # The version the addon reports for the rules.json just written
+        from backend.rules_store import RulesStore
+        assert event["data"]["rules_version"] == RulesStore(RULES_FILE).get().version
+    assert not main.events.subscribers
+
+    before = {"handlers": {"h": {"flows": 2, "errors": 0, "buckets": [2, 0]}}}
+    after = {"handlers": {"h": {"flows": 5, "errors": 0, "buckets": [4, 1]}, "new": {"flows": 1}}}
+    assert metrics_delta(before, after) == {"h": {"flows": 3}, "new": {"flows": 1}}
+
+
+def test_intercept_patterns_match_connect_host_and_load_test_args():
+    """Test that allow_hosts patterns accept the CONNECT Host header's port, and ProxyManager passes load test options."""
+    import re
+    from backend.routing import host_patterns
+    from backend.proxy_manager import ProxyManager
+
+    patterns = host_patterns(["gemini.google.com"])
+    for host in ("gemini.google.com", "gemini.google.com:443"):
+        assert any(re.search(p, host) for p in patterns)
+    assert not any(re.search(p, "gemini.google.com.evil:443") for p in patterns)
+
+    manager = ProxyManager(workers=2, extra_args=["-s", "redirect.py"], metrics_file="/tmp/m.json")
+    cmd = manager._build_cmd(9000, 1)
+    assert cmd[cmd.index("-s", 2) + 1] == "redirect.py"
+    assert "tweaker_metrics_file=/tmp/m-1.json" in cmd
+    assert sum(arg.startswith("tweaker_metrics_file=") for arg in cmd) == 1
+
+
+def test_leaf_certs_are_reused_until_near_expiry(tmp_path, monkeypatch):
+    """Test that leaf certs are generated once per host, reused across starts and renewed near expiry."""
+    import datetime
+    from pathlib import Path
+    from cryptography import x509
+    from mitmproxy.certs import CertStore
+    import backend.leaf_certs as leaf_certs
+    from backend.proxy_manager import ProxyManager
+
+    cache = leaf_certs.LeafCertCache(confdir=str(tmp_path))
+    files = cache.ensure(["gemini.google.com", "Labs.Google", "not a host"])
+    assert sorted(files) == ["gemini.google.com", "labs.google"]
+    mtimes = {host: os.stat(path).st_mtime_ns for host, path in files.items()}
+
+    # A fresh cache over the same directory, as after a backend restart
+    again = leaf_certs.LeafCertCache(confdir=str(tmp_path)).ensure(["gemini.google.com", "labs.google"])
+    assert {host: os.stat(path).st_mtime_ns for host, path in again.items()} == mtimes
+
+    # mitmproxy serves the file for the host, paired with the CA key
+    store = CertStore.from_store(str(tmp_path), "mitmproxy", 2048)
+    store.add_cert_file("labs.google", Path(files["labs.google"]))
+    entry = store.get_cert("labs.google", [x509.DNSName("labs.google")])
+    assert str(entry.chain_file) == files["labs.google"]
+    assert entry.privatekey is store.default_privatekey
+
+    with open(files["labs.google"], "rb") as f:
+        old = f.read()
+    monkeypatch.setattr(leaf_certs, "RENEW_BEFORE", datetime.timedelta(days=400))
+    cache.ensure(["labs.google"])
+    with open(files["labs.google"], "rb") as f:
+        assert f.read() != old
+
+    manager = ProxyManager()
+    manager.cert_files = files
+    cmd = manager._build_cmd(8080, None)
+    assert cmd[-4:] == ["--certs", f"gemini.google.com={files['gemini.google.com']}", "--certs", f"labs.google={files['labs.google']}"]
+
+
+def test_gemini_pages_load_the_shim_from_an_immutable_url():
+    """Test that HTML gets only a script tag and the proxy serves the shim itself, cacheable for good."""
+    import asyncio
+    from backend.addon_proxy import AITweaker
+    from backend.http_cache import IMMUTABLE_CACHE_CONTROL
+    from backend.rules_store import MemoryRulesStore
+    from mitmproxy.test import tflow, tutils
+    from mitmproxy import ctx
+    from unittest.mock import MagicMock
+
+    ctx.log = MagicMock()
+    addon = AITweaker(rules_store=MemoryRulesStore({"apps": {"gemini": {"enabled": True, "flags": [7]}}}))
+    gemini = addon.snapshot.compiled.gemini
+
+    page = tflow.tflow(
+        req=tutils.treq(host="gemini.google.com", path=b"/app"),
+        resp=tutils.tresp(content=b"<html><head><title>x</title></head></html>"),
+    )
+    page.response.headers["content-type"] = "text/html"
+    addon.modify_gemini_html(page)
+    assert f'<head><script src="{gemini.shim_path}"></script>'.encode() in page.response.content
+    assert b"ext_ids" not in page.response.content
+
+    def fetch(path, **headers):
+        flow = tflow.tflow(req=tutils.treq(host="gemini.google.com", path=path.encode()))
+        flow.request.headers.update(headers)
+        addon.request(flow)
+        return flow
+
+    shim = fetch(gemini.shim_path)
+    assert shim.response.status_code == 200
+    assert "immutable" in shim.response.headers["cache-control"]
+    assert b"new Set([7])" in shim.response.content
+    asyncio.run(addon.response(shim))
+    assert shim.response.content == gemini.shim_js
+
+    again = fetch(gemini.shim_path, **{"if-none-match": shim.response.headers["etag"]})
+    assert again.response.status_code == 304
+
+    # An outdated name still works, but must not be cached under that name
+    stale = fetch("/__aitweaker/shim-0000000000000000.js")
+    assert stale.response.status_code == 200 and stale.response.headers["cache-control"] == "no-store"
+
+    # A client remapped to another profile still gets the active profile's shim it holds
+    addon.rules = {
+        "apps": {"gemini": {"enabled": True, "flags": [7]}},
+        "profiles": {"other": {"apps": {"gemini": {"enabled": True, "flags": [8]}}}},
+        "clients": {"127.0.0.1": "other"},
+    }
+    addon.load_rules = lambda: None
+    held = fetch(gemini.shim_path)
+    assert held.response.headers["cache-control"] == IMMUTABLE_CACHE_CONTROL
+    assert held.response.content == gemini.shim_js
+
+
+def test_frontend_is_served_precompressed_with_validators(tmp_path):
+    """Test that the dist manifest picks an encoding per client, caches hashed assets for good and answers 304s."""
+    import gzip
+    from backend.static_files import FrontendManifest, IMMUTABLE_CACHE_CONTROL
+
+    (tmp_path / "assets").mkdir()
+    script = b"console.log('dashboard');\n" * 200
+    (tmp_path / "assets" / "index-abc123.js").write_bytes(script)
+    (tmp_path / "index.html").write_bytes(b"<!doctype html><div id=root></div>")
+    manifest = FrontendManifest.build(str(tmp_path))
+
+    asset = manifest.get("assets/index-abc123.js")
+    br = manifest.respond(asset, {"accept-encoding": "gzip, deflate, br"})
+    assert br.headers["content-encoding"] == "br"
+    assert br.headers["cache-control"] == IMMUTABLE_CACHE_CONTROL
+    assert br.headers["vary"] == "Accept-Encoding"
+
+    gz = manifest.respond(asset, {"accept-encoding": "gzip, br;q=0"})
+    assert gz.headers["content-encoding"] == "gzip" and gzip.decompress(gz.body) == script
+    assert gz.headers["etag"] != br.headers["etag"]
+
+    plain = manifest.respond(asset, {})
+    assert plain.body == script and "content-encoding" not in plain.headers
+
+    again = manifest.respond(asset, {"accept-encoding": "gzip", "if-none-match": gz.headers["etag"]})
+    assert again.status_code == 304 and again.body == b""
+
+    # Too small to be worth compressing; revalidated rather than cached for good
+    index = manifest.index
+    page = manifest.respond(index, {"accept-encoding": "br"})
+    assert "content-encoding" not in page.headers and page.headers["cache-control"] == "no-cache"
+    assert manifest.get("missing.js") is None